@@ -0,0 +1,67 @@
+"""Compares SparkBot's command tokenizer with the shlex.split it replaced
+
+Run from the repository root::
+
+    python benchmarks/bench_commandline.py
+
+Each line of the report is the average time to turn one message's text into a command line, for
+the previous path (``shlex.split`` then comparing the first token to the bot's name) and the
+current one (:func:`sparkbot.commandline.strip_mention` then
+:func:`sparkbot.commandline.tokenize`).
+"""
+
+import argparse
+import shlex
+import sys
+import timeit
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from ciscosparkapi import Person
+from sparkbot.commandline import strip_mention, tokenize
+
+ME = Person({"id": "botid", "displayName": "Bot"})
+MENTION_HTML = ('<p><spark-mention data-object-type="person" data-object-id="botid">Bot'
+                '</spark-mention> deploy service-a to staging</p>')
+
+# (name, text, html, mentionedPeople)
+MESSAGES = [
+    ("direct, one word", "ping", None, None),
+    ("direct, several words", "deploy service-a to staging --force", None, None),
+    ("group, mention", "Bot deploy service-a to staging", MENTION_HTML, ["botid"]),
+    ("quoted", 'remind me "stand-up in five minutes"', None, None),
+]
+
+def previous(text):
+    commandline = shlex.split(text)
+    if commandline[0] == ME.displayName:
+        del commandline[0]
+    return commandline
+
+def current(text, html, mentioned_people):
+    return tokenize(strip_mention(text, ME, html=html, mentioned_people=mentioned_people))
+
+def measure(statement, number):
+    """ Returns the best average time per call of ``statement``, in microseconds """
+    timer = timeit.Timer(statement)
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000,
+                        help="calls per measurement (default: %(default)s)")
+    args = parser.parse_args()
+
+    print("{:<28}{:>12}{:>12}{:>10}".format("message", "shlex us", "current us", "speedup"))
+
+    for name, text, html, mentioned_people in MESSAGES:
+        assert previous(text) == current(text, html, mentioned_people)
+        before = measure(lambda: previous(text), args.number)
+        after = measure(lambda: current(text, html, mentioned_people), args.number)
+        print("{:<28}{:>12.3f}{:>12.3f}{:>9.1f}x".format(name, before, after, before / after))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""Measures how long SparkBot takes to dispatch a command, not counting the command itself
+
+Run from the repository root::
+
+    python benchmarks/bench_dispatch.py
+
+Each line of the report is the average time per call. ``overhead`` is that time minus the cost of
+calling the command's function directly. Pass ``--max-overhead`` to exit with an error when any
+dispatch path is slower than that many microseconds, for example in CI.
+"""
+
+import argparse
+import sys
+import timeit
+from os import path
+from unittest import mock
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from ciscosparkapi import CiscoSparkAPI, Person, Webhook
+from sparkbot import SparkBot
+
+def make_bot():
+    """ Returns a SparkBot which doesn't make any network requests """
+
+    spark_api = mock.MagicMock(spec=CiscoSparkAPI)
+    spark_api.people = mock.MagicMock()
+    spark_api.webhooks = mock.MagicMock()
+    spark_api.people.me.return_value = Person({"id": "botid", "displayName": "Bot"})
+
+    bot = SparkBot(spark_api)
+
+    @bot.command("noargs")
+    def noargs():
+        return "pong"
+
+    @bot.command("someargs")
+    def someargs(commandline, caller, room_id):
+        return "pong"
+
+    @bot.command("callback")
+    def callback(callback):
+        return "pong"
+
+    return bot
+
+def measure(statement, number):
+    """ Returns the best average time per call of ``statement``, in microseconds """
+    timer = timeit.Timer(statement)
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=100000,
+                        help="calls per measurement (default: %(default)s)")
+    parser.add_argument("--max-overhead", type=float, default=None,
+                        help="fail if any dispatch overhead exceeds this many microseconds")
+    args = parser.parse_args()
+
+    bot = make_bot()
+    commandline = ["someargs", "one", "two"]
+    event = Webhook({"data": {"id": "messageid", "roomId": "roomid"}})
+    caller = Person({"id": "personid", "emails": ["person@example.com"]})
+
+    function = bot.commands["someargs"].function
+    baseline = measure(lambda: function(commandline, caller, "roomid"), args.number)
+
+    cases = [
+        ("Command.execute, no parameters",
+         lambda: bot.commands["noargs"].execute(commandline=commandline, event=event,
+                                                caller=caller, callback=bot.respond,
+                                                room_id="roomid")),
+        ("Command.execute, three parameters",
+         lambda: bot.commands["someargs"].execute(commandline=commandline, event=event,
+                                                  caller=caller, callback=bot.respond,
+                                                  room_id="roomid")),
+        ("Command.execute, callback",
+         lambda: bot.commands["callback"].execute(commandline=commandline, event=event,
+                                                  caller=caller, callback=bot.respond,
+                                                  room_id="roomid")),
+        ("SparkBot._executeuserfunction",
+         lambda: bot._executeuserfunction("someargs", commandline, event, caller, "roomid")),
+    ]
+
+    print("{:<40}{:>12}{:>12}".format("path", "us/call", "overhead"))
+    print("{:<40}{:>12.3f}{:>12}".format("direct function call", baseline, "-"))
+
+    worst_overhead = 0
+    for name, statement in cases:
+        per_call = measure(statement, args.number)
+        overhead = per_call - baseline
+        worst_overhead = max(worst_overhead, overhead)
+        print("{:<40}{:>12.3f}{:>12.3f}".format(name, per_call, overhead))
+
+    if args.max_overhead is not None and worst_overhead > args.max_overhead:
+        print("Dispatch overhead of {:.3f}us exceeds the limit of {:.3f}us".format(
+            worst_overhead, args.max_overhead))
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
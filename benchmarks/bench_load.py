@@ -0,0 +1,204 @@
+"""Measures SparkBot's throughput and latency under a steady load of webhooks, fully offline
+
+Run from the repository root::
+
+    python benchmarks/bench_load.py --rate 100 --duration 10 --latency 0.05
+
+A local stub of the Webex Teams API (see ``webex_stub.py``) stands in for the real service, and
+answers every request after ``--latency`` seconds. The bot's receiver is served on localhost and
+``loadgen.py`` posts signed webhooks to it. Each webhook runs a ``ping`` command whose reply is
+recorded by the stub.
+
+The report shows:
+
+* throughput: replies per second, from the first webhook to the last reply
+* ack latency: how long the receiver took to answer each webhook
+* reply latency: from sending a webhook until the stub received the bot's reply
+* threads and RSS: sampled while the benchmark ran. The stub and load generator run in the same
+  process, so compare these between releases rather than reading them as absolutes.
+
+Pass ``--json`` to print the report as JSON for comparing runs.
+"""
+
+import argparse
+import json
+import resource
+import sys
+import threading
+from os import path, sysconf
+from time import monotonic, sleep
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from ciscosparkapi import CiscoSparkAPI
+from sparkbot import SparkBot
+from sparkbot.executor import WorkerPool
+from sparkbot.journal import Journal
+from sparkbot.sender import MessageSender
+from loadgen import LoadGenerator, percentile, serve
+from webex_stub import WebexStub
+
+def current_rss():
+    """ Returns the resident set size of this process in bytes, or None if it isn't known """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+def peak_rss():
+    """ Returns the largest resident set size this process has had, in bytes """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class Sampler:
+    """ Records the thread count and RSS of this process every ``interval`` seconds """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.threads = []
+        self.rss = []
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="sampler")
+        self._thread.daemon = True
+
+    def _sample(self):
+        while not self._stopped.is_set():
+            self.threads.append(threading.active_count())
+            rss = current_rss()
+            if rss is not None:
+                self.rss.append(rss)
+            self._stopped.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+def make_bot(stub, root_url, args):
+    """ Returns a SparkBot which talks to ``stub`` and registers its webhook at ``root_url`` """
+
+    spark_api = CiscoSparkAPI("stub-token", base_url=stub.base_url)
+    executor = WorkerPool(workers=args.workers, queue_size=args.queue_size)
+    # The real rate limits would make the sender the bottleneck, so they are raised unless asked
+    sender = MessageSender(spark_api, rate=args.send_rate, burst=args.send_rate,
+                           room_rate=args.send_rate, room_burst=args.send_rate)
+    journal = Journal(args.journal) if args.journal else None
+    bot = SparkBot(spark_api, root_url=root_url, executor=executor, sender=sender,
+                   journal=journal)
+
+    command_time = args.command_time
+
+    @bot.command("ping")
+    def ping():
+        if command_time:
+            sleep(command_time)
+        return "pong"
+
+    return bot
+
+def run(args):
+    """ Runs the benchmark described by ``args`` and returns the report as a dict """
+
+    stub = WebexStub(latency=args.latency).start()
+
+    # The receiver has to be listening before the bot registers its webhook, so serve a
+    # placeholder and swap the bot's receiver in once it exists.
+    app = {}
+    server, root_url = serve(lambda environ, start_response: app["receiver"](environ,
+                                                                             start_response))
+    startup_started = monotonic()
+    bot = make_bot(stub, root_url, args)
+    startup = monotonic() - startup_started
+    app["receiver"] = bot.receiver
+
+    generator = LoadGenerator(root_url + "/sparkbot", bot.webhook_secret, stub, args.rate,
+                              args.duration, concurrency=args.concurrency)
+
+    with Sampler() as sampler:
+        generator.run()
+        accepted = sum(1 for result in generator.results if result[3] == 204)
+
+        # Wait for the replies to the accepted webhooks
+        deadline = monotonic() + args.drain_timeout
+        while len(stub.sent) < accepted and monotonic() < deadline:
+            sleep(0.05)
+
+    server.shutdown()
+    stub.stop()
+
+    sent_at = {result[0]: result[1] for result in generator.results}
+    reply_latencies = [replied_at - sent_at[room_id] for replied_at, room_id, _ in stub.sent
+                       if room_id in sent_at]
+    ack_latencies = [result[2] for result in generator.results]
+    first_sent = min(sent_at.values())
+    last_reply = max(replied_at for replied_at, _, _ in stub.sent) if stub.sent else first_sent
+
+    def milliseconds(value):
+        return None if value is None else round(value * 1000, 2)
+
+    return {
+        "rate": args.rate,
+        "duration": args.duration,
+        "latency": args.latency,
+        "workers": args.workers,
+        "startup_ms": milliseconds(startup),
+        "webhooks": len(generator.results),
+        "accepted": accepted,
+        "rejected": sum(1 for result in generator.results if result[3] == 503),
+        "failed": sum(1 for result in generator.results if result[3] not in (204, 503)),
+        "replies": len(stub.sent),
+        "throughput": round(len(stub.sent) / (last_reply - first_sent), 2)
+                      if last_reply > first_sent else 0,
+        "ack_p50_ms": milliseconds(percentile(ack_latencies, 0.5)),
+        "ack_p99_ms": milliseconds(percentile(ack_latencies, 0.99)),
+        "reply_p50_ms": milliseconds(percentile(reply_latencies, 0.5)),
+        "reply_p99_ms": milliseconds(percentile(reply_latencies, 0.99)),
+        "threads_max": max(sampler.threads),
+        "rss_max_mb": round(max(sampler.rss) / 2 ** 20, 1) if sampler.rss else None,
+        "rss_peak_mb": round(peak_rss() / 2 ** 20, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=50,
+                        help="webhooks per second (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to send webhooks for (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds the API stub waits before each response "
+                             "(default: %(default)s)")
+    parser.add_argument("--command-time", type=float, default=0,
+                        help="seconds the ping command sleeps for (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=10,
+                        help="bot worker threads (default: %(default)s)")
+    parser.add_argument("--queue-size", type=int, default=100,
+                        help="bot worker queue size (default: %(default)s)")
+    parser.add_argument("--send-rate", type=float, default=10000,
+                        help="messages per second the bot may send (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=64,
+                        help="webhooks the load generator may have in flight "
+                             "(default: %(default)s)")
+    parser.add_argument("--drain-timeout", type=float, default=30,
+                        help="seconds to wait for replies after sending (default: %(default)s)")
+    parser.add_argument("--journal", metavar="PATH",
+                        help="journal webhooks to this SQLite file before acknowledging them")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = run(args)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print("{:<16}{:>12}".format(key, "-" if value is None else value))
+
+    return 0 if report["replies"] == report["accepted"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
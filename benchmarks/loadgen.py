@@ -0,0 +1,136 @@
+"""Posts signed webhooks to a SparkBot receiver at a steady rate
+
+The generator is open-loop: webhook ``n`` is sent ``n / rate`` seconds after the start whether or
+not earlier ones have been answered, the same way Webex Teams delivers webhooks. Each webhook is
+for a new message in its own room, so every reply the stub records can be matched to the webhook
+that caused it.
+"""
+
+import hashlib
+import hmac
+import json
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from threading import Thread, local
+from time import monotonic, sleep
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+import requests
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+def serve(app):
+    """ Serves the WSGI ``app`` on a random local port in a background thread
+
+    :returns: tuple of (server, root URL)
+    """
+
+    server = make_server("127.0.0.1", 0, app, server_class=_ThreadingWSGIServer,
+                         handler_class=_QuietHandler)
+    thread = Thread(target=server.serve_forever, name="receiver")
+    thread.daemon = True
+    thread.start()
+
+    return server, "http://127.0.0.1:{}".format(server.server_port)
+
+def percentile(values, fraction):
+    """ Returns the value below which ``fraction`` of ``values`` fall (nearest rank) """
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+class LoadGenerator:
+    """ Sends ``rate`` webhooks per second for ``duration`` seconds
+
+    :param url: URL of the receiver's webhook route, such as ``http://127.0.0.1:8000/sparkbot``
+
+    :param secret: The bot's ``webhook_secret``, used to sign each body
+
+    :param stub: :class:`webex_stub.WebexStub` that the bot fetches messages from
+
+    :param rate: Webhooks per second
+
+    :param duration: Number of seconds to send for
+
+    :param concurrency: Maximum number of webhooks waiting for a response at once
+
+    :param text: Text of every message, such as ``"ping"``
+
+    :ivar results: list of ``(room ID, time sent, seconds to acknowledge, status code)``
+    """
+
+    def __init__(self, url, secret, stub, rate, duration, concurrency=64, text="ping"):
+        self.url = url
+        self.secret = secret
+        self.stub = stub
+        self.rate = rate
+        self.duration = duration
+        self.concurrency = concurrency
+        self.text = text
+        self.results = []
+        self._sessions = local()
+
+        self.person_id = "load-person"
+        stub.add_person(self.person_id, "load@example.com")
+
+    def _prepare(self, number):
+        """ Creates the message for webhook ``number`` in the stub and returns its signed body """
+
+        room_id = "load-room-{}".format(number)
+        message_id = "load-message-{}".format(number)
+        self.stub.add_room(room_id)
+        self.stub.add_message(message_id, room_id, self.person_id, self.text)
+
+        body = json.dumps({
+            "id": "load-webhook",
+            "resource": "messages",
+            "event": "created",
+            "actorId": self.person_id,
+            "data": {"id": message_id, "roomId": room_id, "personId": self.person_id,
+                     "roomType": "direct"},
+        }).encode("utf-8")
+        signature = hmac.new(self.secret, msg=body, digestmod=hashlib.sha1).hexdigest()
+
+        return room_id, body, signature
+
+    def _post(self, room_id, body, signature):
+        session = getattr(self._sessions, "session", None)
+        if session is None:
+            session = self._sessions.session = requests.Session()
+
+        sent_at = monotonic()
+        try:
+            status = session.post(self.url, data=body, timeout=30,
+                                  headers={"X-Spark-Signature": signature,
+                                           "Content-Type": "application/json"}).status_code
+        except requests.RequestException:
+            status = None
+
+        self.results.append((room_id, sent_at, monotonic() - sent_at, status))
+
+    def run(self):
+        """ Sends every webhook and waits for each to be acknowledged
+
+        :returns: Number of seconds from the first webhook until the last was acknowledged
+        """
+
+        total = int(self.rate * self.duration)
+        prepared = [self._prepare(number) for number in range(total)]
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            start = monotonic()
+            for number, webhook in enumerate(prepared):
+                delay = start + number / self.rate - monotonic()
+                if delay > 0:
+                    sleep(delay)
+                pool.submit(self._post, *webhook)
+
+        return monotonic() - start
@@ -0,0 +1,148 @@
+"""An in-process stand-in for the parts of the Webex Teams API that SparkBot uses
+
+It serves ``people``, ``rooms``, ``messages`` and ``webhooks`` over HTTP on localhost, so a real
+CiscoSparkAPI (and the bot's connection pool) can be pointed at it with ``stub.base_url``. Every
+request waits ``latency`` seconds before it is answered, to stand in for the real service.
+"""
+
+import json
+import re
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+BOT_ID = "stub-bot-id"
+BOT_NAME = "Bot"
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Load tests open many connections at once
+    request_queue_size = 1024
+
+class WebexStub:
+    """ Serves a fake Webex Teams API on a random local port
+
+    :param latency: Number of seconds to wait before answering each request
+
+    :ivar sent: list of ``(time, roomId, markdown)`` for every message the bot created, where
+                ``time`` is from ``time.monotonic()``
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = []
+        self.requests = 0
+
+        self._lock = Lock()
+        self._people = {BOT_ID: {"id": BOT_ID, "displayName": BOT_NAME,
+                                 "emails": ["bot@sparkbot.io"], "type": "bot"}}
+        self._rooms = {}
+        self._messages = {}
+        self._webhooks = {}
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub._handle(self, "GET")
+
+            def do_POST(self):
+                stub._handle(self, "POST")
+
+            def do_DELETE(self):
+                stub._handle(self, "DELETE")
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _Server(("127.0.0.1", 0), Handler)
+        self.base_url = "http://127.0.0.1:{}/v1/".format(self._server.server_port)
+        self._thread = Thread(target=self._server.serve_forever, name="webex-stub")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_person(self, person_id, email, display_name="Person"):
+        with self._lock:
+            self._people[person_id] = {"id": person_id, "emails": [email],
+                                       "displayName": display_name, "type": "person"}
+
+    def add_room(self, room_id, room_type="direct"):
+        with self._lock:
+            self._rooms[room_id] = {"id": room_id, "type": room_type, "title": room_id}
+
+    def add_message(self, message_id, room_id, person_id, text):
+        """ Stores a message for the bot to fetch, as if ``person_id`` had sent it """
+
+        with self._lock:
+            self._messages[message_id] = {"id": message_id, "roomId": room_id,
+                                          "personId": person_id, "text": text,
+                                          "roomType": self._rooms.get(room_id, {}).get("type",
+                                                                                       "direct")}
+
+    def _handle(self, handler, method):
+        if self.latency:
+            sleep(self.latency)
+
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = json.loads(handler.rfile.read(length).decode("utf-8")) if length else {}
+        path = handler.path.split("?")[0]
+
+        with self._lock:
+            self.requests += 1
+            status, response = self._route(method, path, body)
+
+        payload = json.dumps(response).encode("utf-8") if response is not None else b""
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def _route(self, method, path, body):
+        """ Returns the status and JSON response for a request. Called with the lock held. """
+
+        match = re.match(r"^/v1/(people|rooms|messages|webhooks)(?:/([^/]+))?$", path)
+        if not match:
+            return 404, {"message": "Not found"}
+
+        collection, item_id = match.groups()
+
+        if collection == "people" and item_id == "me":
+            return 200, self._people[BOT_ID]
+
+        if collection == "messages" and method == "POST":
+            message = {"id": str(uuid.uuid4()), "roomId": body.get("roomId"),
+                       "markdown": body.get("markdown"), "personId": BOT_ID}
+            self.sent.append((monotonic(), message["roomId"], message["markdown"]))
+            return 200, message
+
+        if collection == "webhooks" and method == "POST":
+            webhook = dict(body, id=str(uuid.uuid4()))
+            self._webhooks[webhook["id"]] = webhook
+            return 200, webhook
+
+        items = {"people": self._people, "rooms": self._rooms,
+                 "messages": self._messages, "webhooks": self._webhooks}[collection]
+
+        if item_id is None and method == "GET":
+            return 200, {"items": list(items.values())}
+
+        if item_id in items and method == "GET":
+            return 200, items[item_id]
+
+        if item_id in items and method == "DELETE":
+            del items[item_id]
+            return 204, None
+
+        return 404, {"message": "Not found"}
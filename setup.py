@@ -122,7 +122,12 @@ setup(
             'sphinx',
             'sphinx-rtd-theme',
             'requests',
-            'pytest'
+            'pytest',
+            'aiohttp'
+        ],
+        'asgi': [
+            'falcon>=3',
+            'aiohttp'
         ],
     },
 )
@@ -0,0 +1,146 @@
+"""A small asyncio client for the Webex Teams API calls that SparkBot makes while handling a
+command"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from ciscosparkapi import Message, Person, Room
+from .exceptions import ApiError
+from . import tracing
+
+class AsyncSparkAPI:
+    """ Makes the Webex Teams API calls needed by :func:`SparkBot.async_commandworker` on an
+    asyncio event loop
+
+    Requires the optional ``aiohttp`` package, which is installed by ``pip install sparkbot[asgi]``.
+    The returned objects are the same ``ciscosparkapi`` models that the synchronous API returns,
+    so commands do not need to know which receiver called them.
+
+    :param access_token: Webex Teams access token for the bot account
+
+    :param base_url: Base URL of the Webex Teams API, including the trailing slash
+
+    :param timeout: Maximum number of seconds to wait for a single request
+
+    :param wait_on_rate_limit: If True, requests which are rate limited are retried after the
+                               number of seconds given in the ``Retry-After`` header
+
+    :param pool: :class:`sparkbot.connectionpool.ConnectionPool` whose connection limits and
+                 timeouts to use. ``timeout`` still limits each request as a whole.
+    """
+
+    def __init__(self, access_token, base_url, timeout=60, wait_on_rate_limit=True, pool=None):
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError("AsyncSparkAPI requires aiohttp. "
+                              "Install it with `pip install sparkbot[asgi]`.")
+
+        self._aiohttp = aiohttp
+        self.base_url = base_url
+        self.timeout = timeout
+        self.wait_on_rate_limit = wait_on_rate_limit
+        self.pool = pool
+        self._headers = {
+            "Authorization": "Bearer " + access_token,
+            "Content-Type": "application/json;charset=utf-8"
+        }
+        self._session = None
+
+    @classmethod
+    def from_spark_api(cls, spark_api, pool=None):
+        """ Creates an AsyncSparkAPI using the token and URL of an existing CiscoSparkAPI """
+
+        return cls(spark_api.access_token,
+                   spark_api.base_url,
+                   timeout=spark_api.single_request_timeout,
+                   wait_on_rate_limit=spark_api.wait_on_rate_limit,
+                   pool=pool)
+
+    def _get_session(self):
+        # aiohttp sessions are bound to the loop they are created on, so this must only be called
+        # from a coroutine running on the bot's loop.
+        if self._session is None or self._session.closed:
+            if self.pool:
+                connector = self.pool.aiohttp_connector()
+                timeout = self.pool.aiohttp_timeout()
+                timeout = self._aiohttp.ClientTimeout(total=self.timeout,
+                                                      sock_connect=timeout.sock_connect,
+                                                      sock_read=timeout.sock_read)
+            else:
+                connector = None
+                timeout = self._aiohttp.ClientTimeout(total=self.timeout)
+
+            self._session = self._aiohttp.ClientSession(headers=self._headers,
+                                                        connector=connector,
+                                                        timeout=timeout)
+        return self._session
+
+    async def request(self, method, url, expected_status, **kwargs):
+        """ Makes a request to the API and returns the decoded JSON response
+
+        :param method: HTTP method, such as ``"GET"``
+
+        :param url: Endpoint, relative to ``base_url``
+
+        :param expected_status: The HTTP status code which indicates success
+
+        :raises ApiError: The API returned something other than ``expected_status``
+        """
+
+        session = self._get_session()
+
+        while True:
+            with tracing.span("webex_api", method=method, path=url.split("?")[0]) as span:
+                async with session.request(method, self.base_url + url, **kwargs) as response:
+                    span.set("status", response.status)
+                    if response.status == expected_status:
+                        return await response.json()
+
+            if response.status == 429 and self.wait_on_rate_limit:
+                retry_after = max(1, int(response.headers.get("Retry-After", 15)))
+                await asyncio.sleep(retry_after)
+                continue
+
+            raise ApiError("Webex Teams API returned {} for {} {}".format(response.status,
+                                                                         method, url),
+                           status=response.status,
+                           retry_after=response.headers.get("Retry-After"))
+
+    async def get_message(self, message_id):
+        """ Returns the ciscosparkapi.Message with the ID ``message_id`` """
+        return Message(await self.request("GET", "messages/" + message_id, 200))
+
+    async def get_person(self, person_id):
+        """ Returns the ciscosparkapi.Person with the ID ``person_id`` """
+        return Person(await self.request("GET", "people/" + person_id, 200))
+
+    async def get_room(self, room_id):
+        """ Returns the ciscosparkapi.Room with the ID ``room_id`` """
+        return Room(await self.request("GET", "rooms/" + room_id, 200))
+
+    async def create_message(self, room_id, markdown):
+        """ Sends ``markdown`` to the room with the ID ``room_id``
+
+        :returns: ciscosparkapi.Message that was created
+        """
+        return Message(await self.request("POST", "messages", 200,
+                                          json={"roomId": room_id, "markdown": markdown}))
+
+    async def close(self):
+        """ Closes the underlying HTTP session """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
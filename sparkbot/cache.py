@@ -0,0 +1,449 @@
+"""In-process caches for data that SparkBot fetches from Webex Teams"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future
+from hashlib import sha1
+from threading import Lock
+from time import monotonic
+from .exceptions import QueueFull
+from .executor import WorkerPool
+
+class TTLCache:
+    """ A bounded, thread-safe cache whose entries expire
+
+    Values are loaded with :func:`get`, which takes the function used to load a value that isn't
+    cached. Concurrent calls to :func:`get` for the same key share a single call to that function
+    ("single-flight"), so a burst of lookups for one key costs one API request.
+
+    Once an entry is older than ``ttl`` it is stale. A stale entry is still returned for up to
+    ``stale_ttl`` more seconds while a fresh value is loaded on ``refresh_pool``
+    ("stale-while-revalidate"). After that, it is treated as a miss. If ``refresh_pool`` is full,
+    the stale value is returned without a refresh, and the next stale hit tries again.
+
+    When more than ``maxsize`` entries are held, the least recently used entry is evicted.
+
+    :param maxsize: Maximum number of entries to hold
+    :type maxsize: int
+
+    :param ttl: Number of seconds an entry is fresh for
+    :type ttl: float
+
+    :param stale_ttl: Number of seconds after ``ttl`` that a stale entry may still be returned while
+                      it is refreshed. 0 disables stale-while-revalidate.
+    :type stale_ttl: float
+
+    :param refresh_pool: Pool to load fresh values for stale entries on. Defaults to a pool of
+                         two threads for this cache.
+    :type refresh_pool: sparkbot.executor.WorkerPool
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, stale_ttl=0, refresh_pool=None):
+
+        if not isinstance(maxsize, int) or maxsize < 1:
+            raise ValueError("maxsize must be a positive int")
+
+        if ttl <= 0 or stale_ttl < 0:
+            raise ValueError("ttl must be positive and stale_ttl must not be negative")
+
+        if refresh_pool is not None and not isinstance(refresh_pool, WorkerPool):
+            raise TypeError("refresh_pool is not of type sparkbot.executor.WorkerPool")
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        # WorkerPool only starts its threads when it is first used
+        self.refresh_pool = refresh_pool or WorkerPool(workers=2, queue_size=64)
+
+        self._lock = Lock()
+        # key: (value, time the value was loaded)
+        self._entries = OrderedDict()
+        # key: Future of a load in progress
+        self._loading = {}
+        # Keys whose load in progress was invalidated, so its result must not be stored
+        self._discarded_loads = set()
+
+        self._hits = 0
+        self._stale_hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._loads = 0
+        self._load_errors = 0
+        self._evictions = 0
+        self._skipped_refreshes = 0
+
+    def get(self, key, loader):
+        """ Returns the value cached for ``key``, loading it with ``loader(key)`` if needed
+
+        :param key: Key of the value to return
+
+        :param loader: Function which takes ``key`` and returns its value. It is called with no
+                       locks held. If it raises, the exception is passed on to every caller waiting
+                       for the value and nothing is cached.
+        """
+
+        now = monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, loaded_at = entry
+                age = now - loaded_at
+
+                if age < self.ttl:
+                    self._hits += 1
+                    self._entries.move_to_end(key)
+                    return value
+
+                if age < self.ttl + self.stale_ttl:
+                    self._stale_hits += 1
+                    self._entries.move_to_end(key)
+                    if key not in self._loading:
+                        self._refresh(key, loader)
+                    return value
+
+            self._misses += 1
+
+            future = self._loading.get(key)
+            if future is not None:
+                # Somebody else is already loading this key. Wait for their result.
+                self._coalesced += 1
+                owner = False
+            else:
+                future = self._loading[key] = Future()
+                owner = True
+
+        if owner:
+            self._load(key, loader)
+
+        return future.result()
+
+    def _refresh(self, key, loader):
+        """ Starts loading ``key`` on the refresh pool, unless it is full. Must be called with the
+        lock held. """
+
+        self._loading[key] = Future()
+        try:
+            self.refresh_pool.submit(self._load, key, loader)
+        except QueueFull:
+            # Nobody else has seen the Future yet, since we hold the lock
+            del self._loading[key]
+            self._skipped_refreshes += 1
+
+    def _load(self, key, loader):
+        """ Calls ``loader`` and publishes its result to the cache and any waiting callers """
+
+        with self._lock:
+            future = self._loading[key]
+            self._loads += 1
+
+        try:
+            value = loader(key)
+        except BaseException as error:
+            with self._lock:
+                self._load_errors += 1
+                self._discarded_loads.discard(key)
+                del self._loading[key]
+            future.set_exception(error)
+            return
+
+        with self._lock:
+            if key in self._discarded_loads:
+                self._discarded_loads.remove(key)
+            else:
+                self._store(key, value)
+            del self._loading[key]
+        future.set_result(value)
+
+    def _store(self, key, value):
+        """ Inserts an entry, evicting old ones if needed. Must be called with the lock held. """
+
+        self._entries[key] = (value, monotonic())
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def peek(self, key, default=None):
+        """ Returns the value cached for ``key`` if it is fresh, otherwise ``default``
+
+        Unlike :func:`get`, this never loads anything.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and monotonic() - entry[1] < self.ttl:
+                self._hits += 1
+                self._entries.move_to_end(key)
+                return entry[0]
+
+            self._misses += 1
+            return default
+
+    def put(self, key, value):
+        """ Stores ``value`` under ``key`` as if it was just loaded """
+
+        with self._lock:
+            self._store(key, value)
+
+    def update(self, key, function):
+        """ Replaces the value cached for ``key`` with ``function(value)``, keeping its age
+
+        The old value is not modified, so callers still holding it see a consistent value. This
+        does not count as a hit or a miss. If ``key`` is being loaded, the loader may have read
+        its data before the change, so the key is invalidated instead.
+
+        :param function: Function which takes the cached value and returns the new one. It is
+                         called with the lock held, so it must be quick.
+
+        :returns: True if the value was replaced, False if nothing was cached for ``key``
+        """
+
+        with self._lock:
+            if key in self._loading:
+                self._invalidate(key)
+                return False
+
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+
+            self._entries[key] = (function(entry[0]), entry[1])
+            return True
+
+    def invalidate(self, key):
+        """ Removes ``key`` from the cache, if it is present. A load of ``key`` already in
+        progress still returns its value to the callers waiting for it, but doesn't cache it. """
+
+        with self._lock:
+            self._invalidate(key)
+
+    def _invalidate(self, key):
+        """ Must be called with the lock held """
+
+        self._entries.pop(key, None)
+        if key in self._loading:
+            self._discarded_loads.add(key)
+
+    def clear(self):
+        """ Removes every entry from the cache """
+
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        """ True if :func:`get` would return the value for ``key`` without waiting for a load.
+        This does not count as a hit or a miss. """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and monotonic() - entry[1] < self.ttl + self.stale_ttl
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        """ Returns a snapshot of this cache's counters as a dict
+
+        ``stale_hits`` are counted separately from ``hits``. ``coalesced`` counts the misses which
+        waited for another caller's load instead of making their own. ``skipped_refreshes`` counts
+        the stale hits which weren't refreshed because ``refresh_pool`` was full.
+        """
+
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self._hits,
+                "stale_hits": self._stale_hits,
+                "misses": self._misses,
+                "coalesced": self._coalesced,
+                "loads": self._loads,
+                "load_errors": self._load_errors,
+                "evictions": self._evictions,
+                "skipped_refreshes": self._skipped_refreshes,
+            }
+
+class SeenSet:
+    """ A bounded, thread-safe set of recently seen keys, used to drop redelivered webhooks
+
+    :func:`add` records a key and reports whether it was already seen within the last ``window``
+    seconds. Keys are forgotten after ``window`` seconds, or sooner if more than ``maxsize`` have
+    been seen since.
+
+    Only an 8-byte hash of each key is kept, in flat arrays rather than Python objects: a ring of
+    the hashes and the times they were seen, oldest first, and an open-addressed hash table of
+    them for lookups. The 100,000 keys kept by default take under 4 MB.
+
+    :param window: Number of seconds a key is remembered for
+    :type window: float
+
+    :param maxsize: Maximum number of keys to remember
+    :type maxsize: int
+    """
+
+    def __init__(self, window=600, maxsize=100000):
+
+        if not isinstance(maxsize, int) or maxsize < 1:
+            raise ValueError("maxsize must be a positive int")
+
+        if window <= 0:
+            raise ValueError("window must be positive")
+
+        self.window = window
+        self.maxsize = maxsize
+
+        self._lock = Lock()
+        # The ring holds _count hashes starting at _oldest. A hash of 0 is a key which was
+        # discarded.
+        self._hashes = array("Q", [0]) * maxsize
+        self._times = array("d", [0.0]) * maxsize
+        self._oldest = 0
+        self._count = 0
+        # Linear probing table of the hashes in the ring, at most half full. 0 is an empty slot.
+        table_size = 1
+        while table_size < 2 * maxsize:
+            table_size *= 2
+        self._table = array("Q", [0]) * table_size
+        self._size = 0
+
+        self._added = 0
+        self._duplicates = 0
+        self._evictions = 0
+
+    @staticmethod
+    def _hash(key):
+        # Collisions only need to be rare, not hard to find, and sha1 is available on Python 3.5
+        hashed = int.from_bytes(sha1(key.encode("utf-8")).digest()[:8], "big")
+        # 0 marks a discarded key
+        return hashed or 1
+
+    def add(self, key):
+        """ Records ``key`` as seen
+
+        :returns: True if ``key`` is new, False if it was already seen within ``window`` seconds
+        """
+
+        hashed = self._hash(key)
+        now = monotonic()
+
+        with self._lock:
+            self._expire(now)
+
+            if self._table[self._probe(hashed)]:
+                self._duplicates += 1
+                return False
+
+            if self._count == self.maxsize:
+                if self._hashes[self._oldest]:
+                    self._evictions += 1
+                self._pop_oldest()
+
+            newest = (self._oldest + self._count) % self.maxsize
+            self._hashes[newest] = hashed
+            self._times[newest] = now
+            self._count += 1
+            # Popping may have moved entries, so probe again
+            self._table[self._probe(hashed)] = hashed
+            self._size += 1
+            self._added += 1
+            return True
+
+    def discard(self, key):
+        """ Forgets ``key``, so that the next :func:`add` of it returns True """
+
+        hashed = self._hash(key)
+        with self._lock:
+            if self._unindex(hashed):
+                # Discards are rare, and each hash is in the ring once, so a scan is cheap enough
+                self._hashes[self._hashes.index(hashed)] = 0
+
+    def _probe(self, hashed):
+        """ Returns the slot of the table holding ``hashed``, or the empty slot where it would go.
+        Must be called with the lock held. """
+
+        table = self._table
+        mask = len(table) - 1
+        slot = hashed & mask
+        while table[slot] and table[slot] != hashed:
+            slot = (slot + 1) & mask
+        return slot
+
+    def _unindex(self, hashed):
+        """ Removes ``hashed`` from the table, returning whether it was there. Must be called with
+        the lock held. """
+
+        table = self._table
+        mask = len(table) - 1
+        empty = self._probe(hashed)
+        if not table[empty]:
+            return False
+
+        # Move later entries of the run back into the gap, unless that would put them before
+        # their home slot, so that probing never stops early
+        slot = empty
+        while True:
+            slot = (slot + 1) & mask
+            entry = table[slot]
+            if not entry:
+                break
+            home = entry & mask
+            if (empty < slot and (home <= empty or home > slot)) or \
+                    (slot < empty and slot < home <= empty):
+                table[empty] = entry
+                empty = slot
+        table[empty] = 0
+        self._size -= 1
+        return True
+
+    def _pop_oldest(self):
+        """ Removes the oldest key from the ring. Must be called with the lock held. """
+
+        if self._hashes[self._oldest]:
+            self._unindex(self._hashes[self._oldest])
+        self._hashes[self._oldest] = 0
+        self._oldest = (self._oldest + 1) % self.maxsize
+        self._count -= 1
+
+    def _expire(self, now):
+        """ Removes keys older than ``window``. Must be called with the lock held. """
+
+        while self._count and now - self._times[self._oldest] >= self.window:
+            self._pop_oldest()
+
+    def __contains__(self, key):
+        with self._lock:
+            self._expire(monotonic())
+            return bool(self._table[self._probe(self._hash(key))])
+
+    def __len__(self):
+        with self._lock:
+            return self._size
+
+    def stats(self):
+        """ Returns a snapshot of this set's counters as a dict """
+
+        with self._lock:
+            return {
+                "size": self._size,
+                "maxsize": self.maxsize,
+                "added": self._added,
+                "duplicates": self._duplicates,
+                "evictions": self._evictions,
+            }
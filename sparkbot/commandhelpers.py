@@ -2,25 +2,94 @@
 
 from re import match
 from ciscosparkapi import CiscoSparkAPI, Room, Person, SparkApiError
+from .exceptions import ApiError
+from .transport import as_transport
 
-def is_group(api, room):
+def _event_value(event, key):
+    """ Returns ``key`` from the ``data`` of a webhook event, or None if it isn't there
+
+    :param event: The webhook event given to a command as ``event``. May be a ciscosparkapi.Webhook
+                  or the parsed JSON ``dict``.
+    """
+
+    if isinstance(event, dict):
+        return event.get("data", {}).get(key)
+
+    return getattr(getattr(event, "data", None), key, None)
+
+def get_room(api, room_id, cache=None):
+    """ Gets a room by its Spark ID
+
+    :param api: CiscoSparkAPI or :class:`sparkbot.transport.Transport` to query Spark with.
+
+    :param room_id: The ID of the room to get
+
+    :param cache: Optional :class:`sparkbot.cache.TTLCache` to look the room up in before asking
+                  Spark, such as ``bot.room_cache``
+
+    :returns: ciscosparkapi.Room of found room
+    """
+
+    if not room_id or not isinstance(room_id, str):
+        raise TypeError("room_id must be of type str")
+
+    transport = as_transport(api)
+
+    if cache is not None:
+        return cache.get(room_id, transport.get_room)
+
+    return transport.get_room(room_id)
+
+def get_room_type(api, room, event=None, cache=None):
+    """ Gets the type of a room, either ``"group"`` or ``"direct"``
+
+    Every webhook event for a message includes the type of the room that the message was sent in.
+    If ``event`` is given and is about ``room``, its type is used and no request is made.
+    Otherwise, the room is looked up with :func:`get_room`.
+
+    :param api: CiscoSparkAPI or :class:`sparkbot.transport.Transport` to query Spark with.
+
+    :param room: The room to get the type of. May be a CiscoSparkAPI Room or a Spark room ID as a
+                 string.
+
+    :param event: Optional webhook event that the calling command received as ``event``
+
+    :param cache: Optional :class:`sparkbot.cache.TTLCache` to look the room up in before asking
+                  Spark, such as ``bot.room_cache``
+
+    :returns: str, the type of the room
+    """
+
+    if isinstance(room, Room):
+        return room.type
+    elif not isinstance(room, str):
+        raise TypeError("room must be of type str or CiscoSparkAPI.Room")
+
+    if event is not None and _event_value(event, "roomId") == room:
+        room_type = _event_value(event, "roomType")
+        if room_type:
+            return room_type
+
+    return get_room(api, room, cache=cache).type
+
+def is_group(api, room, event=None, cache=None):
     """Determines if the specified room is a group (multiple people) or direct (one-on-one)
 
-    :param api: CiscoSparkAPI instance to query Spark with.
+    :param api: CiscoSparkAPI or :class:`sparkbot.transport.Transport` to query Spark with.
 
     :param room: The room to check the status of. May be a CiscoSparkAPI Room or a
                  Spark room ID as a string.
 
+    :param event: Optional webhook event that the calling command received as ``event``. When it
+                  describes ``room``, no request is made to Spark. See :func:`get_room_type`.
+
+    :param cache: Optional :class:`sparkbot.cache.TTLCache` to look the room up in before asking
+                  Spark, such as ``bot.room_cache``
+
     :returns: True if the room is a group, False if it is not.
     """
-    if isinstance(room, Room):
-        check_room = room
-    elif isinstance(room, str):
-        check_room = api.rooms.get(room)
-    else:
-        raise TypeError("room must be of type str or CiscoSparkAPI.Room")
 
-    return check_room.type == 'group'
+    return get_room_type(api, room, event=event, cache=cache) == 'group'
 
 def mention_person(person):
     """ Creates a "mention" for the specified person.
@@ -36,7 +105,7 @@ def mention_person(person):
 def check_if_in_org(organization, person):
     """ Ensures that the given person is inside the desired organization
 
-    :param api: CiscoSparkAPI instance to query Spark with.
+    :param api: CiscoSparkAPI or :class:`sparkbot.transport.Transport` to query Spark with.
 
     :param organization: The ID of the organization to find this user in
 
@@ -54,13 +123,18 @@ def check_if_in_org(organization, person):
     else:
         return False
 
-def get_person_by_email(api, person_email):
+def get_person_by_email(api, person_email, cache=None):
     """ Gets a person by e-mail
 
-    :param api: CiscoSparkAPI instance to query Spark with.
+    :param api: CiscoSparkAPI or :class:`sparkbot.transport.Transport` to query Spark with.
 
     :param person_email: The e-mail address of the person to search for.
 
+    :param cache: Optional :class:`sparkbot.cache.TTLCache` to look the person up in before asking
+                  Spark, such as ``bot.person_cache``. E-mail lookups are stored under the key
+                  ``"email:"`` followed by the address, and the person found is also stored under
+                  their ID.
+
     :returns: ciscosparkapi.Person of found person
 
     :raises: ValueError if person_email is invalid or does not return exactly one person
@@ -75,49 +149,74 @@ def get_person_by_email(api, person_email):
     elif not match(email_regex, person_email):
         raise ValueError("Incorrect e-mail format")
 
-    people = list(api.people.list(email=person_email))
-    number_of_people = len(people)
+    def load_person(key):
+        people = list(as_transport(api).list_people(person_email))
+        number_of_people = len(people)
+
+        if number_of_people == 1:
+            person = people[0]
+        elif number_of_people > 1:
+            raise ValueError("More than one user found for e-mail")
+        elif number_of_people < 1:
+            raise ValueError("No person found for e-mail")
 
-    if number_of_people == 1:
-        person = people[0]
-    elif number_of_people > 1:
-        raise ValueError("More than one user found for e-mail")
-    elif number_of_people < 1:
-        raise ValueError("No person found for e-mail")
+        return person
+
+    if cache is None:
+        return load_person(person_email)
+
+    person = cache.get("email:" + person_email, load_person)
+    cache.put(person.id, person)
 
     return person
 
-def get_person_by_spark_id(api, person_id):
+def get_person_by_spark_id(api, person_id, cache=None):
     """ Gets a person by their Spark ID
 
-    :param api: CiscoSparkAPI instance to query Spark with.
+    :param api: CiscoSparkAPI or :class:`sparkbot.transport.Transport` to query Spark with.
 
     :param person_id: The person's unique ID from Spark
 
+    :param cache: Optional :class:`sparkbot.cache.TTLCache` to look the person up in before asking
+                  Spark, such as ``bot.person_cache``
+
     :returns: ciscosparkapi.Person of found person
     """
 
-    if person_id and isinstance(person_id, str):
+    def load_person(key):
         # Get this user by ID
         try:
-            person = api.people.get(person_id)
-        except SparkApiError:
+            return as_transport(api).get_person(key)
+        except (SparkApiError, ApiError):
             raise ValueError("No person found for ID")
+
+    if person_id and isinstance(person_id, str):
+        if cache is not None:
+            person = cache.get(person_id, load_person)
+        else:
+            person = load_person(person_id)
     else:
         raise ValueError("No person found for ID")
 
     return person
 
-def check_if_in_team(api, team_id, person):
+def check_if_in_team(api, team_id, person, index=None):
     """ Checks if a person is in a given team
 
-    :param api: CiscoSparkAPI instance to query Spark with.
+    :param api: CiscoSparkAPI or :class:`sparkbot.transport.Transport` to query Spark with.
 
     :param team_id: The ID of the team to check for
 
     :param person: The person to check against the team
+
+    :param index: Optional :class:`sparkbot.membership.MembershipIndex` to check, such as
+                  ``bot.membership_index``. Without it, every membership of the team is fetched.
     """
-    team_memberships = api.team_memberships.list(team_id)
+
+    if index is not None:
+        return index.is_in_team(team_id, person.id)
+
+    team_memberships = as_transport(api).list_team_memberships(team_id)
 
     # Check every membership to see if this person is contained within
     for membership in team_memberships:
@@ -126,6 +225,29 @@ def check_if_in_team(api, team_id, person):
 
     return False
 
+def check_if_in_room(api, room_id, person, index=None):
+    """ Checks if a person is in a given room
+
+    :param api: CiscoSparkAPI or :class:`sparkbot.transport.Transport` to query Spark with.
+
+    :param room_id: The ID of the room to check for
+
+    :param person: The person to check against the room
+
+    :param index: Optional :class:`sparkbot.membership.MembershipIndex` to check, such as
+                  ``bot.membership_index``
+    """
+
+    if index is not None:
+        return index.is_in_room(room_id, person.id)
+
+    # Ask Spark for this person's membership only
+    for membership in as_transport(api).list_memberships(room_id, person_id=person.id):
+        if person.id == membership.personId:
+            return True
+
+    return False
+
 def minargs(numargs, commandline):
     """ Ensures that you have more than [numargs] arguments in [commandline] """
 
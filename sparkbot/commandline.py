@@ -0,0 +1,91 @@
+"""Turns the text of a message into the command line that a command receives"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import shlex
+from html import unescape
+
+# Characters which shlex treats specially in POSIX mode
+_NEEDS_SHLEX = re.compile(r"['\"\\]").search
+
+# shlex only splits on these, unlike str.split, which also splits on other Unicode whitespace
+_TOKENS = re.compile(r"[^ \t\r\n]+").findall
+
+_MENTION = re.compile(r'<spark-mention\b[^>]*\bdata-object-id="([^"]*)"[^>]*>(.*?)</spark-mention>',
+                      re.DOTALL)
+_TAG = re.compile(r"<[^>]*>")
+
+def tokenize(text):
+    """ Splits ``text`` into tokens, giving the same result as ``shlex.split``
+
+    Most messages have no quotes or backslashes, so they are split on whitespace directly, which
+    is many times faster. Only messages which have them are passed to ``shlex``.
+
+    :raises ValueError: ``text`` has a quote that isn't closed, or ends with a backslash
+    """
+
+    if _NEEDS_SHLEX(text) is None:
+        return _TOKENS(text)
+    return shlex.split(text)
+
+def mention_text(html, person_id):
+    """ Returns the text of the first mention of ``person_id`` in a message's ``html``, or None
+
+    Webex Teams marks mentions up as ``<spark-mention data-object-id="...">Name</spark-mention>``.
+    The text is whatever the sender left the mention as, which may be shorter than the person's
+    display name.
+    """
+
+    for object_id, text in _MENTION.findall(html):
+        if object_id == person_id:
+            return unescape(_TAG.sub("", text))
+    return None
+
+def strip_mention(text, me, html=None, mentioned_people=None):
+    """ Removes a mention of the bot from the start of ``text``
+
+    If the bot is in ``mentioned_people``, the mention's text is taken from ``html``. Otherwise,
+    or if the message doesn't start with it, the bot's full display name is removed if the
+    message starts with it.
+
+    :param text: The message's ``text``
+
+    :param me: ciscosparkapi.Person of the bot account
+
+    :param html: The message's ``html``, if it has any
+
+    :param mentioned_people: The message's ``mentionedPeople``, a list of person IDs
+
+    :returns: ``text`` without the mention, or unchanged if it doesn't start with one
+    """
+
+    names = []
+    if html and mentioned_people and me.id in mentioned_people:
+        mention = mention_text(html, me.id)
+        if mention:
+            names.append(mention)
+    if me.displayName:
+        names.append(me.displayName)
+
+    stripped = text.lstrip()
+    for name in names:
+        # The name must be followed by whitespace, so that a command called "Botanist" isn't
+        # taken for a mention of "Bot"
+        rest = stripped[len(name):]
+        if stripped.startswith(name) and (not rest or rest[0] in " \t\r\n"):
+            return rest
+
+    return text
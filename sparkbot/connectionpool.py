@@ -0,0 +1,218 @@
+"""Settings for the HTTP connections that SparkBot makes to Webex Teams"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from threading import BoundedSemaphore, Lock
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from . import tracing
+
+class PooledAdapter(HTTPAdapter):
+    """ A requests transport adapter which applies the settings of a :class:`ConnectionPool`
+
+    requests makes one of these per session by default, sized for 10 connections to each host
+    and with no timeout. This one is sized and timed by the ConnectionPool that created it.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+        super().__init__(pool_connections=pool.max_hosts,
+                         pool_maxsize=pool.max_per_host,
+                         pool_block=pool.block,
+                         max_retries=0)
+
+    def send(self, request, **kwargs):
+        pool = self._pool
+        kwargs["timeout"] = (pool.connect_timeout, pool.read_timeout)
+        if not pool.keep_alive:
+            request.headers["Connection"] = "close"
+
+        # Only the path is recorded, since queries may contain email addresses
+        with tracing.span("webex_api", method=request.method,
+                          path=urlsplit(request.url).path) as span:
+            pool._acquire()
+            try:
+                response = super().send(request, **kwargs)
+            finally:
+                pool._release()
+            span.set("status", response.status_code)
+            return response
+
+class ConnectionPool:
+    """ Holds the connections used for every Webex Teams API request the bot makes
+
+    Pass one to :class:`SparkBot` as ``connection_pool`` to tune it. The bot applies it to its
+    ``spark_api`` with :func:`mount`, so every worker thread, reply and command helper shares the
+    same connections. The ASGI receiver's :class:`sparkbot.asyncapi.AsyncSparkAPI` uses the same
+    limits and timeouts for its own connections.
+
+    :param max_connections: Maximum number of requests in progress at once across every host.
+                            Further requests wait for one to finish. None means no limit other
+                            than ``max_per_host``.
+    :type max_connections: int
+
+    :param max_per_host: Maximum number of connections kept open to each host
+    :type max_per_host: int
+
+    :param max_hosts: Number of hosts to keep connections open to
+    :type max_hosts: int
+
+    :param connect_timeout: Number of seconds to wait for a connection to be established
+    :type connect_timeout: float
+
+    :param read_timeout: Number of seconds to wait for the server between bytes of a response
+    :type read_timeout: float
+
+    :param keep_alive: If False, every connection is closed after one request
+    :type keep_alive: bool
+
+    :param block: If True, a request which finds all ``max_per_host`` connections in use waits for
+                  one to be free. If False, it opens an extra connection which is closed after
+                  use.
+    :type block: bool
+    """
+
+    def __init__(self, max_connections=None, max_per_host=20, max_hosts=4, connect_timeout=10,
+                 read_timeout=60, keep_alive=True, block=True):
+
+        if max_connections is not None and (not isinstance(max_connections, int)
+                                            or max_connections < 1):
+            raise ValueError("max_connections must be a positive int or None")
+
+        if not isinstance(max_per_host, int) or max_per_host < 1:
+            raise ValueError("max_per_host must be a positive int")
+
+        if not isinstance(max_hosts, int) or max_hosts < 1:
+            raise ValueError("max_hosts must be a positive int")
+
+        if connect_timeout <= 0 or read_timeout <= 0:
+            raise ValueError("connect_timeout and read_timeout must be positive")
+
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.max_hosts = max_hosts
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keep_alive = keep_alive
+        self.block = block
+
+        self._adapters = []
+        self._semaphore = BoundedSemaphore(max_connections) if max_connections else None
+        self._lock = Lock()
+        self._in_flight = 0
+        self._max_in_flight = 0
+        self._waited = 0
+
+    def _acquire(self):
+        if self._semaphore is not None and not self._semaphore.acquire(blocking=False):
+            with self._lock:
+                self._waited += 1
+            self._semaphore.acquire()
+
+        with self._lock:
+            self._in_flight += 1
+            self._max_in_flight = max(self._max_in_flight, self._in_flight)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def mount(self, spark_api):
+        """ Makes every request from ``spark_api`` use this pool
+
+        :param spark_api: CiscoSparkAPI instance
+
+        :returns: False if ``spark_api`` does not make its requests with a ``requests.Session``,
+                  such as a mock in a test suite, otherwise True
+        """
+
+        rest_session = getattr(spark_api, "_session", None)
+        session = getattr(rest_session, "_req_session", None)
+        if not isinstance(session, requests.Session):
+            return False
+
+        adapter = PooledAdapter(self)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self._adapters.append(adapter)
+        return True
+
+    def aiohttp_connector(self):
+        """ Returns an ``aiohttp.TCPConnector`` with the same limits as this pool. Each
+        ``aiohttp.ClientSession`` needs its own. """
+
+        import aiohttp
+        return aiohttp.TCPConnector(limit=self.max_connections or 0,
+                                    limit_per_host=self.max_per_host,
+                                    force_close=not self.keep_alive)
+
+    def aiohttp_timeout(self):
+        """ Returns an ``aiohttp.ClientTimeout`` with the same timeouts as this pool """
+
+        import aiohttp
+        return aiohttp.ClientTimeout(sock_connect=self.connect_timeout,
+                                     sock_read=self.read_timeout)
+
+    def close(self):
+        """ Closes every idle connection. Connections are reopened when they are next needed. """
+
+        for adapter in self._adapters:
+            adapter.poolmanager.clear()
+
+    def stats(self):
+        """ Returns a snapshot of how much of this pool is in use as a dict
+
+        ``in_flight`` is the number of requests in progress and ``max_in_flight`` the most there
+        have been at once. ``idle`` is the number of open connections waiting to be reused.
+        ``opened`` counts the connections the pool has created, not counting a connection which
+        is reopened after the server closed it. ``waited`` counts the requests which had to wait
+        for ``max_connections``.
+        """
+
+        hosts = 0
+        idle = 0
+        opened = 0
+        requests_made = 0
+
+        for adapter in self._adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                host_pool = pools.get(key)
+                if host_pool is None:
+                    continue
+                hosts += 1
+                opened += host_pool.num_connections
+                requests_made += host_pool.num_requests
+                if host_pool.pool is not None:
+                    # The queue is padded with None for connections which haven't been opened
+                    idle += sum(1 for connection in list(host_pool.pool.queue)
+                                if connection is not None)
+
+        with self._lock:
+            return {
+                "max_connections": self.max_connections,
+                "max_per_host": self.max_per_host,
+                "hosts": hosts,
+                "in_flight": self._in_flight,
+                "max_in_flight": self._max_in_flight,
+                "idle": idle,
+                "opened": opened,
+                "requests": requests_made,
+                "waited": self._waited,
+            }
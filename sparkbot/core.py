@@ -14,14 +14,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .exceptions import CommandNotFound, SparkBotError, CommandSetupError
+from .exceptions import CommandNotFound, SparkBotError, CommandSetupError, QueueFull
+from .executor import Bulkhead, WorkerPool
+from .eventloop import EventLoopThread
+from .cache import SeenSet, TTLCache
+from .membership import MembershipIndex
+from .output import MAX_MESSAGE_LENGTH, split_markdown, coalesce, coalesce_async
+from .sender import MessageSender
+from .connectionpool import ConnectionPool
+from .metrics import BotMetrics, Gauge
+from .tracing import Tracer, TraceIdFilter
+from . import tracing
+from .transport import Transport, SparkAPITransport
+from .journal import Journal
+from .registry import CommandRegistry
+from .commandline import strip_mention, tokenize
+from .webhooks import RegistrationLease, derive_secret
+from . import webhooks
 from . import receiver
-import shlex
-import textwrap
+import asyncio
 import functools
-from types import FunctionType, GeneratorType
+import hashlib
+from threading import Lock, Thread
+from time import monotonic, sleep
+from types import CoroutineType, FunctionType, GeneratorType
+import types
+import inspect
 from logging import Logger
-from inspect import signature
+from inspect import iscoroutinefunction, signature
 from os import environ
 import falcon
 from ciscosparkapi import CiscoSparkAPI, Webhook, Room
@@ -29,16 +49,20 @@ from ciscosparkapi import CiscoSparkAPI, Webhook, Room
 class SparkBot:
     """ A bot for Cisco Webex Teams
 
-    SparkBot automatically creates a webhook for itself and will delete any other webhooks on its
-    bot account. To do this, it uses the ``root_url`` parameter or ``WEBHOOK_URL`` in the
-    environment to know its public URL.
+    SparkBot automatically creates a webhook for itself, keeping it if it already exists, and will
+    delete any other webhooks on its bot account. To do this, it uses the ``root_url`` parameter or
+    ``WEBHOOK_URL`` in the environment to know its public URL.
 
     SparkBot has a ``help`` command built in by default. These may be overridden using the
     :func:`command` decorator and providing the "help" argument and a function with your desired
     behavior on calling ``help``. See :doc:`Writing Commands </writing-commands>` for more
     information on writing commands.
 
-    :param spark_api: CiscoSparkAPI instance that this bot should use
+    :param spark_api: CiscoSparkAPI instance that this bot should use, or a
+                      :class:`sparkbot.transport.Transport` such as
+                      :class:`sparkbot.transport.InMemoryTransport`. Every request the bot makes
+                      goes through ``bot.transport``. ``bot.spark_api`` is None if the transport
+                      doesn't use a CiscoSparkAPI.
     :type spark_api: ciscosparkapi.CiscoSparkAPI
 
     :param root_url: The base URL for the SparkBot webhook receiver. May also be provided as
@@ -47,14 +71,118 @@ class SparkBot:
 
     :param logger: Logger that the bot will output to
     :type logger: logging.Logger
+
+    :param executor: Worker pool that runs commands as webhooks arrive. Defaults to a
+                     :class:`sparkbot.executor.WorkerPool` with its default size and policy.
+                     Pass a :class:`sparkbot.executor.OrderedWorkerPool` to run the commands
+                     sent in each room one at a time, in the order they were sent.
+    :type executor: sparkbot.executor.WorkerPool
+
+    :param person_cache: Cache for the people who send commands to the bot, keyed by person ID.
+                         Pass this to :mod:`sparkbot.commandhelpers` functions as ``cache`` to share
+                         it. Defaults to a :class:`sparkbot.cache.TTLCache` which keeps people for
+                         5 minutes and serves them for up to an hour longer while they are
+                         refreshed.
+    :type person_cache: sparkbot.cache.TTLCache
+
+    :param room_cache: Cache for rooms, keyed by room ID, for use with
+                       :func:`sparkbot.commandhelpers.get_room` and
+                       :func:`sparkbot.commandhelpers.is_group`. Defaults to a
+                       :class:`sparkbot.cache.TTLCache` which keeps rooms for 5 minutes.
+    :type room_cache: sparkbot.cache.TTLCache
+
+    :param track_memberships: If True, also create a webhook for ``memberships`` events and use
+                              them to keep ``membership_index`` up to date. A
+                              :class:`sparkbot.membership.MembershipIndex` is always available as
+                              ``membership_index``, but without this its rooms are only refreshed
+                              periodically.
+    :type track_memberships: bool
+
+    :param sender: Sends every message the bot replies with, keeping within Webex Teams rate
+                   limits. Defaults to a :class:`sparkbot.sender.MessageSender` with its default
+                   rates.
+    :type sender: sparkbot.sender.MessageSender
+
+    :param connection_pool: Connection limits and timeouts for every request made with
+                            ``spark_api``, which is shared by every thread. Defaults to a
+                            :class:`sparkbot.connectionpool.ConnectionPool` with two connections
+                            for each of the executor's workers. See ``connection_pool.stats()``
+                            for how much of it is in use.
+    :type connection_pool: sparkbot.connectionpool.ConnectionPool
+
+    :param metrics_path: Path on the receiver, such as ``"/metrics"``, which serves
+                         ``metrics`` in the Prometheus text format. Metrics are always recorded
+                         in :attr:`metrics`, but are only served if this is given.
+    :type metrics_path: str
+
+    :param tracer: Records a trace of each webhook, from the receiver through every Webex Teams
+                   API request, the command and each reply. Defaults to a
+                   :class:`sparkbot.tracing.Tracer` which assigns trace IDs for logging without
+                   exporting spans. Pass ``Tracer("traces.jsonl")`` to write them to a file.
+    :type tracer: sparkbot.tracing.Tracer
+
+    :param journal: If given, the receiver records every webhook in it before acknowledging it,
+                    and webhooks whose commands never finished are run again by
+                    :func:`replay_journal` after a restart. Without one, webhooks waiting for a
+                    worker are lost if the process stops.
+    :type journal: sparkbot.journal.Journal
+
+    :param webhook_secret: Secret that Webex Teams signs webhooks with. May also be provided as
+                           ``WEBHOOK_SECRET`` in the environment. Otherwise it is derived from
+                           ``spark_api``'s access token and ``root_url`` with
+                           :func:`sparkbot.webhooks.derive_secret`, so that every process serving
+                           the bot agrees on it, or is random if there is no access token.
+    :type webhook_secret: bytes
+
+    :param registration_lease: Makes sure that only one of the processes serving the bot
+                               registers its webhooks. Defaults to
+                               ``RegistrationLease.for_url(root_url)``, a lock file in the
+                               temporary directory. See
+                               :class:`sparkbot.webhooks.RegistrationLease`.
+    :type registration_lease: sparkbot.webhooks.RegistrationLease
+
+    :param seen_webhooks: The messages the receiver has recently received webhooks for, so that
+                          webhooks which Webex Teams delivers again are dropped. Defaults to a
+                          :class:`sparkbot.cache.SeenSet` which remembers the last 100,000
+                          messages for 10 minutes.
+    :type seen_webhooks: sparkbot.cache.SeenSet
+
+    :param max_body_size: Largest webhook body, in bytes, that the receiver will read. Larger
+                          requests are rejected with ``413 Payload Too Large``. Webex Teams
+                          webhooks are around a kilobyte.
+    :type max_body_size: int
+
+    :param json_decoder: Function which parses a webhook body, given as bytes, into a dict. It
+                         must raise ``ValueError`` for invalid JSON. Defaults to
+                         :func:`sparkbot.receiver.decode_json`, which decodes the body as UTF-8
+                         and parses it with ``json.loads``. A faster decoder which accepts bytes,
+                         such as ``orjson.loads``, may be given instead. Bodies
+                         are only parsed after their signature has been checked.
+    :type json_decoder: function
+
+    :ivar startup_seconds: How long each phase of creating the bot took, as a dict of phase name
+                           to seconds: ``setup``, ``identity`` (fetching the bot account),
+                           ``receiver`` and, if there is a ``root_url``, ``webhooks``.
     """
 
-    def __init__(self, spark_api, root_url=None, logger=None):
+    def __init__(self, spark_api, root_url=None, logger=None, executor=None, person_cache=None,
+                 room_cache=None, track_memberships=False, sender=None, connection_pool=None,
+                 metrics_path=None, tracer=None, journal=None, webhook_secret=None,
+                 registration_lease=None, seen_webhooks=None, max_body_size=65536,
+                 json_decoder=None):
+
+        # Time taken by each phase of startup, reported in self.startup_seconds
+        phase_started = monotonic()
 
-        if isinstance(spark_api, CiscoSparkAPI):
+        if isinstance(spark_api, Transport):
+            self.transport = spark_api
+            self.spark_api = getattr(spark_api, "spark_api", None)
+        elif isinstance(spark_api, CiscoSparkAPI):
             self.spark_api = spark_api
+            self.transport = SparkAPITransport(spark_api)
         else:
-            raise TypeError("spark_api is not of type ciscosparkapi.CiscoSparkAPI")
+            raise TypeError("spark_api is not of type ciscosparkapi.CiscoSparkAPI or "
+                            "sparkbot.transport.Transport")
 
         if isinstance(logger, Logger):
             self._logger = logger
@@ -64,19 +192,120 @@ class SparkBot:
         else:
             self._logger = None
 
-        self.commands = {}
-        self.commands["help"] = Command(self.my_help)
+        if isinstance(tracer, Tracer):
+            self.tracer = tracer
+        elif tracer:
+            raise TypeError("tracer is not of type sparkbot.tracing.Tracer")
+        else:
+            self.tracer = Tracer(logger=self._logger)
+
+        # Lets the bot's log format include %(trace_id)s
+        if self._logger and not any(isinstance(log_filter, TraceIdFilter)
+                                    for log_filter in self._logger.filters):
+            self._logger.addFilter(TraceIdFilter())
+
+        if isinstance(executor, WorkerPool):
+            self.executor = executor
+        elif executor:
+            raise TypeError("executor is not of type sparkbot.executor.WorkerPool")
+        else:
+            self.executor = WorkerPool(logger=self._logger)
+
+        # Runs the API requests that commandworker makes alongside each other.
+        # If it's full, commandworker makes them one after the other instead.
+        self._fetch_pool = WorkerPool(workers=self.executor.workers,
+                                      queue_size=self.executor.workers,
+                                      logger=self._logger)
+
+        if isinstance(connection_pool, ConnectionPool):
+            self.connection_pool = connection_pool
+        elif connection_pool:
+            raise TypeError("connection_pool is not of type sparkbot.connectionpool.ConnectionPool")
+        else:
+            # Enough for every command worker and every fetch running alongside it
+            self.connection_pool = ConnectionPool(max_per_host=2 * self.executor.workers)
+
+        self.connection_pool.mount(self.spark_api)
+
+        if isinstance(journal, Journal):
+            self.journal = journal
+        elif journal:
+            raise TypeError("journal is not of type sparkbot.journal.Journal")
+        else:
+            self.journal = None
+
+        self._replay_lock = Lock()
+        self._replayed = False
+
+        if isinstance(person_cache, TTLCache):
+            self.person_cache = person_cache
+        elif person_cache:
+            raise TypeError("person_cache is not of type sparkbot.cache.TTLCache")
+        else:
+            self.person_cache = TTLCache(maxsize=1024, ttl=300, stale_ttl=3600,
+                                         refresh_pool=self._fetch_pool)
+
+        if isinstance(room_cache, TTLCache):
+            self.room_cache = room_cache
+        elif room_cache:
+            raise TypeError("room_cache is not of type sparkbot.cache.TTLCache")
+        else:
+            self.room_cache = TTLCache(maxsize=1024, ttl=300)
+
+        if isinstance(seen_webhooks, SeenSet):
+            self.seen_webhooks = seen_webhooks
+        elif seen_webhooks:
+            raise TypeError("seen_webhooks is not of type sparkbot.cache.SeenSet")
+        else:
+            self.seen_webhooks = SeenSet()
+
+        if not isinstance(track_memberships, bool):
+            raise TypeError("track_memberships is not of type bool")
+
+        self.membership_index = MembershipIndex(self.transport)
+
+        if isinstance(sender, MessageSender):
+            self.sender = sender
+        elif sender:
+            raise TypeError("sender is not of type sparkbot.sender.MessageSender")
+        elif self.transport.rate_limited:
+            self.sender = MessageSender(self.transport, logger=self._logger)
+        else:
+            self.sender = MessageSender(self.transport, rate=None, room_rate=None,
+                                        logger=self._logger)
+
+        if metrics_path and not (isinstance(metrics_path, str) and metrics_path.startswith("/")):
+            raise TypeError("metrics_path is not a str starting with /")
+
+        self.metrics_path = metrics_path
+        self.metrics = BotMetrics()
+        self.metrics.register(Gauge("sparkbot_executor_queue_depth",
+                                    "Webhooks waiting for a worker.",
+                                    lambda: self.executor.queue_depth))
+        self.metrics.register(Gauge("sparkbot_sender_waiting",
+                                    "Messages waiting to be sent.",
+                                    lambda: self.sender.stats()["waiting"]))
+        self.metrics.register(Gauge("sparkbot_connections_in_flight",
+                                    "Webex Teams API requests in progress.",
+                                    lambda: self.connection_pool.stats()["in_flight"]))
+
+        # Runs async def commands. See sparkbot.eventloop.
+        self.event_loop = EventLoopThread()
+
+        # Commands by name, along with the help built from them. See sparkbot.registry.
+        self.commands = CommandRegistry()
+        self.commands.add("help", Command(self.my_help))
         self.fallback_command = None
 
         # Message sent to user when they request a command that doesn't exist.
         self.command_not_found_message = "Command not found. Maybe try 'help'?"
 
-        # Cache "me" to speed up commands requiring it
-        self.me = self.spark_api.people.me()
+        self.startup_seconds = {}
+        phase_started = self._end_startup_phase("setup", phase_started)
 
-        # The output of the "help all" command should only need to be determined once.
-        # See self.my_help_all to learn more.
-        self._help_all_string = ""
+        # Cache "me" to speed up commands requiring it. The receiver uses it too.
+        self.me = self.transport.me()
+        phase_started = self._end_startup_phase("identity", phase_started)
 
         if not root_url:
             try:
@@ -89,9 +318,44 @@ class SparkBot:
         elif not isinstance(root_url, str):
             raise TypeError("root_url is not of type str")
 
+        # Created on first use by the ASGI receiver. See self.async_api.
+        self._async_api = None
+
+        if not webhook_secret:
+            webhook_secret = environ.get("WEBHOOK_SECRET")
+        if isinstance(webhook_secret, str):
+            webhook_secret = webhook_secret.encode("utf-8")
+        elif webhook_secret and not isinstance(webhook_secret, bytes):
+            raise TypeError("webhook_secret is not of type bytes or str")
+
+        if webhook_secret:
+            self.webhook_secret = webhook_secret
+        elif root_url and isinstance(getattr(self.spark_api, "access_token", None), str):
+            self.webhook_secret = derive_secret(self.spark_api.access_token, root_url)
+        else:
+            self.webhook_secret = receiver.random_bytes(32)
+
+        if isinstance(registration_lease, RegistrationLease):
+            self.registration_lease = registration_lease
+        elif registration_lease:
+            raise TypeError("registration_lease is not of type sparkbot.webhooks.RegistrationLease")
+        elif root_url:
+            self.registration_lease = RegistrationLease.for_url(root_url)
+        else:
+            self.registration_lease = None
+
+        if not isinstance(max_body_size, int) or max_body_size < 1:
+            raise TypeError("max_body_size is not a positive int")
+
+        if json_decoder and not callable(json_decoder):
+            raise TypeError("json_decoder is not callable")
+
+        self.max_body_size = max_body_size
+        self.json_decoder = json_decoder or receiver.decode_json
+
         # Create my receiver
-        self.webhook_secret = receiver.random_bytes(32)
         self.receiver = receiver.create(self)
+        phase_started = self._end_startup_phase("receiver", phase_started)
 
         # Create my webhook
         if root_url:
@@ -102,15 +366,45 @@ class SparkBot:
                                        "recommended. Please use an HTTPS webhook to better secure "
                                        "your users' data."))
 
-            for webhook in self.spark_api.webhooks.list():
-                self.spark_api.webhooks.delete(webhook.id)
-            self.spark_api.webhooks.create("myBot",
-                                           root_url + "/sparkbot",
-                                           "messages",
-                                           "created",
-                                           secret=self.webhook_secret.decode())
-
-    def command(self, command_strings=[], fallback=False):
+            # Another process serving this bot may have registered the same webhooks already
+            registration = hashlib.sha256(b"\n".join([
+                root_url.encode("utf-8"), self.webhook_secret,
+                str(track_memberships).encode("utf-8")])).hexdigest()
+            registered = self.registration_lease.run_once(
+                registration, functools.partial(self._register_webhooks, root_url,
+                                                track_memberships))
+            if not registered and self._logger:
+                self._logger.info("Webhooks were registered by another process")
+            self._end_startup_phase("webhooks", phase_started)
+
+        if self._logger:
+            self._logger.info("SparkBot started in {:.3f}s ({})".format(
+                sum(self.startup_seconds.values()),
+                ", ".join("{} {:.3f}s".format(phase, seconds)
+                          for phase, seconds in self.startup_seconds.items())))
+
+    def _end_startup_phase(self, phase, started):
+        """Records the time since ``started`` as startup ``phase`` and returns the current time"""
+
+        now = monotonic()
+        self.startup_seconds[phase] = now - started
+        return now
+
+    def _register_webhooks(self, root_url, track_memberships):
+        """Makes the bot account's webhooks match the ones this bot needs"""
+
+        desired = [("myBot", root_url + "/sparkbot", "messages", "created")]
+        if track_memberships:
+            desired.append(("myBot memberships", root_url + "/sparkbot", "memberships", "all"))
+
+        changes = webhooks.reconcile(self.transport, desired, self.webhook_secret)
+        if self._logger:
+            self._logger.info("Webhooks: {kept} kept, {created} created, {deleted} deleted".format(
+                **changes))
+
+    def command(self, command_strings=[], fallback=False, coalesce_window=None,
+                coalesce_size=MAX_MESSAGE_LENGTH, cache_ttl=None, cache_key=("commandline",),
+                cache_size=256, timeout=None, max_concurrency=None, queue_timeout=0):
         """ Decorator that adds a command to this bot.
 
         :param command_strings: Callable name(s) of command. When a bot user types this (these),
@@ -126,6 +420,47 @@ class SparkBot:
                          exist.
         :type fallback: bool
 
+        :param coalesce_window: None by default, not required. If given, replies that the command
+                                yields within this many seconds of each other are merged into one
+                                message. See :func:`sparkbot.output.coalesce`.
+        :type coalesce_window: float
+
+        :param coalesce_size: Largest message, in bytes, that ``coalesce_window`` will merge replies
+                              into. Defaults to the largest message Webex Teams accepts.
+        :type coalesce_size: int
+
+        :param cache_ttl: None by default, not required. If given, the command's reply is cached
+                          for this many seconds and sent again to anyone who calls it with the
+                          same ``cache_key``, without running the function. Concurrent calls
+                          with the same key run the function once. Exceptions aren't cached. A
+                          command which yields is run to completion and its replies are cached as
+                          a list. Commands which take ``callback`` can't be cached.
+        :type cache_ttl: float
+
+        :param cache_key: Which of the command's inputs a cached reply depends on: any of
+                          ``"commandline"`` (every token, including the command's name),
+                          ``"room_id"`` and ``"caller"`` (the caller's ID). Defaults to the
+                          commandline only, so everyone shares cached replies.
+        :type cache_key: tuple
+
+        :param cache_size: Maximum number of replies to cache for this command
+        :type cache_size: int
+
+        :param timeout: None by default, not required. If given, the user is told the command took
+                        too long when it runs for more than this many seconds, and the worker moves
+                        on. For a command which yields, this covers all of its replies.
+        :type timeout: float
+
+        :param max_concurrency: None by default, not required. If given, at most this many calls
+                                of the command run at once. Calls of a command which hangs keep
+                                running after they time out, and count towards this.
+        :type max_concurrency: int
+
+        :param queue_timeout: Number of seconds a call waits for another to finish when
+                              ``max_concurrency`` calls are running. After that, the user is told
+                              the command is busy. Defaults to telling them straight away.
+        :type queue_timeout: float
+
         :raises CommandSetupError: Arguments or combination of arguments was incorrect.
                                    The error description will have more details.
 
@@ -149,7 +484,31 @@ class SparkBot:
             if not isinstance(fallback, bool):
                 raise TypeError("fallback not a boolean in call to SparkBot.command. Do you have too many arguments in your decorator?")
 
-            new_command = Command(function)
+            if coalesce_window is not None and not isinstance(coalesce_window, (int, float)):
+                raise TypeError("coalesce_window is not a number of seconds.")
+
+            if cache_ttl is not None and not isinstance(cache_ttl, (int, float)):
+                raise TypeError("cache_ttl is not a number of seconds.")
+
+            if timeout is not None and not isinstance(timeout, (int, float)):
+                raise TypeError("timeout is not a number of seconds.")
+
+            if max_concurrency is not None and not isinstance(max_concurrency, int):
+                raise TypeError("max_concurrency is not an int.")
+
+            if not isinstance(queue_timeout, (int, float)):
+                raise TypeError("queue_timeout is not a number of seconds.")
+
+            cache = TTLCache(maxsize=cache_size, ttl=cache_ttl) if cache_ttl else None
+
+            limits = None
+            if timeout is not None or max_concurrency is not None:
+                limits = Bulkhead(timeout=timeout, max_concurrency=max_concurrency,
+                                  queue_timeout=queue_timeout)
+
+            new_command = Command(function, coalesce_window=coalesce_window,
+                                  coalesce_size=coalesce_size, cache=cache, cache_key=cache_key,
+                                  limits=limits, event_loop=self.event_loop)
 
             if self.fallback_command:
                 # There is already a fallback command
@@ -163,26 +522,292 @@ class SparkBot:
                     if not isinstance(command, str):
                         raise TypeError("non-str object found in command_strings.")
 
-                    self.commands[command] = new_command
+                    self.commands.add(command, new_command)
 
             return function
 
         return decorator
 
     def commandworker(self, json_data):
-        """Called by the bottle app when a command comes in. Glues together the behavior of SparkBot.
+        """Called by the receiver when a command comes in. Glues together the behavior of SparkBot.
 
         :param json_data: The blob of json that Spark POSTs to the webhook parsed into a dictionary
         """
 
+        with self._trace("commandworker", json_data):
+            self._commandworker(json_data)
+
+    def journaled_commandworker(self, entry_id, json_data):
+        """Runs :func:`commandworker` for a webhook recorded in :attr:`journal`, then marks its
+        entry as done. The entry is marked even if the command fails, so that a webhook which
+        always fails isn't run again on every restart.
+
+        :param entry_id: ID returned by :func:`sparkbot.journal.Journal.append`
+
+        :param json_data: The blob of json that Spark POSTs to the webhook parsed into a dictionary
+        """
+
+        try:
+            self.commandworker(json_data)
+        finally:
+            self.journal.complete(entry_id)
+
+    def submit_journaled(self, entry_id, json_data):
+        """Submits :func:`journaled_commandworker` to :attr:`executor`, keyed by room ID.
+
+        If the executor drops it to make room, the entry is marked as done. The webhook was
+        already acknowledged, so Webex Teams won't send it again, and dropping it was deliberate,
+        so it isn't replayed either.
+
+        :raises QueueFull: The executor's queue is full. The entry is left unfinished.
+        """
+
+        future = self.executor.submit_ordered(json_data["data"]["roomId"],
+                                              self.journaled_commandworker, entry_id, json_data)
+        future.add_done_callback(
+            lambda future: self.journal.complete(entry_id) if future.cancelled() else None)
+        return future
+
+    def replay_journal(self):
+        """Runs the commands for webhooks in :attr:`journal` which were acknowledged but never
+        finished, for example because the process was restarted while they were queued.
+
+        The receiver calls this when it gets its first webhook. Call it yourself once every
+        command has been added to replay them straight away. Only the first call does anything.
+
+        :returns: The number of webhooks being replayed
+        """
+
+        with self._replay_lock:
+            if self._replayed or not self.journal:
+                return 0
+            self._replayed = True
+
+        entries = self.journal.unfinished()
+        if entries:
+            if self._logger:
+                self._logger.info("Replaying {} unfinished webhooks from the journal".format(
+                    len(entries)))
+            # Entries are submitted from their own thread so that a long backlog waits for room
+            # in the executor without holding up the caller
+            replayer = Thread(target=self._replay, args=(entries,), name="sparkbot-replay")
+            replayer.daemon = True
+            replayer.start()
+
+        return len(entries)
+
+    def _replay(self, entries):
+        for entry_id, json_data in entries:
+            while True:
+                try:
+                    self.submit_journaled(entry_id, json_data)
+                    break
+                except QueueFull:
+                    sleep(self.executor.retry_after)
+
+    def _commandworker(self, json_data):
+        stage_seconds = self.metrics.worker_seconds
+        started = monotonic()
         webhook_obj = Webhook(json_data)
         room_id = json_data["data"]["roomId"]
-        message = self.spark_api.messages.get(webhook_obj.data.id)
-        person = self.spark_api.people.get(message.personId)
+
+        # The webhook tells us who sent the message, so we don't need to wait for the message to
+        # fetch them. Do both at once unless we already know the person.
+        person_future = None
+        person_id = json_data["data"].get("personId")
+        if person_id and person_id not in self.person_cache:
+            try:
+                person_future = self._fetch_pool.submit(self.person_cache.get, person_id,
+                                                        self.transport.get_person)
+            except QueueFull:
+                pass
+
+        message = self.transport.get_message(webhook_obj.data.id)
+
+        if person_future:
+            person = person_future.result()
+        else:
+            person = self.person_cache.get(message.personId, self.transport.get_person)
+
+        started = stage_seconds.observe_since(started, "fetch")
+        commandline, error_response = self._parsecommandline(message, person)
+        if error_response:
+            self.respond(room_id, error_response)
+            return
+
+        userfunc_torun = str.lower(commandline[0])
+        command_to_run = None
+        started = stage_seconds.observe_since(started, "parse")
+
+        # Catch generic Exception so that we always reply to the user.
+        try:
+            command_to_run = self._getcommand(userfunc_torun)
+            with tracing.span("command", command=userfunc_torun):
+                finalresponse = self._executeuserfunction(command_to_run, commandline,
+                                                          webhook_obj, person, room_id)
+        except Exception as error:
+            self._count_error(error, userfunc_torun, command_to_run)
+            finalresponse = self._errorresponse(error, person, message)
+
+        started = stage_seconds.observe_since(started, "command")
+
+        # finalresponse will be a Generator if the executed function contains the yield keyword.
+        if isinstance(finalresponse, str):
+            self.respond(room_id, finalresponse)
+        elif isinstance(finalresponse, GeneratorType):
+            # The command runs as it is iterated, so it can still fail or time out here
+            try:
+                if command_to_run.coalesce_window:
+                    coalesce(finalresponse, functools.partial(self.respond, room_id),
+                             command_to_run.coalesce_window, command_to_run.coalesce_size)
+                else:
+                    for response in finalresponse:
+                        self.respond(room_id, response)
+            except Exception as error:
+                self._count_error(error, userfunc_torun, command_to_run)
+                self.respond(room_id, self._errorresponse(error, person, message))
+
+        stage_seconds.observe_since(started, "respond")
+
+    def _trace(self, name, json_data):
+        """Returns a span for handling ``json_data``. It is part of the webhook's trace if the
+        receiver started one, otherwise it starts a new trace."""
+
+        message_id = json_data.get("data", {}).get("id")
+        if tracing.current_span() is None:
+            return self.tracer.trace(name, message_id=message_id)
+        return tracing.span(name, message_id=message_id)
+
+    def _count_error(self, error, name, command):
+        """Counts an exception raised while finding or running the command called ``name``"""
+
+        if isinstance(error, CommandNotFound):
+            self.metrics.not_found.inc()
+        elif command is None or command is self.fallback_command:
+            # Label with names the bot knows about, not whatever the user typed
+            self.metrics.command_errors.inc("fallback")
+        else:
+            self.metrics.command_errors.inc(name)
+
+    async def async_commandworker(self, json_data):
+        """The asyncio counterpart of :func:`commandworker`, called by the ASGI receiver.
+
+        Webex Teams API calls are made with :attr:`async_api` so that they do not hold a thread
+        while waiting. ``async def`` commands are awaited on :attr:`event_loop`. Other commands
+        are regular functions, so they are run in the event loop's default executor to keep them
+        from blocking other conversations.
+
+        :param json_data: The blob of json that Spark POSTs to the webhook parsed into a dictionary
+        """
+
+        with self._trace("commandworker", json_data):
+            await self._async_commandworker(json_data)
+
+    async def journaled_async_commandworker(self, entry_id, json_data):
+        """The asyncio counterpart of :func:`journaled_commandworker`"""
+
+        try:
+            await self.async_commandworker(json_data)
+        finally:
+            self.journal.complete(entry_id)
+
+    async def _async_commandworker(self, json_data):
+        loop = asyncio.get_event_loop()
+        stage_seconds = self.metrics.worker_seconds
+        started = monotonic()
+        webhook_obj = Webhook(json_data)
+        room_id = json_data["data"]["roomId"]
+        # The webhook tells us who sent the message, so fetch them alongside the message unless
+        # we already know them.
+        person_id = json_data["data"].get("personId")
+        person = self.person_cache.peek(person_id) if person_id else None
+
+        if person is not None:
+            message = await self.async_api.get_message(webhook_obj.data.id)
+        elif person_id:
+            message, person = await asyncio.gather(
+                self.async_api.get_message(webhook_obj.data.id),
+                self.async_api.get_person(person_id))
+            self.person_cache.put(person_id, person)
+        else:
+            message = await self.async_api.get_message(webhook_obj.data.id)
+            person = await self.async_api.get_person(message.personId)
+            self.person_cache.put(message.personId, person)
+
+        started = stage_seconds.observe_since(started, "fetch")
+        commandline, error_response = self._parsecommandline(message, person)
+        if error_response:
+            await self.async_respond(room_id, error_response)
+            return
+
+        userfunc_torun = str.lower(commandline[0])
+        command_to_run = None
+        started = stage_seconds.observe_since(started, "parse")
+
+        try:
+            command_to_run = self._getcommand(userfunc_torun)
+            with tracing.span("command", command=userfunc_torun):
+                if command_to_run.awaitable:
+                    finalresponse = await command_to_run.execute_async(
+                        commandline=commandline, callback=self.respond, event=webhook_obj,
+                        caller=person, room_id=room_id)
+                else:
+                    finalresponse = await loop.run_in_executor(
+                        None,
+                        tracing.bind(functools.partial(self._executeuserfunction, command_to_run,
+                                                       commandline, webhook_obj, person,
+                                                       room_id)))
+        except Exception as error:
+            self._count_error(error, userfunc_torun, command_to_run)
+            finalresponse = self._errorresponse(error, person, message)
+
+        started = stage_seconds.observe_since(started, "command")
+
+        if isinstance(finalresponse, str):
+            await self.async_respond(room_id, finalresponse)
+        elif isinstance(finalresponse, GeneratorType):
+            try:
+                await self._async_respond_all(loop, room_id, finalresponse, command_to_run)
+            except Exception as error:
+                self._count_error(error, userfunc_torun, command_to_run)
+                await self.async_respond(room_id, self._errorresponse(error, person, message))
+
+        stage_seconds.observe_since(started, "respond")
+
+    async def _async_respond_all(self, loop, room_id, replies, command):
+        """Sends each reply that the generator ``replies`` yields, as the command runs"""
+
+        if command.coalesce_window:
+            await coalesce_async(replies, functools.partial(self.async_respond, room_id),
+                                 command.coalesce_window, command.coalesce_size)
+            return
+
+        # Each step of the generator may block, so it is also run in the executor
+        finished = object()
+        while True:
+            response = await loop.run_in_executor(None, tracing.bind(next), replies, finished)
+            if response is finished:
+                break
+            await self.async_respond(room_id, response)
+
+    def _parsecommandline(self, message, person):
+        """Splits the text of ``message`` into a list of tokens for a command to use.
+
+        :param message: The ciscosparkapi.Message sent by the bot user
+
+        :param person: The ciscosparkapi.Person who sent ``message``
+
+        :returns: tuple of (commandline, error_response). If the message could not be parsed,
+                  commandline is None and error_response is the reply to send the user.
+        """
+
+        # Remove my name from the beginning of the message if it's there
+        text = strip_mention(message.text or "", self.me, html=message.html,
+                             mentioned_people=message.mentionedPeople)
 
         # Catch any errors in the shlex string
         try:
-            commandline = shlex.split(message.text)
+            commandline = tokenize(text)
         except ValueError as error:
             # Something is incorrect in the user's command string
             if isinstance(self._logger, Logger):
@@ -190,43 +815,32 @@ class SparkBot:
                                                 'with the message:', message.text]))
             errordescription = ' '.join(["⚠️Error: Please check the format of your command.",
                                          error.args[0]])
-            self.respond(room_id, errordescription)
-            return
+            return None, errordescription
 
-        # Remove my name from the beginning of the message if it's there
-        my_name = self.me.displayName
-        if commandline[0] == my_name:
-            del commandline[0]
+        if not commandline:
+            # The message only mentioned me
+            return None, self.command_not_found_message
 
-        userfunc_torun = str.lower(commandline[0])
+        return commandline, None
 
-        # Catch generic Exception so that we always reply to the user.
-        try:
-            usercommandresponse = self._executeuserfunction(userfunc_torun, commandline,
-                                                            webhook_obj, person, room_id)
-        except Exception as error:
+    def _errorresponse(self, error, person, message):
+        """Logs an exception raised while running a command and returns the reply for the user.
 
-            # Build our logging string
-            if isinstance(self._logger, Logger):
-                self._logger.exception(' '.join([person.emails[0], 'caused:', type(error).__name__,
-                                                error.args[0], 'with the command:', message.text]))
-            try:
-                errordescription = error.args[1]
-            except IndexError:
-                errordescription = ("Something happened internally. "
-                                    "For more information, contact the bot author.")
-            # Make response
-            finalresponse = " ".join(["⚠️ Error:", errordescription])
+        If the exception has a second argument, it is shown to the user. Otherwise, they get a
+        generic error message.
+        """
 
-        else:
-            finalresponse = usercommandresponse
+        # Build our logging string
+        if isinstance(self._logger, Logger):
+            self._logger.exception(' '.join([person.emails[0], 'caused:', type(error).__name__,
+                                            error.args[0], 'with the command:', message.text]))
+        try:
+            errordescription = error.args[1]
+        except IndexError:
+            errordescription = ("Something happened internally. "
+                                "For more information, contact the bot author.")
 
-        # finalresponse will be a Generator if the executed function contains the yield keyword.
-        if isinstance(finalresponse, str):
-            self.respond(room_id, finalresponse)
-        elif isinstance(finalresponse, GeneratorType):
-            for response in finalresponse:
-                self.respond(room_id, response)
+        return " ".join(["⚠️ Error:", errordescription])
 
     def remove_help(self):
         """Removes the help command from the bot
@@ -235,13 +849,14 @@ class SparkBot:
         """
 
         self.command_not_found_message = "Command not found."
-        self.commands.pop("help", None)
+        self.commands.remove("help")
 
     def _executeuserfunction(self, func, commandline, event_json_dict, caller, room_id):
         """Runs the bot user's specified command (found in func) if it exists.
 
         :param func: The 'command' that the user wants to run. Should match a command string
-                     that has previously been added to the bot.
+                     that has previously been added to the bot, or be a :class:`Command` that
+                     was already found with :func:`_getcommand`.
 
         :param commandline: The user's complete message to the bot parsed into a list of tokens
                             by ``shlex.split()``.
@@ -255,15 +870,10 @@ class SparkBot:
         :param room_id: The ID of the room that the message we're processing was sent in.
         """
 
-        command_to_run = None
-
-        # Try to find command in the commands dictionary
-        if func in self.commands:
-            command_to_run = self.commands[func]
-        elif self.fallback_command:
-            command_to_run = self.fallback_command
+        if isinstance(func, Command):
+            command_to_run = func
         else:
-            raise CommandNotFound('No command found', self.command_not_found_message)
+            command_to_run = self._getcommand(func)
 
         # To add a new argument for commands to use, have them sent into this function by
         # commandworker. Then, add them here and to the signature of Command.execute()
@@ -273,9 +883,38 @@ class SparkBot:
                                       caller=caller,
                                       room_id=room_id)
 
+    def _getcommand(self, func):
+        """Returns the Command registered under the name ``func``, or the fallback command.
+
+        :raises CommandNotFound: There is no such command and no fallback command.
+        """
+
+        command = self.commands.get(func)
+        if command is not None:
+            return command
+        elif self.fallback_command:
+            return self.fallback_command
+        else:
+            raise CommandNotFound('No command found', self.command_not_found_message)
+
+    def command_stats(self):
+        """Returns :func:`Command.stats` for each command added with a ``timeout`` or
+        ``max_concurrency``, as a dict keyed by command name. The fallback command is under None.
+        """
+
+        stats = {name: command.stats() for name, command in self.commands.snapshot.items()
+                 if command.limits is not None}
+        if self.fallback_command and self.fallback_command.limits is not None:
+            stats[None] = self.fallback_command.stats()
+        return stats
+
     def respond(self, spark_room, markdown):
         """Sends a message to a Spark room.
 
+        Messages larger than Webex Teams allows are split into several messages. See
+        :func:`sparkbot.output.split_markdown`. Messages are sent through :attr:`sender`, so this
+        may wait to avoid being rate limited.
+
         :param markdown: Markdown formatted string to send
 
         :param spark_room: The room that we should send this response to,
@@ -286,9 +925,37 @@ class SparkBot:
             raise ValueError("response must be a non-blank string.")
 
         if isinstance(spark_room, Room):
-            self.spark_api.messages.create(spark_room.id, markdown=markdown)
+            spark_room = spark_room.id
+
         if isinstance(spark_room, str):
-            self.spark_api.messages.create(spark_room, markdown=markdown)
+            for chunk in split_markdown(markdown):
+                self.sender.send(spark_room, chunk)
+
+    async def async_respond(self, spark_room, markdown):
+        """The asyncio counterpart of :func:`respond`. Sends a message to a Spark room.
+
+        :param markdown: Markdown formatted string to send
+
+        :param spark_room: The room that we should send this response to,
+            either CiscoSparkAPI.Room or str containing the room ID
+        """
+        if not markdown or not isinstance(markdown, str):
+            raise ValueError("response must be a non-blank string.")
+
+        if isinstance(spark_room, Room):
+            spark_room = spark_room.id
+
+        for chunk in split_markdown(markdown):
+            await self.sender.send_async(spark_room, chunk, self.async_api.create_message)
+
+    @property
+    def async_api(self):
+        """:class:`sparkbot.asyncapi.AsyncSparkAPI` used by the ASGI receiver. It is created by
+        the bot's ``transport`` the first time it is needed."""
+
+        if self._async_api is None:
+            self._async_api = self.transport.async_api(pool=self.connection_pool)
+        return self._async_api
 
     def my_help(self, commandline):
         """
@@ -309,66 +976,118 @@ class SparkBot:
             return self.my_help_all()
 
         try:
-            help_text_raw = self.commands[command_to_help].function.__doc__
-            help_text = textwrap.dedent(help_text_raw)
+            help_text = self.commands.help_text(command_to_help)
         except KeyError:
             # The requested command doesn't exist
-            help_text = "I don't have a command with the name \"{}\".".format(command_to_help)
-        except TypeError:
+            return "I don't have a command with the name \"{}\".".format(command_to_help)
+
+        if help_text is None:
             # The requested command doesn't have a docstring
-            help_text = "There is no help available for `{}`.".format(command_to_help)
+            return "There is no help available for `{}`.".format(command_to_help)
 
         return help_text
 
     def my_help_all(self):
-        """Returns a formatted list of all commands for this bot"""
+        """Returns a formatted list of all commands for this bot
 
-        # Create a formatted string containing all of our commands
-        # One command can have multiple names and therefore takes up multiple slots in the
-        # self.commands dict. However, for this help, we want multiple names for one command
-        # to be grouped together. In this process, we'll look at every command added to this bot
-        # and group together ones which are the same.
-        # We can't add or remove commands after the bot starts, so we can create this string once
-        if not self._help_all_string:
-            temp_command_list = []
-            used_command_string_list = []
-
-            # Iterate over all of our commands to obtain a list where multiple
-            # names for one command are in the same entry.
-            for command_string, command_object in self.commands.items():
+        Each command is listed once with all of its names. :attr:`commands` keeps the list up to
+        date as commands are added and removed, so this costs nothing.
+        """
 
-                if command_string in used_command_string_list:
-                    continue
+        return self.commands.help_all()
 
-                used_command_string_list.append(command_string)
-                current_command_strings = [command_string]
+# Async generators only exist from Python 3.6. An empty tuple never matches in isinstance().
+_AsyncGeneratorType = getattr(types, "AsyncGeneratorType", ())
+_isasyncgenfunction = getattr(inspect, "isasyncgenfunction", lambda function: False)
 
-                # Iterate over the commands *again* and put any names for commands that
-                # match the one we're currently checking into current_command_strings
-                for inner_command_string, inner_command_object in self.commands.items():
-                    if inner_command_object == command_object and command_string != inner_command_string:
-                        used_command_string_list.append(inner_command_string)
-                        current_command_strings.append(inner_command_string)
+class Command:
+    """ Represents a command that can be executed by a SparkBot
 
-                temp_command_list.append(", ".join(sorted(current_command_strings)))
+    :param function: The function that this command will execute. Must return a str or yield
+                     them. It may be an ``async def`` function or async generator, which can't
+                     take ``callback``.
 
-            sorted_commands = sorted(temp_command_list)
+    :param coalesce_window: If given, replies that the function yields within this many seconds
+                            of each other are sent as one message
 
-            output = ("Type `help [command]` for more specific help about any of these commands:\n - "
-                    + "\n - ".join(sorted_commands))
+    :param coalesce_size: Largest message, in bytes, that replies will be merged into
 
-            self._help_all_string = output
+    :param cache: If given, the function's replies are cached in it. See ``cache_ttl`` in
+                  :func:`SparkBot.command`.
+    :type cache: sparkbot.cache.TTLCache
 
-        return self._help_all_string
+    :param cache_key: Names of the inputs that cached replies are keyed by, from
+                      ``CACHE_KEY_PARAMETERS``
 
-class Command:
-    """ Represents a command that can be executed by a SparkBot
+    :param limits: If given, the function is run within its timeout and concurrency limit. See
+                   ``timeout`` and ``max_concurrency`` in :func:`SparkBot.command`.
+    :type limits: sparkbot.executor.Bulkhead
 
-    :param function: The function that this command will execute. Must return a str.
+    :param event_loop: Loop that the function runs on if it is ``async def``. SparkBot shares one
+                       between all of its commands. If not given, the command gets its own.
+    :type event_loop: sparkbot.eventloop.EventLoopThread
     """
 
-    def __init__(self, function):
+    # Names of the parameters that execute() can pass to a command's function
+    INJECTABLE_PARAMETERS = ("commandline", "event", "caller", "callback", "room_id")
+
+    # Names of the parameters that cached replies can be keyed by
+    CACHE_KEY_PARAMETERS = ("commandline", "caller", "room_id")
+
+    def __init__(self, function, coalesce_window=None, coalesce_size=MAX_MESSAGE_LENGTH,
+                 cache=None, cache_key=("commandline",), limits=None, event_loop=None):
         self.function = function
+        self.coalesce_window = coalesce_window
+        self.coalesce_size = coalesce_size
+
+        if cache is not None:
+            if not isinstance(cache, TTLCache):
+                raise TypeError("cache is not of type sparkbot.cache.TTLCache")
+            if "callback" in self._parameters:
+                raise CommandSetupError("Commands which take callback can't be cached, since "
+                                        "their replies aren't all returned.")
+            if isinstance(cache_key, str) or not all(
+                    parameter in self.CACHE_KEY_PARAMETERS for parameter in cache_key):
+                raise CommandSetupError("cache_key must be a tuple of names from {}".format(
+                    ", ".join(self.CACHE_KEY_PARAMETERS)))
+
+        if "callback" in self._parameters and (self._is_coroutine
+                                               or _isasyncgenfunction(self._function)):
+            raise CommandSetupError("Async commands can't take callback, since it would block "
+                                    "the event loop that every async command shares. Yield "
+                                    "replies instead.")
+
+        if limits is not None and not isinstance(limits, Bulkhead):
+            raise TypeError("limits is not of type sparkbot.executor.Bulkhead")
+
+        if event_loop is not None and not isinstance(event_loop, EventLoopThread):
+            raise TypeError("event_loop is not of type sparkbot.eventloop.EventLoopThread")
+
+        self.cache = cache
+        self.cache_key = tuple(cache_key)
+        self.limits = limits
+        # The loop only starts when an async function first runs, so this costs nothing otherwise
+        self.event_loop = event_loop or EventLoopThread()
+
+    @property
+    def function(self):
+        """The function that this command will execute"""
+        return self._function
+
+    @function.setter
+    def function(self, function):
+        # Work out which parameters the function takes once, rather than on every execute()
+        function_parameters = signature(function).parameters
+        self._parameters = tuple(parameter for parameter in self.INJECTABLE_PARAMETERS
+                                 if parameter in function_parameters)
+        self._is_coroutine = iscoroutinefunction(function)
+        self._function = function
+
+    @property
+    def awaitable(self):
+        """True if :func:`execute_async` can await the function without holding a thread, which
+        is when it is ``async def`` and has no cache or limits"""
+        return self._is_coroutine and self.cache is None and self.limits is None
 
     @classmethod
     def create_callback(self, respond, room_id):
@@ -414,16 +1133,102 @@ class Command:
 
         """
 
-        possible_parameters = locals()
+        if self.cache is not None:
+            return self._execute_cached(commandline, event, caller, room_id)
+
+        return self._call(self._parameters_for(commandline, event, caller, callback, room_id))
+
+    async def execute_async(self, commandline=None, event=None, caller=None, callback=None,
+                            room_id=None):
+        """ The asyncio counterpart of :func:`execute` for :attr:`awaitable` commands
+
+        The coroutine runs on :attr:`event_loop` and is awaited from the calling loop, so no
+        thread waits for it.
+        """
+
+        coroutine = self._function(**self._parameters_for(commandline, event, caller, callback,
+                                                           room_id))
+        return await asyncio.wrap_future(self.event_loop.submit(coroutine))
+
+    def _parameters_for(self, commandline, event, caller, callback, room_id):
+        """ Returns the keyword arguments to call the function with """
 
-        function_parameters = signature(self.function).parameters
-        parameters_to_pass = {}
-        for parameter, value in possible_parameters.items():
-            if parameter in list(function_parameters.keys()):
-                parameters_to_pass[parameter] = value
+        if not self._parameters:
+            return {}
+
+        possible_parameters = {
+            "commandline": commandline,
+            "event": event,
+            "caller": caller,
+            "callback": callback,
+            "room_id": room_id
+        }
+        parameters_to_pass = {parameter: possible_parameters[parameter]
+                              for parameter in self._parameters}
 
         # Only create the callback function if it's needed
         if "callback" in parameters_to_pass:
             parameters_to_pass["callback"] = self.create_callback(callback, room_id)
 
-        return self.function(**parameters_to_pass)
+        return parameters_to_pass
+
+    def _call(self, parameters):
+        """ Calls the function with ``parameters``, within :attr:`limits` if it has any """
+
+        if self.limits is None:
+            return self._invoke(parameters)
+        return self.limits.run(self._invoke, parameters)
+
+    def _invoke(self, parameters):
+        """ Calls the function, running it on :attr:`event_loop` if it is async. An async
+        generator is returned as a regular generator, whose every step runs on the loop.
+        """
+
+        reply = self._function(**parameters)
+        if isinstance(reply, (CoroutineType, _AsyncGeneratorType)):
+            # Unlike a thread, a coroutine can be cancelled, so one which outlives its timeout
+            # gives its slot back instead of running on
+            timeout = self.limits.timeout if self.limits is not None else None
+            deadline = None if timeout is None else monotonic() + timeout
+            if isinstance(reply, CoroutineType):
+                return self.event_loop.run(reply, deadline)
+            return self.event_loop.iterate(reply, deadline)
+        return reply
+
+    def stats(self):
+        """ Returns the in-flight and queued calls of this command, along with how many were
+        busy or timed out, as a dict. Returns None if the command has no limits.
+        """
+
+        return self.limits.stats() if self.limits is not None else None
+
+    def _execute_cached(self, commandline, event, caller, room_id):
+        """ Returns the cached reply for these inputs, running the function if there isn't one """
+
+        inputs = {
+            "commandline": tuple(commandline or ()),
+            "caller": caller.id if caller else None,
+            "room_id": room_id
+        }
+        key = tuple(inputs[parameter] for parameter in self.cache_key)
+
+        possible_parameters = {
+            "commandline": commandline,
+            "event": event,
+            "caller": caller,
+            "room_id": room_id
+        }
+
+        def load(_):
+            reply = self._call({parameter: possible_parameters[parameter]
+                                for parameter in self._parameters})
+            if isinstance(reply, GeneratorType):
+                # Generators can only be iterated once, so keep their replies
+                return list(reply)
+            return reply
+
+        reply = self.cache.get(key, load)
+        if isinstance(reply, list):
+            # Give commandworker a generator, as the command itself would have
+            return (response for response in reply)
+        return reply
@@ -0,0 +1,155 @@
+"""Runs ``async def`` commands on an event loop owned by the bot"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from concurrent.futures import TimeoutError as FutureTimeout
+from os import getpid
+from threading import Event, Lock, Thread, get_ident
+from time import monotonic
+
+# Number of seconds run() waits for a cancelled coroutine to finish unwinding
+CANCEL_GRACE = 1
+
+class EventLoopThread:
+    """ An asyncio event loop running on a thread of its own
+
+    Every ``async def`` command of a bot runs on its loop, so that commands waiting on I/O share
+    one thread instead of holding a worker each. Worker threads call :func:`run` and
+    :func:`iterate`, which wait for the loop to finish a coroutine, so the WSGI receiver can run
+    async commands like any other. The ASGI receiver uses :func:`submit` instead, and waits
+    without holding a thread.
+
+    The loop is started the first time it is needed, and again in a forked child, where the
+    parent's thread does not exist.
+
+    :param name: Name of the loop's thread
+    :type name: str
+    """
+
+    def __init__(self, name="sparkbot-loop"):
+        self.name = name
+
+        self._lock = Lock()
+        self._pid = None
+        self._loop = None
+        self._thread = None
+
+    @property
+    def loop(self):
+        """ The running ``asyncio`` event loop """
+
+        with self._lock:
+            if self._pid != getpid():
+                self._pid = getpid()
+                self._loop = asyncio.new_event_loop()
+                self._thread = Thread(target=self._run_forever, args=(self._loop,),
+                                      name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            return self._loop
+
+    def _run_forever(self, loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def submit(self, coroutine):
+        """ Schedules ``coroutine`` on the loop
+
+        :returns: concurrent.futures.Future of the coroutine's result. Wrap it with
+                  ``asyncio.wrap_future`` to await it from another event loop.
+        """
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine, deadline=None):
+        """ Runs ``coroutine`` on the loop and returns its result, blocking until it finishes
+
+        :param deadline: ``time.monotonic()`` value by which the coroutine must finish. If it
+                         hasn't, it is cancelled, and given up to :data:`CANCEL_GRACE` seconds to
+                         handle that before the TimeoutError is raised.
+
+        :raises concurrent.futures.TimeoutError: The deadline passed
+
+        :raises RuntimeError: Called from the loop's own thread, where it would never finish
+        """
+
+        loop = self.loop
+        if self._thread.ident == get_ident():
+            coroutine.close()
+            raise RuntimeError("EventLoopThread.run can't be called from its own loop. "
+                               "Await the coroutine instead.")
+        if deadline is None:
+            return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+        finished = Event()
+        future = asyncio.run_coroutine_threadsafe(self._watch(coroutine, finished), loop)
+        try:
+            return future.result(timeout=max(0, deadline - monotonic()))
+        except FutureTimeout:
+            future.cancel()
+            # The coroutine only sees the cancellation once the loop gets to it
+            finished.wait(CANCEL_GRACE)
+            raise
+
+    async def _watch(self, coroutine, finished):
+        """ Awaits ``coroutine``, setting ``finished`` once it has returned, raised or been
+        cancelled """
+
+        try:
+            return await coroutine
+        finally:
+            finished.set()
+
+    def iterate(self, async_generator, deadline=None):
+        """ Returns a generator which yields the values of ``async_generator``, running each step
+        on the loop. The async generator is closed when the generator is.
+
+        :param deadline: ``time.monotonic()`` value by which every value must have been yielded.
+                         The step running when it passes is cancelled.
+        """
+
+        timed_out = False
+        try:
+            while True:
+                try:
+                    value = self.run(async_generator.__anext__(), deadline)
+                except StopAsyncIteration:
+                    return
+                except FutureTimeout:
+                    timed_out = True
+                    raise
+                yield value
+        finally:
+            if timed_out:
+                # The cancelled step may still be unwinding if it outlasted CANCEL_GRACE, so
+                # close the async generator after it without waiting
+                self.submit(async_generator.aclose())
+            else:
+                self.run(async_generator.aclose())
+
+    def stop(self):
+        """ Stops the loop and waits for its thread to exit. Anything still running on it is
+        abandoned. The loop starts again if it is used afterwards. """
+
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            if self._pid != getpid():
+                return
+            self._pid = None
+
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
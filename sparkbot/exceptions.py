@@ -13,4 +13,29 @@ class CommandSetupError(SparkBotError):
     
     * Attempting to add more than one fallback command
     * Attempting to add a non-fallback command with no command strings
-    """
\ No newline at end of file
+    """
+
+class QueueFull(SparkBotError):
+    """Raised when work is submitted to a full :class:`sparkbot.executor.WorkerPool` and its
+    ``full_policy`` could not make room for it"""
+
+class CommandTimeout(SparkBotError):
+    """Raised when a command takes longer than the ``timeout`` it was added with. The user is
+    told that the command took too long."""
+
+class CommandBusy(SparkBotError):
+    """Raised when a command is already running as many times as its ``max_concurrency`` allows
+    and no slot became free within its ``queue_timeout``. The user is asked to try again later."""
+
+class ApiError(SparkBotError):
+    """Raised by :class:`sparkbot.asyncapi.AsyncSparkAPI` when Webex Teams returns an unexpected
+    response
+
+    The HTTP status code is available as ``status`` and the value of the ``Retry-After`` header,
+    if any, as ``retry_after``.
+    """
+
+    def __init__(self, *args, status=None, retry_after=None):
+        super().__init__(*args)
+        self.status = status
+        self.retry_after = retry_after
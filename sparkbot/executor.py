@@ -0,0 +1,565 @@
+"""Bounded worker pools used to run SparkBot commands"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+from logging import Logger
+from os import getpid
+from threading import Condition, Lock, Thread
+from time import monotonic
+from types import GeneratorType
+from .exceptions import CommandBusy, CommandTimeout, QueueFull
+from . import tracing
+
+REJECT = "reject"
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+
+FULL_POLICIES = (REJECT, BLOCK, DROP_OLDEST)
+
+class WorkerPool:
+    """ A fixed number of worker threads fed from a bounded queue
+
+    SparkBot hands every accepted webhook to one of these instead of starting a new thread for it.
+    Worker threads are started the first time work is submitted in a process, so a pool created
+    before the receiver is forked (by gunicorn or multiprocessing) still works in the child.
+
+    :param workers: Number of worker threads that will run submitted work
+    :type workers: int
+
+    :param queue_size: Maximum number of submitted items waiting for a free worker
+    :type queue_size: int
+
+    :param full_policy: What to do when work is submitted while the queue is full:
+
+                        * ``"reject"`` raises :class:`sparkbot.exceptions.QueueFull`. The receiver
+                          turns this into a ``503 Service Unavailable`` with a ``Retry-After``
+                          header so that Webex Teams will deliver the webhook again later.
+                        * ``"block"`` waits for space in the queue, up to ``block_timeout``
+                          seconds, then rejects.
+                        * ``"drop_oldest"`` discards the item that has waited the longest to make
+                          room for the new one.
+    :type full_policy: str
+
+    :param block_timeout: Maximum number of seconds to wait for space when ``full_policy`` is
+                          ``"block"``. ``None`` waits forever.
+    :type block_timeout: float
+
+    :param retry_after: Number of seconds sent in the ``Retry-After`` header of a rejection
+    :type retry_after: int
+
+    :param logger: Logger that exceptions raised by submitted work will be output to
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, workers=10, queue_size=100, full_policy=REJECT, block_timeout=None,
+                 retry_after=5, logger=None):
+
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError("workers must be a positive int")
+
+        if not isinstance(queue_size, int) or queue_size < 1:
+            raise ValueError("queue_size must be a positive int")
+
+        if full_policy not in FULL_POLICIES:
+            raise ValueError("full_policy must be one of: " + ", ".join(FULL_POLICIES))
+
+        if logger and not isinstance(logger, Logger):
+            raise TypeError("logger is not of type logging.Logger")
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self.full_policy = full_policy
+        self.block_timeout = block_timeout
+        self.retry_after = retry_after
+        self.logger = logger
+
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+        self._queue = deque()
+        self._threads = []
+        self._pid = None
+        self._active = 0
+        self._shutdown = False
+
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._dropped = 0
+        self._saturated = 0
+        self._peak_queue_depth = 0
+
+    def submit(self, function, *args, **kwargs):
+        """ Queues ``function(*args, **kwargs)`` to be run by a worker
+
+        :returns: concurrent.futures.Future which will hold the result of the call
+
+        :raises QueueFull: The queue is full and the pool's ``full_policy`` did not make room
+        """
+
+        return self._submit(None, function, args, kwargs)
+
+    def submit_ordered(self, key, function, *args, **kwargs):
+        """ Queues ``function(*args, **kwargs)`` as work belonging to ``key``
+
+        A WorkerPool runs work in any order, whatever its key. An :class:`OrderedWorkerPool` runs
+        work with the same key one item at a time, in the order it was submitted. The receiver
+        submits each webhook with its room ID as the key.
+
+        :returns: concurrent.futures.Future which will hold the result of the call
+
+        :raises QueueFull: The queue is full and the pool's ``full_policy`` did not make room
+        """
+
+        return self._submit(key, function, args, kwargs)
+
+    def _submit(self, key, function, args, kwargs):
+        future = Future()
+
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit work to a WorkerPool that has been shut down")
+
+            self._ensure_started()
+
+            if self._waiting() >= self.queue_size:
+                self._saturated += 1
+                self._make_room()
+
+            # Carry the trace in progress over to the worker thread
+            self._add((future, tracing.bind(function), args, kwargs), key)
+            self._submitted += 1
+            self._peak_queue_depth = max(self._peak_queue_depth, self._waiting())
+
+        return future
+
+    def _add(self, item, key):
+        """ Makes ``item`` available to the workers. Must be called with the lock held. """
+
+        self._queue.append(item)
+        self._not_empty.notify()
+
+    def _release(self, item):
+        """ Called with the lock held once ``item`` has been run or dropped """
+
+    def _waiting(self):
+        """ Returns the number of items waiting for a worker. Must be called with the lock
+        held. """
+
+        return len(self._queue)
+
+    def _make_room(self):
+        """ Applies ``full_policy`` to a full queue. Must be called with the lock held. """
+
+        # An OrderedWorkerPool can be full with nothing in the queue, when every waiting item is
+        # behind one that is running. Then there's nothing to drop, so it rejects.
+        if self.full_policy == DROP_OLDEST and self._queue:
+            dropped = self._queue.popleft()
+            dropped[0].cancel()
+            self._dropped += 1
+            self._release(dropped)
+            return
+
+        if self.full_policy == BLOCK:
+            has_room = self._not_full.wait_for(
+                lambda: self._waiting() < self.queue_size or self._shutdown,
+                timeout=self.block_timeout)
+            if has_room and not self._shutdown:
+                return
+
+        self._rejected += 1
+        raise QueueFull("Worker queue is full", "The bot is busy right now. Try again later.")
+
+    def _ensure_started(self):
+        """ Starts the worker threads if this process does not have them yet """
+
+        if self._pid == getpid():
+            return
+
+        # Either this pool has never been started or we are in a forked child, where the
+        # parent's threads do not exist. Any queue contents belong to the parent.
+        self._pid = getpid()
+        self._queue.clear()
+        self._active = 0
+        self._threads = []
+
+        for number in range(self.workers):
+            thread = Thread(target=self._work, name="sparkbot-worker-{}".format(number))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        """ Body of every worker thread """
+
+        while True:
+            with self._lock:
+                self._not_empty.wait_for(lambda: self._queue or self._shutdown)
+                if not self._queue:
+                    return
+
+                item = self._queue.popleft()
+                self._active += 1
+                # Wake anyone blocked in submit() waiting for room
+                self._not_full.notify()
+
+            self._run(*item)
+
+            with self._lock:
+                self._active -= 1
+                self._release(item)
+
+    def _run(self, future, function, args, kwargs):
+        """ Runs one unit of work, storing its result in ``future`` """
+
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as error:
+            with self._lock:
+                self._failed += 1
+            if self.logger:
+                self.logger.exception("Unhandled exception in SparkBot worker")
+            future.set_exception(error)
+        else:
+            with self._lock:
+                self._completed += 1
+            future.set_result(result)
+
+    def shutdown(self, wait=True):
+        """ Stops accepting work and lets the workers exit once the queue is empty
+
+        :param wait: If True, block until every worker thread has exited
+        """
+
+        with self._lock:
+            self._shutdown = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+            threads = list(self._threads) if self._pid == getpid() else []
+
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    @property
+    def queue_depth(self):
+        """ Number of items currently waiting for a worker """
+        with self._lock:
+            return self._waiting()
+
+    def stats(self):
+        """ Returns a snapshot of this pool's counters as a dict
+
+        ``queue_depth`` and ``active`` are current values. ``saturated`` counts the submissions
+        which found the queue full, whether they were eventually accepted or not. ``rejected`` and
+        ``dropped`` count the work that was lost as a result.
+        """
+
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "queue_depth": self._waiting(),
+                "peak_queue_depth": self._peak_queue_depth,
+                "active": self._active,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "saturated": self._saturated,
+                "rejected": self._rejected,
+                "dropped": self._dropped,
+            }
+
+class OrderedWorkerPool(WorkerPool):
+    """ A :class:`WorkerPool` which runs work with the same key in order, one item at a time
+
+    Work submitted with :func:`submit_ordered` is kept in a mailbox for its key, such as a room
+    ID. Only the oldest item in each mailbox is in the pool's queue. When it has finished, the
+    next item for that key joins the back of the queue, so one busy room can't hold up the
+    others, and rooms still run in parallel. A mailbox is deleted as soon as it is empty, so
+    memory only depends on the rooms with work in progress, not on every room ever seen.
+
+    Work submitted with :func:`submit` has no key and runs in any order. Items waiting in
+    mailboxes count towards ``queue_size``. Takes the same parameters as :class:`WorkerPool`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # key: deque of items waiting behind the one that is queued or running
+        self._mailboxes = {}
+        # Future of a queued or running item: its key
+        self._keys = {}
+        self._mailboxed = 0
+
+    def _ensure_started(self):
+        if self._pid != getpid():
+            # Like the queue, any mailboxes belong to the parent process
+            self._mailboxes.clear()
+            self._keys.clear()
+            self._mailboxed = 0
+
+        super()._ensure_started()
+
+    def _add(self, item, key):
+        if key is None:
+            super()._add(item, key)
+            return
+
+        mailbox = self._mailboxes.get(key)
+        if mailbox is not None:
+            # Something for this key is already queued or running. Wait for it.
+            mailbox.append(item)
+            self._mailboxed += 1
+            return
+
+        self._mailboxes[key] = deque()
+        self._keys[item[0]] = key
+        super()._add(item, key)
+
+    def _release(self, item):
+        key = self._keys.pop(item[0], None)
+        if key is None:
+            return
+
+        mailbox = self._mailboxes[key]
+        if not mailbox:
+            del self._mailboxes[key]
+            return
+
+        next_item = mailbox.popleft()
+        self._mailboxed -= 1
+        self._keys[next_item[0]] = key
+        super()._add(next_item, key)
+
+    def _waiting(self):
+        return len(self._queue) + self._mailboxed
+
+    def stats(self):
+        """ Returns a snapshot of this pool's counters as a dict
+
+        In addition to the counters of :func:`WorkerPool.stats`, ``mailboxes`` is the number of
+        keys with work queued or running.
+        """
+
+        stats = super().stats()
+        with self._lock:
+            stats["mailboxes"] = len(self._mailboxes)
+        return stats
+
+class Bulkhead:
+    """ Limits how long a command may run for and how many calls of it may run at once
+
+    SparkBot gives each command added with ``timeout`` or ``max_concurrency`` its own bulkhead, so
+    that a slow command can't occupy every worker and starve the others.
+
+    A call which finds ``max_concurrency`` calls already running waits up to ``queue_timeout``
+    seconds for one to finish, then raises :class:`sparkbot.exceptions.CommandBusy`.
+
+    With a ``timeout``, the command runs on one of the bulkhead's own threads while the worker
+    waits for it. If it doesn't finish in time, the worker raises
+    :class:`sparkbot.exceptions.CommandTimeout` and moves on. Python can't stop the call, so it
+    keeps its slot until it really finishes. A command which keeps hanging therefore ends up busy
+    instead of holding up the workers. ``async def`` commands are the exception: the call is
+    cancelled by :func:`sparkbot.eventloop.EventLoopThread.run` when it runs out of time, which
+    gives the slot back. For a command which yields, ``timeout`` covers every reply and the slot
+    is held until the last one.
+
+    :param timeout: Number of seconds a call may take, or None for no limit
+    :type timeout: float
+
+    :param max_concurrency: Number of calls which may run at once, or None for no limit
+    :type max_concurrency: int
+
+    :param queue_timeout: Number of seconds a call may wait for a free slot. 0 rejects calls
+                          straight away when every slot is in use.
+    :type queue_timeout: float
+
+    :param max_queue: Number of calls which may wait for a slot at once, or None for no limit
+    :type max_queue: int
+
+    :param timeout_workers: Number of threads which run timed calls when there's no
+                            ``max_concurrency``. Calls beyond that are busy.
+    :type timeout_workers: int
+    """
+
+    def __init__(self, timeout=None, max_concurrency=None, queue_timeout=0, max_queue=None,
+                 timeout_workers=10):
+
+        if timeout is not None and (not isinstance(timeout, (int, float)) or timeout <= 0):
+            raise ValueError("timeout must be a positive number of seconds")
+
+        if max_concurrency is not None and (not isinstance(max_concurrency, int)
+                                            or max_concurrency < 1):
+            raise ValueError("max_concurrency must be a positive int")
+
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.timeout_workers = timeout_workers
+
+        self._lock = Lock()
+        self._slot_free = Condition(self._lock)
+        # Runs timed calls. Created on the first one.
+        self._pool = None
+
+        self._in_flight = 0
+        self._queued = 0
+        self._peak_in_flight = 0
+        self._calls = 0
+        self._busy = 0
+        self._timeouts = 0
+
+    def run(self, function, *args):
+        """ Calls ``function(*args)`` within this bulkhead's limits and returns its result. If it
+        returns a generator, a generator which applies the limits to each step is returned
+        instead.
+
+        :raises CommandBusy: Every slot is in use
+
+        :raises CommandTimeout: ``function`` took longer than ``timeout``
+        """
+
+        self._acquire()
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+
+        try:
+            reply = self._step(function, args, deadline)
+        except CommandTimeout:
+            raise
+        except BaseException:
+            self._release()
+            raise
+
+        if isinstance(reply, GeneratorType):
+            return self._iterate(reply, deadline)
+
+        self._release()
+        return reply
+
+    def _acquire(self):
+        """ Takes a slot, waiting up to ``queue_timeout`` for one """
+
+        with self._lock:
+            self._calls += 1
+
+            if self.max_concurrency is not None and self._in_flight >= self.max_concurrency:
+                if self.max_queue is not None and self._queued >= self.max_queue:
+                    self._busy += 1
+                    raise CommandBusy("Command is at its concurrency limit",
+                                      "This command is busy right now. Try again later.")
+
+                self._queued += 1
+                try:
+                    has_slot = self._slot_free.wait_for(
+                        lambda: self._in_flight < self.max_concurrency,
+                        timeout=self.queue_timeout)
+                finally:
+                    self._queued -= 1
+
+                if not has_slot:
+                    self._busy += 1
+                    raise CommandBusy("Command is at its concurrency limit",
+                                      "This command is busy right now. Try again later.")
+
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._slot_free.notify()
+
+    def _step(self, function, args, deadline):
+        """ Calls ``function(*args)``, on the bulkhead's threads if there is a ``deadline``
+
+        If the deadline passes, the slot is released once the call finishes and CommandTimeout is
+        raised. Otherwise the caller must release it.
+        """
+
+        if deadline is None:
+            return function(*args)
+
+        try:
+            future = self._get_pool().submit(function, *args)
+        except QueueFull:
+            # The caller still holds the slot and releases it
+            with self._lock:
+                self._busy += 1
+            raise CommandBusy("Command has no free thread to run on",
+                              "This command is busy right now. Try again later.")
+
+        try:
+            return future.result(timeout=max(0, deadline - monotonic()))
+        except FutureTimeout:
+            with self._lock:
+                self._timeouts += 1
+            future.add_done_callback(lambda _: self._release())
+            raise CommandTimeout("Command took longer than {}s".format(self.timeout),
+                                 "This command took too long to finish.")
+
+    def _iterate(self, generator, deadline):
+        """ Yields the replies of ``generator``, running each step within the deadline """
+
+        finished = object()
+        timed_out = False
+        try:
+            while True:
+                reply = self._step(next, (generator, finished), deadline)
+                if reply is finished:
+                    return
+                yield reply
+        except CommandTimeout:
+            timed_out = True
+            raise
+        finally:
+            if not timed_out:
+                generator.close()
+                self._release()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # With a concurrency limit, every call has a slot and so never waits for a thread
+                workers = self.max_concurrency or self.timeout_workers
+                self._pool = WorkerPool(workers=workers, queue_size=workers)
+            return self._pool
+
+    def stats(self):
+        """ Returns a snapshot of this bulkhead's counters as a dict
+
+        ``in_flight`` is the number of calls holding a slot, including calls which timed out but
+        haven't finished. ``queued`` is the number waiting for a slot.
+        """
+
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "timeout": self.timeout,
+                "in_flight": self._in_flight,
+                "peak_in_flight": self._peak_in_flight,
+                "queued": self._queued,
+                "calls": self._calls,
+                "busy": self._busy,
+                "timeouts": self._timeouts,
+            }
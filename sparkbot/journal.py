@@ -0,0 +1,294 @@
+"""A durable record of accepted webhooks, so that commands survive a restart"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sqlite3
+from concurrent.futures import Future
+from logging import Logger
+from os import getpid
+from threading import Condition, Lock, Thread
+from time import time
+from uuid import uuid4
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    received REAL NOT NULL,
+    body TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    owner TEXT NOT NULL DEFAULT ''
+)
+"""
+
+# Owners of the journals open in this process
+_live_owners = set()
+
+def _process_exists(pid):
+    """ Returns whether a process with the given ID is running """
+
+    if os.name == "nt":
+        # os.kill would terminate the process. Journals aren't shared between processes on
+        # Windows, so an entry owned by another process was left behind by one that stopped.
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists, but belongs to another user
+        return True
+    return True
+
+def _owner_stopped(owner):
+    """ Returns 1 if the journal which wrote an entry is no longer running, otherwise 0.
+    Registered as an SQLite function so that entries can be claimed in a single statement. """
+
+    if owner in _live_owners:
+        return 0
+    pid, _, _ = owner.partition(":")
+    if not pid.isdigit() or int(pid) == getpid():
+        # Written before owners were recorded, or by an earlier process which had our PID
+        return 1
+    return 0 if _process_exists(int(pid)) else 1
+
+class Journal:
+    """ An append-only SQLite journal of the webhooks the receiver has accepted
+
+    When SparkBot is created with a journal, the receiver appends every webhook to it before
+    answering Webex Teams, and the entry is marked as done once its command has finished. Entries
+    which were never finished, because the process stopped while they were queued or running,
+    are run again by :func:`SparkBot.replay_journal`.
+
+    Appends are committed by a single writer thread. Every append waiting when a commit starts is
+    included in it, so a burst of webhooks shares one ``fsync`` instead of paying for one each.
+
+    Several processes may share one journal file, for example the workers started by
+    ``gunicorn --workers N``. Each entry records the process which appended it, and only entries
+    whose process has stopped are replayed, so a worker never runs a command again while another
+    worker is still running it.
+
+    :param path: Path of the SQLite database file. It is created if it does not exist.
+    :type path: str
+
+    :param fsync: If True, every commit is flushed to disk before the webhook is answered, so
+                  entries survive a power failure. If False, they only survive the process
+                  stopping, which is much faster on slow disks.
+    :type fsync: bool
+
+    :param purge_every: Number of finished entries after which finished entries are deleted
+    :type purge_every: int
+
+    :param logger: Logger that errors from the writer thread will be output to
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, path, fsync=True, purge_every=1000, logger=None):
+
+        if logger and not isinstance(logger, Logger):
+            raise TypeError("logger is not of type logging.Logger")
+
+        self.path = path
+        self.fsync = fsync
+        self.purge_every = purge_every
+        self.logger = logger
+
+        self._lock = Lock()
+        self._wake = Condition(self._lock)
+        # Waiting appends as (body, Future) and entries to mark as done
+        self._appends = []
+        self._completions = []
+        self._pid = None
+        self._owner = None
+        self._writer = None
+        self._closed = False
+
+        self._appended = 0
+        self._completed = 0
+        self._commits = 0
+
+        # Create the file, or add owners to one written by an older version, straight away
+        self._connect().close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous={}".format("FULL" if self.fsync else "NORMAL"))
+        connection.execute(_SCHEMA)
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(entries)")]
+        if "owner" not in columns:
+            connection.execute("ALTER TABLE entries ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+        connection.commit()
+        return connection
+
+    def _ensure_started(self):
+        """ Starts the writer thread if this process does not have one yet. Must be called with
+        the lock held. """
+
+        if self._pid == getpid():
+            return
+
+        # SQLite connections can't be shared with a forked child, so each process makes its own.
+        # The PID alone can't identify this journal, since a restarted container is often given
+        # the same PID as before.
+        self._pid = getpid()
+        self._owner = "{}:{}".format(self._pid, uuid4().hex)
+        _live_owners.add(self._owner)
+        self._appends = []
+        self._completions = []
+        self._writer = Thread(target=self._write, name="sparkbot-journal")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def append(self, json_data):
+        """ Adds a webhook to the journal, returning once it has been committed
+
+        :param json_data: The webhook's body parsed into a dictionary
+
+        :returns: The ID of the new entry, to pass to :func:`complete`
+        """
+
+        future = Future()
+        body = json.dumps(json_data)
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Cannot append to a Journal that has been closed")
+            self._ensure_started()
+            self._appends.append((body, future))
+            self._wake.notify()
+
+        return future.result()
+
+    def complete(self, entry_id):
+        """ Marks an entry as done. This returns immediately and is committed with the next batch.
+        """
+
+        with self._lock:
+            if self._closed:
+                return
+            self._ensure_started()
+            self._completions.append(entry_id)
+            self._wake.notify()
+
+    def _write(self):
+        """ Body of the writer thread """
+
+        connection = self._connect()
+        since_purge = 0
+
+        while True:
+            with self._lock:
+                self._wake.wait_for(lambda: self._appends or self._completions or self._closed)
+                appends, self._appends = self._appends, []
+                completions, self._completions = self._completions, []
+                closed = self._closed
+
+            if appends or completions:
+                try:
+                    entry_ids = []
+                    with connection:
+                        received = time()
+                        for body, future in appends:
+                            cursor = connection.execute(
+                                "INSERT INTO entries (received, body, owner) VALUES (?, ?, ?)",
+                                (received, body, self._owner))
+                            entry_ids.append(cursor.lastrowid)
+                        connection.executemany("UPDATE entries SET done = 1 WHERE id = ?",
+                                               [(entry_id,) for entry_id in completions])
+
+                        since_purge += len(completions)
+                        if since_purge >= self.purge_every:
+                            connection.execute("DELETE FROM entries WHERE done = 1")
+                            since_purge = 0
+                except Exception as error:
+                    if self.logger:
+                        self.logger.exception("Unable to write to the SparkBot journal")
+                    for _, future in appends:
+                        future.set_exception(error)
+                else:
+                    with self._lock:
+                        self._appended += len(appends)
+                        self._completed += len(completions)
+                        self._commits += 1
+                    for (_, future), entry_id in zip(appends, entry_ids):
+                        future.set_result(entry_id)
+
+            if closed:
+                connection.close()
+                return
+
+    def unfinished(self):
+        """ Claims the entries which were never marked as done by a process that has since
+        stopped, so that no other process replays them as well.
+
+        :returns: ``(entry ID, json_data)`` for each claimed entry, oldest first
+        """
+
+        with self._lock:
+            if self._closed:
+                return []
+            self._ensure_started()
+            owner = self._owner
+
+        connection = self._connect()
+        connection.create_function("owner_stopped", 1, _owner_stopped)
+        # Transactions are managed here, so that the entries are selected and claimed atomically
+        connection.isolation_level = None
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = connection.execute(
+                    "SELECT id, body FROM entries WHERE done = 0 AND owner != ? "
+                    "AND owner_stopped(owner) ORDER BY id", (owner,)).fetchall()
+                connection.executemany("UPDATE entries SET owner = ? WHERE id = ?",
+                                       [(owner, entry_id) for entry_id, _ in rows])
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+        return [(entry_id, json.loads(body)) for entry_id, body in rows]
+
+    def close(self):
+        """ Commits anything waiting and stops the writer thread """
+
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+            writer = self._writer if self._pid == getpid() else None
+
+        if writer:
+            writer.join()
+            # Anything this journal left unfinished may now be replayed by another one
+            _live_owners.discard(self._owner)
+
+    def stats(self):
+        """ Returns a snapshot of this journal's counters as a dict
+
+        ``commits`` counts the batches written, so ``appended / commits`` is the average number of
+        webhooks sharing each ``fsync``.
+        """
+
+        with self._lock:
+            return {
+                "appended": self._appended,
+                "completed": self._completed,
+                "commits": self._commits,
+                "waiting": len(self._appends) + len(self._completions),
+            }
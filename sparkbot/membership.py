@@ -0,0 +1,122 @@
+"""An index of who is in which team and room, for fast authorization checks"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .cache import TTLCache
+from .transport import as_transport
+
+TEAM = "team"
+ROOM = "room"
+
+class MembershipIndex:
+    """ Holds the set of person IDs in each team and room that has been asked about
+
+    The members of a team or room are loaded the first time they are needed. After that, checking
+    whether somebody is a member is a set lookup.
+
+    Room memberships are kept current with ``memberships`` webhook events, which the receiver
+    passes to :func:`handle_event` when SparkBot is created with ``track_memberships=True``.
+    Webex Teams has no webhook for team memberships, so team members are reloaded every
+    ``refresh_interval`` seconds instead, and somebody removed from a team passes checks until
+    then.
+
+    The answers are used to decide who may run a command, so by default a check waits for the
+    reload rather than answering from the old set. With ``stale_ttl``, the old set keeps
+    answering for up to that many more seconds while the reload runs in the background, which
+    lets a removed member pass checks for up to ``refresh_interval + stale_ttl`` seconds.
+
+    :param api: CiscoSparkAPI or :class:`sparkbot.transport.Transport` to load memberships with
+
+    :param refresh_interval: Number of seconds after which the members of a team or room are
+                             reloaded
+    :type refresh_interval: float
+
+    :param stale_ttl: Number of seconds after ``refresh_interval`` that the old members may still
+                      be used while they are reloaded in the background. 0 never uses them.
+    :type stale_ttl: float
+
+    :param maxsize: Maximum number of teams and rooms to hold. The least recently checked ones are
+                    forgotten first.
+    :type maxsize: int
+    """
+
+    def __init__(self, api, refresh_interval=3600, maxsize=256, stale_ttl=0):
+        self.api = api
+        self._transport = as_transport(api)
+        self._members = TTLCache(maxsize=maxsize, ttl=refresh_interval, stale_ttl=stale_ttl)
+
+    def _load(self, key):
+        kind, container_id = key
+
+        if kind == TEAM:
+            memberships = self._transport.list_team_memberships(container_id)
+        else:
+            memberships = self._transport.list_memberships(container_id)
+
+        return set(membership.personId for membership in memberships)
+
+    def team_members(self, team_id):
+        """ Returns the set of person IDs in the team ``team_id``. Do not modify it. """
+        return self._members.get((TEAM, team_id), self._load)
+
+    def room_members(self, room_id):
+        """ Returns the set of person IDs in the room ``room_id``. Do not modify it. """
+        return self._members.get((ROOM, room_id), self._load)
+
+    def is_in_team(self, team_id, person_id):
+        """ Returns True if the person with ID ``person_id`` is in the team ``team_id`` """
+        return person_id in self.team_members(team_id)
+
+    def is_in_room(self, room_id, person_id):
+        """ Returns True if the person with ID ``person_id`` is in the room ``room_id`` """
+        return person_id in self.room_members(room_id)
+
+    def handle_event(self, json_data):
+        """ Applies a ``memberships`` webhook event to the index
+
+        Events for rooms which have not been loaded are ignored, since the room will be loaded
+        with its current members when it is first checked. They don't count towards
+        :func:`stats`.
+
+        :param json_data: The blob of json that Spark POSTs to the webhook parsed into a dictionary
+        """
+
+        data = json_data.get("data", {})
+        room_id = data.get("roomId")
+        person_id = data.get("personId")
+        event = json_data.get("event")
+
+        if not person_id:
+            return
+
+        # The set is replaced rather than changed, since other threads may be reading it. If
+        # the room is being loaded, it is invalidated instead, so the change isn't lost.
+        if event == "created":
+            self._members.update((ROOM, room_id), lambda members: members | {person_id})
+        elif event == "deleted":
+            self._members.update((ROOM, room_id), lambda members: members - {person_id})
+
+    def invalidate(self, team_id=None, room_id=None):
+        """ Forgets the members of a team or room so they are reloaded when next checked """
+
+        if team_id:
+            self._members.invalidate((TEAM, team_id))
+        if room_id:
+            self._members.invalidate((ROOM, room_id))
+
+    def stats(self):
+        """ Returns the hit, miss and load counters of the index as a dict. See
+        :func:`sparkbot.cache.TTLCache.stats`. """
+        return self._members.stats()
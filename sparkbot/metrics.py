@@ -0,0 +1,239 @@
+"""Counters and latency histograms for SparkBot, in the Prometheus text format"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bisect import bisect_left
+from threading import Lock
+from time import monotonic
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names, values, extra=""):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """ A count of events, optionally split up by label values
+
+    :param name: Name of the metric, such as ``sparkbot_webhooks_rejected_total``
+
+    :param documentation: One line describing the metric
+
+    :param labelnames: Names of the labels which :func:`inc` is given values for, in order
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        """ Adds ``amount`` to the count for the given label values """
+
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        """ Returns the count for the given label values """
+
+        with self._lock:
+            return self._values.get(labelvalues, 0)
+
+    def render(self):
+        """ Returns this metric in the Prometheus text format, as a list of lines """
+
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} counter".format(self.name)]
+
+        with self._lock:
+            values = sorted(self._values.items())
+
+        for labelvalues, value in values:
+            lines.append("{}{} {}".format(self.name, _format_labels(self.labelnames, labelvalues),
+                                          _format_value(value)))
+        return lines
+
+class Histogram:
+    """ A distribution of observed values, such as latencies, counted into buckets
+
+    Observing a value is a dict lookup, a binary search of the buckets and three additions, so
+    it is cheap enough to do for every request.
+
+    :param name: Name of the metric, such as ``sparkbot_receiver_seconds``
+
+    :param documentation: One line describing the metric
+
+    :param labelnames: Names of the labels which :func:`observe` is given values for, in order
+
+    :param buckets: Sorted upper bounds of the buckets. A ``+Inf`` bucket is always added.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = Lock()
+        # label values: [count in each bucket, ..., count above the last bucket, sum]
+        self._values = {}
+
+    def observe(self, value, *labelvalues):
+        """ Records ``value`` for the given label values """
+
+        index = bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._values.get(labelvalues)
+            if counts is None:
+                counts = self._values[labelvalues] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def observe_since(self, started, *labelvalues):
+        """ Records the seconds since ``started``, a ``time.monotonic()`` time, and returns the
+        current time, so that it can start the next stage """
+
+        now = monotonic()
+        self.observe(now - started, *labelvalues)
+        return now
+
+    def count(self, *labelvalues):
+        """ Returns the number of values observed for the given label values """
+
+        with self._lock:
+            counts = self._values.get(labelvalues)
+            return sum(counts[:-1]) if counts else 0
+
+    def render(self):
+        """ Returns this metric in the Prometheus text format, as a list of lines """
+
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} histogram".format(self.name)]
+
+        with self._lock:
+            values = sorted((labelvalues, list(counts))
+                            for labelvalues, counts in self._values.items())
+
+        bounds = [_format_value(float(bound)) for bound in self.buckets] + ["+Inf"]
+        for labelvalues, counts in values:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _format_labels(self.labelnames, labelvalues, 'le="{}"'.format(bound)),
+                    cumulative))
+
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append("{}_sum{} {}".format(self.name, labels, _format_value(counts[-1])))
+            lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+class Gauge:
+    """ A value which is read from a function whenever the metrics are rendered
+
+    :param name: Name of the metric, such as ``sparkbot_executor_queue_depth``
+
+    :param documentation: One line describing the metric
+
+    :param function: Function which takes no arguments and returns the current value
+    """
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def render(self):
+        """ Returns this metric in the Prometheus text format, as a list of lines """
+
+        return ["# HELP {} {}".format(self.name, self.documentation),
+                "# TYPE {} gauge".format(self.name),
+                "{} {}".format(self.name, _format_value(self.function()))]
+
+class MetricsRegistry:
+    """ A set of metrics which are rendered together """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """ Adds ``metric`` to the registry and returns it """
+
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Returns every metric in the registry in the Prometheus text format """
+
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+class BotMetrics(MetricsRegistry):
+    """ The metrics that every :class:`SparkBot` records, available as ``SparkBot.metrics``
+
+    ``receiver_seconds`` times each ``stage`` of handling a webhook: ``read`` (the request body,
+    including computing its HMAC),
+    ``validate`` (checking the signature, then parsing), ``journal`` (writing it to the bot's
+    journal, if it has one) and ``submit`` (queueing the command).
+
+    ``worker_seconds`` times each ``stage`` of running a command: ``fetch`` (the message and its
+    sender), ``parse``, ``command`` (the command's function) and ``respond`` (sending replies,
+    including running the rest of a command which yields them).
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.receiver_seconds = self.register(Histogram(
+            "sparkbot_receiver_seconds", "Time spent in each stage of receiving a webhook.",
+            ["stage"]))
+        self.worker_seconds = self.register(Histogram(
+            "sparkbot_worker_seconds", "Time spent in each stage of running a command.",
+            ["stage"]))
+        self.rejected = self.register(Counter(
+            "sparkbot_webhooks_rejected_total",
+            "Webhooks rejected with 403 because their signature was missing or wrong."))
+        self.malformed = self.register(Counter(
+            "sparkbot_webhooks_malformed_total",
+            "Webhooks rejected with 400 or 413 because their body was too large or not JSON."))
+        self.overloaded = self.register(Counter(
+            "sparkbot_webhooks_overloaded_total",
+            "Webhooks answered with 503 because the executor's queue was full."))
+        self.duplicates = self.register(Counter(
+            "sparkbot_webhooks_duplicate_total",
+            "Webhooks dropped because the same message was delivered recently."))
+        self.self_messages = self.register(Counter(
+            "sparkbot_self_messages_total",
+            "Webhooks ignored because the message was sent by the bot."))
+        self.not_found = self.register(Counter(
+            "sparkbot_commands_not_found_total",
+            "Messages which did not name a command, with no fallback command to run."))
+        self.command_errors = self.register(Counter(
+            "sparkbot_command_errors_total", "Exceptions raised by commands.", ["command"]))
@@ -0,0 +1,230 @@
+"""Shapes the replies that commands produce into messages that Webex Teams will accept"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from queue import Empty, Queue
+from threading import Thread
+from time import monotonic
+from . import tracing
+
+# The largest message Webex Teams accepts, in bytes
+MAX_MESSAGE_LENGTH = 7439
+
+# Room left in each chunk for a code fence line to be closed and reopened
+_FENCE_ALLOWANCE = 64
+
+def _size(text):
+    return len(text.encode("utf-8"))
+
+def _hard_split(line, limit):
+    """ Splits a single line which is longer than ``limit`` bytes, preferring to break at spaces """
+
+    pieces = []
+
+    while _size(line) > limit:
+        # Cut at the byte limit, dropping any character that was cut in half
+        prefix = line.encode("utf-8")[:limit].decode("utf-8", errors="ignore")
+        space = prefix.rfind(" ")
+        if space > 0:
+            prefix = prefix[:space + 1]
+        elif not prefix:
+            # The first character alone is larger than limit. Send it anyway rather than loop.
+            prefix = line[0]
+
+        pieces.append(prefix)
+        line = line[len(prefix):]
+
+    pieces.append(line)
+    return pieces
+
+def split_markdown(markdown, limit=MAX_MESSAGE_LENGTH):
+    """ Splits ``markdown`` into pieces no longer than ``limit`` bytes
+
+    Pieces are split between lines wherever possible. If a split falls inside a fenced code block,
+    the block is closed at the end of one piece and reopened at the start of the next so that both
+    render as code. Lines which are too long by themselves are split at a space, or anywhere if
+    they have no spaces.
+
+    :param markdown: The message to split
+
+    :param limit: Maximum size of each piece in bytes, once encoded as UTF-8. Must be more than
+                  64, which is kept free in each piece for closing and reopening code blocks.
+
+    :returns: list of str, which is just ``[markdown]`` if it already fits
+
+    :raises ValueError: ``limit`` is too small
+    """
+
+    if limit <= _FENCE_ALLOWANCE:
+        raise ValueError("limit must be more than {} bytes".format(_FENCE_ALLOWANCE))
+
+    if _size(markdown) <= limit:
+        return [markdown]
+
+    chunks = []
+    current = []
+    current_size = 0
+    fence = None
+
+    for line in markdown.split("\n"):
+        for piece in _hard_split(line, limit - _FENCE_ALLOWANCE):
+            piece_size = _size(piece) + 1
+            closing_size = 4 if fence else 0
+
+            if current and current_size + piece_size + closing_size > limit:
+                if fence:
+                    current.append("```")
+                chunks.append("\n".join(current))
+                current = [fence] if fence else []
+                current_size = _size(fence) + 1 if fence else 0
+
+            current.append(piece)
+            current_size += piece_size
+
+            if piece.lstrip().startswith("```"):
+                fence = None if fence else piece.strip()
+
+    if current:
+        chunks.append("\n".join(current))
+
+    return [chunk for chunk in chunks if chunk.strip()]
+
+def coalesce(generator, send, window, max_size=MAX_MESSAGE_LENGTH, separator="\n"):
+    """ Sends the replies from a command's generator, merging replies which arrive close together
+
+    The first reply after a message is sent starts a window of ``window`` seconds. Replies which
+    arrive during the window are joined with ``separator`` and sent as one message when the window
+    ends, when adding another reply would make the message larger than ``max_size`` bytes, or when
+    the generator finishes.
+
+    The generator is stepped through on a helper thread so that the window can end while the
+    command is still working. Messages are sent from the calling thread, in order.
+
+    :param generator: Generator returned by a command
+
+    :param send: Function which sends one message, such as :func:`SparkBot.respond` with the room
+                 filled in
+
+    :param window: Number of seconds to wait for more replies before sending
+
+    :param max_size: Largest message to build, in bytes
+
+    :param separator: String placed between merged replies
+
+    :raises: Any exception raised by the generator, after the replies before it have been sent
+    """
+
+    replies = Queue()
+    finished = object()
+
+    def produce():
+        try:
+            for reply in generator:
+                replies.put((reply, None))
+        except BaseException as error:
+            replies.put((finished, error))
+        else:
+            replies.put((finished, None))
+
+    producer = Thread(target=tracing.bind(produce), name="sparkbot-output")
+    producer.daemon = True
+    producer.start()
+
+    pending = []
+    pending_size = 0
+    deadline = None
+
+    while True:
+        timeout = None if deadline is None else max(0, deadline - monotonic())
+        try:
+            reply, error = replies.get(timeout=timeout)
+        except Empty:
+            # The window ended while the command was still working
+            send(separator.join(pending))
+            pending, pending_size, deadline = [], 0, None
+            continue
+
+        if reply is finished:
+            break
+
+        reply_size = _size(reply) + _size(separator)
+        if pending and pending_size + reply_size > max_size:
+            send(separator.join(pending))
+            pending, pending_size, deadline = [], 0, None
+
+        pending.append(reply)
+        pending_size += reply_size
+        if deadline is None:
+            deadline = monotonic() + window
+
+    if pending:
+        send(separator.join(pending))
+
+    if error:
+        raise error
+
+async def coalesce_async(generator, send, window, max_size=MAX_MESSAGE_LENGTH, separator="\n"):
+    """ The asyncio counterpart of :func:`coalesce`
+
+    Steps through ``generator`` in the event loop's default executor and awaits ``send`` with the
+    merged replies.
+
+    :param generator: Generator returned by a command
+
+    :param send: Coroutine function which sends one message
+    """
+
+    loop = asyncio.get_event_loop()
+    finished = object()
+    pending = []
+    pending_size = 0
+    deadline = None
+    next_reply = loop.run_in_executor(None, tracing.bind(next), generator, finished)
+
+    while True:
+        timeout = None if deadline is None else max(0, deadline - loop.time())
+        done, _ = await asyncio.wait([next_reply], timeout=timeout)
+
+        if not done:
+            # The window ended while the command was still working
+            await send(separator.join(pending))
+            pending, pending_size, deadline = [], 0, None
+            continue
+
+        try:
+            reply = next_reply.result()
+        except BaseException:
+            if pending:
+                await send(separator.join(pending))
+            raise
+
+        if reply is finished:
+            break
+
+        reply_size = _size(reply) + _size(separator)
+        if pending and pending_size + reply_size > max_size:
+            await send(separator.join(pending))
+            pending, pending_size, deadline = [], 0, None
+
+        pending.append(reply)
+        pending_size += reply_size
+        if deadline is None:
+            deadline = loop.time() + window
+
+        next_reply = loop.run_in_executor(None, tracing.bind(next), generator, finished)
+
+    if pending:
+        await send(separator.join(pending))
@@ -12,24 +12,79 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from threading import Thread
+import asyncio
+import functools
 import hmac
 import hashlib
 import json
 from random import SystemRandom
 import string
+from time import monotonic
 import falcon
 from ciscosparkapi import CiscoSparkAPI
+from .exceptions import QueueFull
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+
+# Number of bytes of a webhook body read at a time
+CHUNK_SIZE = 16384
+
+def decode_json(raw):
+    """Parses a webhook body, given as bytes, into whatever JSON value it contains
+
+    The body is decoded before it is parsed since ``json.loads`` only accepts bytes from Python
+    3.6. Invalid UTF-8 raises ``UnicodeDecodeError``, which is a ``ValueError``.
+    """
+
+    return json.loads(raw.decode("utf-8"))
+
+class _WebhookBody(object):
+    """Collects a webhook body as it is read, computing its HMAC along the way"""
+
+    def __init__(self, secret, expected_digest, max_size):
+        self.expected_digest = expected_digest
+        self.max_size = max_size
+        self.size = 0
+        self._chunks = []
+        self._digest = hmac.new(secret, digestmod=hashlib.sha1) if secret else None
+
+    def feed(self, chunk):
+        """Adds the next chunk of the body. Returns False if the body is now too large."""
+
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            return False
+
+        if self._digest:
+            self._digest.update(chunk)
+        self._chunks.append(chunk)
+        return True
+
+    def signature_matches(self):
+        """Returns whether the body matches the signature header, or True if there's no secret"""
+
+        if not self._digest:
+            return True
+        # Compared as bytes, since a forged header may contain characters that aren't ASCII
+        return hmac.compare_digest(self._digest.hexdigest().encode("utf-8"),
+                                   self.expected_digest.encode("utf-8"))
+
+    def read(self):
+        return b"".join(self._chunks)
 
 class ReceiverResource(object):
 
     def __init__(self, bot):
         self.bot = bot
-        self.me = self.bot.spark_api.people.me()
+        self.me = self.bot.me
 
     def on_post(self, req, resp):
         """Receives messages and passes them to the sparkbot instance in BOT_INSTANCE"""
 
+        with self.bot.tracer.trace("webhook") as span:
+            self._receive(req, resp)
+            span.set("status", str(resp.status))
+
+    def _receive(self, req, resp):
         resp.status = falcon.HTTP_204
 
         if not self.bot:
@@ -41,40 +96,278 @@ class ReceiverResource(object):
             resp.body = "Missing command"
             return
 
-        raw_response_body = req.bounded_stream.read()
-        json_data = json.loads(raw_response_body.decode("utf-8"))
+        stage_seconds = self.bot.metrics.receiver_seconds
+        started = monotonic()
 
-        if self.bot.webhook_secret:
+        body = self._start_body(req, resp)
+        if body is None:
+            return
 
-            try:
-                # Get the HMAC of the incoming message
-                expected_digest = req.get_header("X-SPARK-SIGNATURE")
-            except KeyError:
-                # We expected but didn't receive a signature. Don't process any further.
-                resp.status = falcon.HTTP_403
+        while True:
+            chunk = req.bounded_stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if not body.feed(chunk):
+                self._reject_malformed(resp, falcon.HTTP_413)
                 return
+        started = stage_seconds.observe_since(started, "read")
 
-            real_digest = hmac.new(self.bot.webhook_secret, msg=raw_response_body, digestmod=hashlib.sha1)
-            if not hmac.compare_digest(real_digest.hexdigest(), expected_digest):
-                # The received signature doesn't match the one we expect.
-                resp.status = falcon.HTTP_403
-                return
+        json_data = self._validate(body, req, resp)
+        started = stage_seconds.observe_since(started, "validate")
+        if json_data is None:
+            return
+
+        try:
+            self._submit(json_data, resp, started)
+        except BaseException:
+            # The webhook wasn't accepted, so Webex Teams' next delivery of it mustn't be dropped
+            self.bot.seen_webhooks.discard(json_data["data"]["id"])
+            raise
+
+    def _submit(self, json_data, resp, started):
+        stage_seconds = self.bot.metrics.receiver_seconds
+
+        journal = self.bot.journal
+        if journal:
+            self.bot.replay_journal()
+            entry_id = journal.append(json_data)
+            started = stage_seconds.observe_since(started, "journal")
+
+        try:
+            # Commands for the same room can be run in order by an OrderedWorkerPool
+            if journal:
+                self.bot.submit_journaled(entry_id, json_data)
+            else:
+                self.bot.executor.submit_ordered(json_data["data"]["roomId"],
+                                                 self.bot.commandworker, json_data)
+        except BaseException as error:
+            if journal:
+                # Webex Teams will send it again, so it mustn't be replayed as well
+                journal.complete(entry_id)
+            if not isinstance(error, QueueFull):
+                raise
+            # Every worker is busy and the queue is full. Ask Webex Teams to try again later.
+            self.bot.seen_webhooks.discard(json_data["data"]["id"])
+            self.bot.metrics.overloaded.inc()
+            resp.status = falcon.HTTP_503
+            resp.set_header("Retry-After", str(self.bot.executor.retry_after))
+
+        stage_seconds.observe_since(started, "submit")
+
+    def _start_body(self, req, resp):
+        """Checks a webhook's headers before its body is read
+
+        :returns: A :class:`_WebhookBody` to read the body into, or None if the request was
+                  rejected, in which case ``resp.status`` is set accordingly.
+        """
+
+        if req.content_length > self.bot.max_body_size:
+            self._reject_malformed(resp, falcon.HTTP_413)
+            return None
+
+        # Get the HMAC of the incoming message
+        expected_digest = req.get_header("X-SPARK-SIGNATURE")
+        if self.bot.webhook_secret and not expected_digest:
+            # We expected but didn't receive a signature. Don't process any further.
+            self.bot.metrics.rejected.inc()
+            resp.status = falcon.HTTP_403
+            return None
+
+        return _WebhookBody(self.bot.webhook_secret, expected_digest, self.bot.max_body_size)
+
+    def _reject_malformed(self, resp, status):
+        self.bot.metrics.malformed.inc()
+        resp.status = status
+
+    def _validate(self, body, req, resp):
+        """Checks the signature and sender of a webhook body, and whether it was already received
+
+        The signature is checked before the body is parsed, so forged requests cost as little as
+        possible.
+
+        :param body: :class:`_WebhookBody` which the whole body has been read into
+
+        :returns: The parsed body as a dict if the bot should process it, otherwise None. If the
+                  request was rejected, ``resp.status`` is set accordingly.
+        """
+
+        if not body.signature_matches():
+            # The received signature doesn't match the one we expect.
+            self.bot.metrics.rejected.inc()
+            resp.status = falcon.HTTP_403
+            return None
+
+        try:
+            json_data = self.bot.json_decoder(body.read())
+        except ValueError:
+            self._reject_malformed(resp, falcon.HTTP_400)
+            return None
+
+        if not isinstance(json_data, dict):
+            self._reject_malformed(resp, falcon.HTTP_400)
+            return None
+
+        # Membership events only keep the bot's membership index current, whoever caused them
+        if json_data.get("resource") == "memberships":
+            self.bot.membership_index.handle_event(json_data)
+            return None
 
         # Loop prevention
         message_person_id = json_data["actorId"]
         if message_person_id == self.me.id:
             # Message was sent by me (bot); do not respond.
+            self.bot.metrics.self_messages.inc()
+            return None
+
+        # Webex Teams delivers a webhook again if it isn't answered in time. The command is already
+        # running, so don't run it twice.
+        if not self.bot.seen_webhooks.add(json_data["data"]["id"]):
+            self.bot.metrics.duplicates.inc()
+            return None
+
+        return json_data
+
+class AsyncReceiverResource(ReceiverResource):
+    """Receives webhooks in an ASGI app and runs :func:`SparkBot.async_commandworker` for them on
+    the server's event loop
+
+    Like :class:`sparkbot.executor.OrderedWorkerPool`, the commands for each room run one at a
+    time, in the order their webhooks arrived, while different rooms run concurrently."""
+
+    def __init__(self, bot):
+        super().__init__(bot)
+        # Keep a reference to running commands so that they aren't garbage collected
+        self._tasks = set()
+        # The last task started for each room, which the room's next command waits for
+        self._room_tails = {}
+
+    async def on_post(self, req, resp):
+        """Receives messages and schedules them on the event loop"""
+
+        with self.bot.tracer.trace("webhook") as span:
+            await self._receive_async(req, resp)
+            span.set("status", str(resp.status))
+
+    async def _receive_async(self, req, resp):
+        resp.status = falcon.HTTP_204
+
+        if not self.bot:
+            resp.status = falcon.HTTP_500
+            return
+
+        if not req.content_length:
+            resp.status = falcon.HTTP_400
+            resp.text = "Missing command"
+            return
+
+        stage_seconds = self.bot.metrics.receiver_seconds
+        started = monotonic()
+
+        body = self._start_body(req, resp)
+        if body is None:
             return
 
-        bot_thread = Thread(target=self.bot.commandworker, args=(json_data,))
-        bot_thread.start()
+        while True:
+            chunk = await req.bounded_stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if not body.feed(chunk):
+                self._reject_malformed(resp, falcon.HTTP_413)
+                return
+        started = stage_seconds.observe_since(started, "read")
 
-        return
+        json_data = self._validate(body, req, resp)
+        started = stage_seconds.observe_since(started, "validate")
+        if json_data is None:
+            return
+
+        try:
+            await self._submit_async(json_data, started)
+        except BaseException:
+            # The webhook wasn't accepted, so Webex Teams' next delivery of it mustn't be dropped
+            self.bot.seen_webhooks.discard(json_data["data"]["id"])
+            raise
+
+    async def _submit_async(self, json_data, started):
+        stage_seconds = self.bot.metrics.receiver_seconds
+
+        journal = self.bot.journal
+        if journal:
+            self.bot.replay_journal()
+            # Appending waits for the journal to be written to disk, so keep it off the event loop
+            entry_id = await asyncio.get_event_loop().run_in_executor(None, journal.append,
+                                                                      json_data)
+            started = stage_seconds.observe_since(started, "journal")
+            worker = functools.partial(self.bot.journaled_async_commandworker, entry_id,
+                                       json_data)
+        else:
+            worker = functools.partial(self.bot.async_commandworker, json_data)
+        try:
+            self._schedule(json_data["data"]["roomId"], worker)
+        except BaseException:
+            if journal:
+                # Webex Teams will send it again, so it mustn't be replayed as well
+                journal.complete(entry_id)
+            raise
+        stage_seconds.observe_since(started, "submit")
+
+    def _schedule(self, room_id, worker):
+        """Starts a task which awaits ``worker()`` once every earlier task for ``room_id`` is done
+
+        :returns: The task
+        """
+
+        task = asyncio.ensure_future(self._run_after(self._room_tails.get(room_id), worker))
+        self._room_tails[room_id] = task
+        self._tasks.add(task)
+        task.add_done_callback(functools.partial(self._task_done, room_id))
+        return task
+
+    async def _run_after(self, previous, worker):
+        if previous is not None:
+            # Whatever happened to it is logged by _task_done
+            await asyncio.wait([previous])
+        await worker()
+
+    def _task_done(self, room_id, task):
+        self._tasks.discard(task)
+        if self._room_tails.get(room_id) is task:
+            del self._room_tails[room_id]
+        if not task.cancelled() and task.exception() and self.bot._logger:
+            self.bot._logger.error("Unhandled exception in SparkBot command",
+                                   exc_info=task.exception())
+
+class MetricsResource(object):
+    """Serves the bot's metrics in the Prometheus text format"""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def on_get(self, req, resp):
+        resp.content_type = METRICS_CONTENT_TYPE
+        # resp.data works on every version of falcon, unlike resp.body and resp.text
+        resp.data = self.bot.metrics.render().encode("utf-8")
+
+class AsyncMetricsResource(MetricsResource):
+    """Serves the bot's metrics in the Prometheus text format from an ASGI app"""
+
+    async def on_get(self, req, resp):
+        super().on_get(req, resp)
+
+class _AsyncAPICloser(object):
+    """ASGI middleware that closes the bot's HTTP session when the server shuts down"""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def process_shutdown(self, scope, event):
+        await self.bot.async_api.close()
 
 def create(bot):
     """Creates a falcon.API instance with the required behavior for a SparkBot receiver.
 
-    Currently the API webhook path is hard-coded to ``/sparkbot``
+    Currently the API webhook path is hard-coded to ``/sparkbot``. If the bot has a
+    ``metrics_path``, its metrics are served there.
 
     :param bot: :class:`sparkbot.SparkBot` instance for this API instance to use
     """
@@ -82,6 +375,35 @@ def create(bot):
     api = falcon.API()
     api_behavior = ReceiverResource(bot)
     api.add_route("/sparkbot", api_behavior)
+    if bot.metrics_path:
+        api.add_route(bot.metrics_path, MetricsResource(bot))
+
+    return api
+
+def create_asgi(bot):
+    """Creates a falcon.asgi.App instance with the required behavior for a SparkBot receiver.
+
+    Commands are handled by :func:`SparkBot.async_commandworker` on the ASGI server's event loop
+    rather than by the bot's worker pool. Requires falcon 3 or newer and the ``aiohttp`` package,
+    both of which are installed by ``pip install sparkbot[asgi]``. Serve the result with any ASGI
+    server, for example ``uvicorn run:asgi_receiver``.
+
+    Currently the API webhook path is hard-coded to ``/sparkbot``
+
+    :param bot: :class:`sparkbot.SparkBot` instance for this API instance to use
+    """
+
+    try:
+        import falcon.asgi
+    except ImportError:
+        raise ImportError("The ASGI receiver requires falcon 3 or newer. "
+                          "Install it with `pip install sparkbot[asgi]`.")
+
+    api = falcon.asgi.App(middleware=[_AsyncAPICloser(bot)])
+    api_behavior = AsyncReceiverResource(bot)
+    api.add_route("/sparkbot", api_behavior)
+    if bot.metrics_path:
+        api.add_route(bot.metrics_path, AsyncMetricsResource(bot))
 
     return api
 
@@ -0,0 +1,176 @@
+"""Keeps a bot's commands along with the help text built from them"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import textwrap
+from bisect import bisect_left, insort
+from collections import namedtuple
+from collections.abc import MutableMapping
+from threading import Lock
+from types import MappingProxyType
+
+HELP_ALL_HEADER = "Type `help [command]` for more specific help about any of these commands:"
+
+# Everything readers need, replaced as a whole whenever a command is added or removed
+_Snapshot = namedtuple("_Snapshot", ("commands", "help_texts", "help_all"))
+
+class CommandRegistry(MutableMapping):
+    """ The commands of a bot, by name
+
+    SparkBot keeps its commands in one of these as :attr:`SparkBot.commands`. It behaves like a
+    dict of names to :class:`sparkbot.core.Command`, and also keeps the bot's help up to date as
+    commands are added and removed:
+
+    * The names of each command are grouped together as it is added, so that the help lists
+      each command once with all of its names.
+    * Each command's docstring is dedented once, when it is added, for ``help [command]``.
+    * The ``help all`` text is rebuilt from the groups whenever a name is added or removed.
+
+    Changes are made to a copy under a lock, which then replaces the current commands and help
+    in one step. Reading never waits, so commands can be looked up from any number of worker
+    threads while others are added or removed, and each lookup sees either the old or the new
+    commands, never a mixture.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # The names of each command, in the order they were added
+        self._aliases = {}
+        # Line of the help-all list for each command, and every line in sorted order
+        self._lines = {}
+        self._sorted_lines = []
+        self._snapshot = _Snapshot(MappingProxyType({}), MappingProxyType({}),
+                                   self._render_help_all())
+
+    def add(self, name, command):
+        """ Registers ``command`` under ``name``, replacing any command already there """
+
+        with self._lock:
+            commands = dict(self._snapshot.commands)
+            help_texts = dict(self._snapshot.help_texts)
+
+            replaced = commands.get(name)
+            if replaced is command:
+                return
+            if replaced is not None:
+                self._remove_alias(name, replaced)
+
+            commands[name] = command
+            help_texts[name] = _dedent_doc(command.function.__doc__)
+            self._aliases.setdefault(command, []).append(name)
+            self._update_line(command)
+
+            self._publish(commands, help_texts)
+
+    def remove(self, name):
+        """ Removes the command registered under ``name``
+
+        :returns: The removed command, or None if there was no command called ``name``
+        """
+
+        with self._lock:
+            if name not in self._snapshot.commands:
+                return None
+
+            commands = dict(self._snapshot.commands)
+            help_texts = dict(self._snapshot.help_texts)
+
+            command = commands.pop(name)
+            del help_texts[name]
+            self._remove_alias(name, command)
+
+            self._publish(commands, help_texts)
+            return command
+
+    def _remove_alias(self, name, command):
+        """ Takes ``name`` out of the names of ``command``. Must be called with the lock held. """
+
+        names = self._aliases[command]
+        names.remove(name)
+        if not names:
+            del self._aliases[command]
+        self._update_line(command)
+
+    def _update_line(self, command):
+        """ Replaces the help-all line of ``command`` after its names changed. Must be called with
+        the lock held. """
+
+        old_line = self._lines.pop(command, None)
+        if old_line is not None:
+            del self._sorted_lines[bisect_left(self._sorted_lines, old_line)]
+
+        if command in self._aliases:
+            line = ", ".join(sorted(self._aliases[command]))
+            self._lines[command] = line
+            insort(self._sorted_lines, line)
+
+    def _render_help_all(self):
+        return "\n - ".join([HELP_ALL_HEADER] + self._sorted_lines)
+
+    def _publish(self, commands, help_texts):
+        self._snapshot = _Snapshot(MappingProxyType(commands), MappingProxyType(help_texts),
+                                   self._render_help_all())
+
+    @property
+    def snapshot(self):
+        """ A read-only mapping of the commands as they are right now. It doesn't change when
+        commands are added or removed later. """
+        return self._snapshot.commands
+
+    def help_text(self, name):
+        """ Returns the dedented docstring of the command called ``name``, or None if it has none
+
+        :raises KeyError: There is no command called ``name``
+        """
+        return self._snapshot.help_texts[name]
+
+    def help_all(self):
+        """ Returns the list of every command for ``help all``, with the names of each command
+        on one line """
+        return self._snapshot.help_all
+
+    def names_of(self, command):
+        """ Returns the names that ``command`` is registered under, in the order they were added """
+
+        with self._lock:
+            return list(self._aliases.get(command, ()))
+
+    def __getitem__(self, name):
+        return self._snapshot.commands[name]
+
+    def get(self, name, default=None):
+        return self._snapshot.commands.get(name, default)
+
+    def __contains__(self, name):
+        return name in self._snapshot.commands
+
+    def __iter__(self):
+        return iter(self._snapshot.commands)
+
+    def __len__(self):
+        return len(self._snapshot.commands)
+
+    def __setitem__(self, name, command):
+        self.add(name, command)
+
+    def __delitem__(self, name):
+        if self.remove(name) is None:
+            raise KeyError(name)
+
+    def __repr__(self):
+        return "CommandRegistry({!r})".format(dict(self._snapshot.commands))
+
+def _dedent_doc(docstring):
+    return textwrap.dedent(docstring) if docstring is not None else None
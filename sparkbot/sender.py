@@ -0,0 +1,298 @@
+"""Sends the bot's messages without exceeding Webex Teams rate limits"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from logging import Logger
+from threading import Condition, Lock
+from time import monotonic, sleep
+from ciscosparkapi import SparkApiError
+from .exceptions import ApiError
+from .transport import as_transport
+from . import tracing
+
+class TokenBucket:
+    """ Allows ``rate`` events per second on average, with bursts of up to ``burst`` events
+
+    :param rate: Number of tokens added to the bucket each second. None means there is no limit
+                 other than :func:`pause`.
+
+    :param burst: Number of tokens the bucket holds when full
+    """
+
+    def __init__(self, rate, burst):
+        if rate is not None and (rate <= 0 or burst < 1):
+            raise ValueError("rate must be positive or None and burst must be at least 1")
+
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = monotonic()
+        self._paused_until = 0
+        self._lock = Lock()
+
+    def reserve(self):
+        """ Takes a token and returns the number of seconds to wait before using it """
+
+        with self._lock:
+            now = monotonic()
+            if self.rate is None:
+                return max(0, self._paused_until - now)
+
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+
+            return max(0, -self._tokens / self.rate, self._paused_until - now)
+
+    def pause(self, seconds):
+        """ Makes every reservation wait until ``seconds`` from now, as for a ``Retry-After`` """
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+    def idle(self):
+        """ True if the bucket has refilled, meaning it holds no state worth keeping """
+
+        with self._lock:
+            now = monotonic()
+            if self.rate is None:
+                return self._paused_until <= now
+            return (self._tokens + (now - self._updated) * self.rate >= self.burst
+                    and self._paused_until <= now)
+
+class _Room:
+    """ The queue of messages waiting to be sent to one room """
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.condition = Condition()
+        self.next_ticket = 0
+        self.serving = 0
+        self.async_lock = None
+        # Number of sends which have looked the room up and not finished. Only guarded by the
+        # sender's lock, so that a room can't be forgotten between being looked up and used.
+        self.holders = 0
+
+def _retry_after(error):
+    """ Returns the number of seconds to wait if ``error`` is a rate limit response, else None """
+
+    if isinstance(error, ApiError):
+        status = error.status
+        retry_after = error.retry_after
+    else:
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None)
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+
+    if status != 429:
+        return None
+
+    try:
+        return max(1, int(retry_after))
+    except (TypeError, ValueError):
+        return 15
+
+class MessageSender:
+    """ Sends messages through a global token bucket and one token bucket per room
+
+    Every message the bot sends goes through :func:`send` (or :func:`send_async`), which waits for
+    a token from both buckets so that bursts of replies are smoothed out instead of being rejected
+    by Webex Teams. Messages to the same room are sent in the order they were given to the sender.
+
+    If Webex Teams still responds with ``429 Too Many Requests``, the sender waits for the number
+    of seconds in the ``Retry-After`` header, holds back every other message for the same time,
+    and tries again up to ``max_retries`` times.
+
+    :param spark_api: CiscoSparkAPI or :class:`sparkbot.transport.Transport` to send messages
+                      with
+
+    :param rate: Messages per second the bot may send across all rooms. None for no limit, such as
+                 for a :class:`sparkbot.transport.InMemoryTransport`.
+
+    :param burst: Messages the bot may send at once across all rooms
+
+    :param room_rate: Messages per second the bot may send to a single room. None for no limit.
+
+    :param room_burst: Messages the bot may send at once to a single room
+
+    :param max_retries: Number of times to retry a message which was rate limited
+
+    :param logger: Logger that rate limit warnings will be output to
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, spark_api, rate=20, burst=40, room_rate=2, room_burst=5, max_retries=3,
+                 logger=None):
+
+        if logger and not isinstance(logger, Logger):
+            raise TypeError("logger is not of type logging.Logger")
+
+        self.spark_api = spark_api
+        self._transport = as_transport(spark_api)
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.max_retries = max_retries
+        self.logger = logger
+        self.bucket = TokenBucket(rate, burst)
+
+        self._lock = Lock()
+        self._rooms = {}
+
+        self._sent = 0
+        self._rate_limited = 0
+        self._waiting = 0
+        self._queue_latency_total = 0
+        self._queue_latency_max = 0
+
+    def _enter_room(self, room_id):
+        """ Returns the state of ``room_id``, forgetting rooms which have gone idle
+
+        The caller holds the room until it calls :func:`_leave_room`, and a held room is never
+        forgotten, so every send to a room shares its queue and bucket.
+        """
+
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                if len(self._rooms) >= 1024:
+                    self._forget_idle_rooms()
+                room = self._rooms[room_id] = _Room(self.room_rate, self.room_burst)
+            room.holders += 1
+            self._waiting += 1
+            return room
+
+    def _leave_room(self, room):
+        with self._lock:
+            room.holders -= 1
+            self._waiting -= 1
+
+    def _forget_idle_rooms(self):
+        """ Must be called with the lock held """
+
+        for room_id, room in list(self._rooms.items()):
+            if not room.holders and room.bucket.idle():
+                del self._rooms[room_id]
+
+    def _record(self, queued_at):
+        with self._lock:
+            latency = monotonic() - queued_at
+            self._sent += 1
+            self._queue_latency_total += latency
+            self._queue_latency_max = max(self._queue_latency_max, latency)
+
+    def _rate_limited_by(self, error):
+        """ Returns the seconds to wait before retrying after ``error``, pausing every room """
+
+        retry_after = _retry_after(error)
+        if retry_after is None:
+            return None
+
+        with self._lock:
+            self._rate_limited += 1
+        self.bucket.pause(retry_after)
+        if self.logger:
+            self.logger.warning("Rate limited by Webex Teams, waiting %s seconds", retry_after)
+
+        return retry_after
+
+    def send(self, room_id, markdown):
+        """ Sends ``markdown`` to the room ``room_id``, waiting for its turn
+
+        :raises: Any error from the API, once retries have been used up
+        """
+
+        with tracing.span("reply", room_id=room_id):
+            return self._send(room_id, markdown)
+
+    def _send(self, room_id, markdown):
+        queued_at = monotonic()
+        room = self._enter_room(room_id)
+
+        with room.condition:
+            ticket = room.next_ticket
+            room.next_ticket += 1
+            room.condition.wait_for(lambda: room.serving == ticket)
+
+        try:
+            for attempt in range(self.max_retries + 1):
+                sleep(max(self.bucket.reserve(), room.bucket.reserve()))
+                if attempt == 0:
+                    self._record(queued_at)
+
+                try:
+                    return self._transport.create_message(room_id, markdown)
+                except (SparkApiError, ApiError) as error:
+                    retry_after = self._rate_limited_by(error)
+                    if retry_after is None or attempt == self.max_retries:
+                        raise
+                    sleep(retry_after)
+        finally:
+            with room.condition:
+                room.serving += 1
+                room.condition.notify_all()
+            self._leave_room(room)
+
+    async def send_async(self, room_id, markdown, create_message):
+        """ The asyncio counterpart of :func:`send`
+
+        :param create_message: Coroutine function which takes a room ID and markdown and sends it,
+                               such as :func:`sparkbot.asyncapi.AsyncSparkAPI.create_message`
+        """
+
+        with tracing.span("reply", room_id=room_id):
+            return await self._send_async(room_id, markdown, create_message)
+
+    async def _send_async(self, room_id, markdown, create_message):
+        queued_at = monotonic()
+        room = self._enter_room(room_id)
+        if room.async_lock is None:
+            # asyncio.Lock wakes its waiters in order, which keeps the room in order
+            room.async_lock = asyncio.Lock()
+
+        try:
+            async with room.async_lock:
+                for attempt in range(self.max_retries + 1):
+                    await asyncio.sleep(max(self.bucket.reserve(), room.bucket.reserve()))
+                    if attempt == 0:
+                        self._record(queued_at)
+
+                    try:
+                        return await create_message(room_id, markdown)
+                    except ApiError as error:
+                        retry_after = self._rate_limited_by(error)
+                        if retry_after is None or attempt == self.max_retries:
+                            raise
+                        await asyncio.sleep(retry_after)
+        finally:
+            self._leave_room(room)
+
+    def stats(self):
+        """ Returns a snapshot of this sender's counters as a dict
+
+        Queue latency is the time from a message being given to the sender until it was first
+        handed to the API, in seconds.
+        """
+
+        with self._lock:
+            return {
+                "sent": self._sent,
+                "waiting": self._waiting,
+                "rate_limited": self._rate_limited,
+                "rooms": len(self._rooms),
+                "queue_latency_avg": (self._queue_latency_total / self._sent
+                                      if self._sent else 0),
+                "queue_latency_max": self._queue_latency_max,
+            }
@@ -0,0 +1,265 @@
+"""Traces of the work SparkBot does for each webhook, from receipt to the last reply"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+from binascii import hexlify
+from functools import partial
+from os import urandom
+from threading import Lock, local
+from time import monotonic, time
+
+try:
+    from contextvars import ContextVar, copy_context
+except ImportError:
+    # Python 3.6 and older. Spans are followed within a thread and into WorkerPools, but not
+    # between asyncio tasks.
+    ContextVar = None
+
+if ContextVar:
+    _current = ContextVar("sparkbot_span", default=None)
+
+    def current_span():
+        """ Returns the :class:`Span` that is in progress, or None """
+        return _current.get()
+
+    def _set_current(span):
+        return _current.set(span)
+
+    def _reset_current(token):
+        _current.reset(token)
+
+    def bind(function):
+        """ Returns a function which calls ``function`` with the current span, for handing work
+        to another thread. Call the result only once. """
+        return partial(copy_context().run, function)
+else:
+    _local = local()
+
+    def current_span():
+        """ Returns the :class:`Span` that is in progress, or None """
+        return getattr(_local, "span", None)
+
+    def _set_current(span):
+        token = current_span()
+        _local.span = span
+        return token
+
+    def _reset_current(token):
+        _local.span = token
+
+    def bind(function):
+        """ Returns a function which calls ``function`` with the current span, for handing work
+        to another thread. Call the result only once. """
+        span = current_span()
+
+        def bound(*args, **kwargs):
+            token = _set_current(span)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _reset_current(token)
+
+        return bound
+
+def _new_id(length):
+    return hexlify(urandom(length)).decode()
+
+def current_trace_id():
+    """ Returns the ID of the trace in progress, or None """
+
+    span = current_span()
+    return span.trace_id if span else None
+
+class Span:
+    """ One timed operation within a trace
+
+    Spans are created with :func:`Tracer.trace` and :func:`span` rather than directly.
+
+    :ivar trace_id: ID shared by every span started for the same webhook
+
+    :ivar span_id: ID of this span
+
+    :ivar parent_id: ID of the span this one was started in, or None
+
+    :ivar name: What the span timed, such as ``"command"``
+
+    :ivar start: Time the span started, in seconds since the epoch
+
+    :ivar duration: Number of seconds the span took, once it has ended
+
+    :ivar attributes: dict of details about the operation
+
+    :ivar error: Name of the exception the operation raised, if any
+    """
+
+    __slots__ = ("tracer", "trace_id", "span_id", "parent_id", "name", "start", "duration",
+                 "attributes", "error", "_started", "_token")
+
+    def __init__(self, tracer, trace_id, parent_id, name, attributes):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = None
+        self.duration = None
+        self.error = None
+
+    def set(self, key, value):
+        """ Adds an attribute to this span """
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start = time()
+        self._started = monotonic()
+        self._token = _set_current(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = monotonic() - self._started
+        _reset_current(self._token)
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self.tracer._export(self)
+
+    def to_dict(self):
+        """ Returns this span as a dict which can be serialized as JSON """
+
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+class _NoSpan:
+    """ Stands in for a span when there is no trace in progress """
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+def span(name, **attributes):
+    """ Returns a context manager which times its block as a child of the current span
+
+    If no trace is in progress, for example while SparkBot is starting up, this does nothing.
+
+    :param name: What the block does, such as ``"webex_api"``
+
+    :param attributes: Details about the operation to record with the span
+    """
+
+    parent = current_span()
+    if parent is None:
+        return _NO_SPAN
+    return Span(parent.tracer, parent.trace_id, parent.span_id, name, attributes)
+
+class JSONLinesExporter:
+    """ Appends every finished span to a file as one line of JSON
+
+    :param path: Path of the file to append to
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._file = None
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class Tracer:
+    """ Starts a trace for each webhook and hands finished spans to an exporter
+
+    SparkBot starts a trace when a webhook arrives. The trace follows the webhook to the worker
+    thread, and every Webex Teams API request, the command and each reply made for it are
+    recorded as spans.
+
+    :param exporter: Where finished spans are sent. A str is the path of a file to append them to
+                     as JSON lines (see :class:`JSONLinesExporter`). Otherwise, any object with an
+                     ``export(span)`` method. None assigns trace IDs, so that they can be logged,
+                     without recording spans.
+
+    :param logger: Logger that errors from the exporter will be output to
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, exporter=None, logger=None):
+        if isinstance(exporter, str):
+            exporter = JSONLinesExporter(exporter)
+        elif exporter is not None and not callable(getattr(exporter, "export", None)):
+            raise TypeError("exporter is not a path or an object with an export method")
+
+        if logger and not isinstance(logger, logging.Logger):
+            raise TypeError("logger is not of type logging.Logger")
+
+        self.exporter = exporter
+        self.logger = logger
+
+    def trace(self, name, trace_id=None, **attributes):
+        """ Returns a :class:`Span` which starts a new trace when it is entered
+
+        :param name: What the trace is for, such as ``"webhook"``
+
+        :param trace_id: ID to give the trace. A random one is made if this is not given.
+        """
+        return Span(self, trace_id or _new_id(16), None, name, attributes)
+
+    def _export(self, span):
+        if self.exporter is None:
+            return
+
+        try:
+            self.exporter.export(span)
+        except Exception:
+            # A broken exporter should never stop a command
+            if self.logger:
+                self.logger.exception("Unable to export trace span")
+
+class TraceIdFilter(logging.Filter):
+    """ Adds the ID of the current trace to log records as ``trace_id``, or ``-`` outside a trace
+
+    SparkBot adds one to its logger, so ``%(trace_id)s`` can be used in its log format.
+    """
+
+    def filter(self, record):
+        record.trace_id = current_trace_id() or "-"
+        return True
@@ -0,0 +1,335 @@
+"""The interface SparkBot uses to talk to Webex Teams, and implementations of it"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from itertools import count
+from threading import Lock
+from ciscosparkapi import (CiscoSparkAPI, Membership, Message, Person, Room, TeamMembership,
+                           Webhook)
+from .asyncapi import AsyncSparkAPI
+from .exceptions import ApiError
+
+class Transport:
+    """ Every request SparkBot, its receiver and :mod:`sparkbot.commandhelpers` make to Webex Teams
+
+    Methods return the same ``ciscosparkapi`` models that CiscoSparkAPI does, so commands can't
+    tell which transport is in use. Subclasses must implement every method.
+
+    :cvar rate_limited: Whether the service behind this transport limits how fast messages may be
+                        sent. If it doesn't, SparkBot's default sender doesn't either.
+    """
+
+    rate_limited = True
+
+    def me(self):
+        """ Returns the ciscosparkapi.Person of the bot account """
+        raise NotImplementedError
+
+    def get_person(self, person_id):
+        """ Returns the ciscosparkapi.Person with the ID ``person_id`` """
+        raise NotImplementedError
+
+    def list_people(self, email):
+        """ Returns an iterable of every ciscosparkapi.Person with the e-mail address ``email`` """
+        raise NotImplementedError
+
+    def get_room(self, room_id):
+        """ Returns the ciscosparkapi.Room with the ID ``room_id`` """
+        raise NotImplementedError
+
+    def get_message(self, message_id):
+        """ Returns the ciscosparkapi.Message with the ID ``message_id`` """
+        raise NotImplementedError
+
+    def create_message(self, room_id, markdown):
+        """ Sends ``markdown`` to the room ``room_id`` and returns the ciscosparkapi.Message """
+        raise NotImplementedError
+
+    def list_memberships(self, room_id, person_id=None):
+        """ Returns an iterable of the ciscosparkapi.Membership of each person in ``room_id``, or
+        only of ``person_id`` if it is given """
+        raise NotImplementedError
+
+    def list_team_memberships(self, team_id):
+        """ Returns an iterable of the ciscosparkapi.TeamMembership of each person in ``team_id`` """
+        raise NotImplementedError
+
+    def list_webhooks(self):
+        """ Returns an iterable of the bot's ciscosparkapi.Webhook """
+        raise NotImplementedError
+
+    def create_webhook(self, name, target_url, resource, event, secret=None):
+        """ Creates a webhook and returns its ciscosparkapi.Webhook """
+        raise NotImplementedError
+
+    def delete_webhook(self, webhook_id):
+        """ Deletes the webhook with the ID ``webhook_id`` """
+        raise NotImplementedError
+
+    def async_api(self, pool=None):
+        """ Returns an object with the coroutine methods of :class:`sparkbot.asyncapi.AsyncSparkAPI`
+        for the ASGI receiver to use
+
+        :param pool: :class:`sparkbot.connectionpool.ConnectionPool` for it to use, if it makes
+                     HTTP requests
+        """
+        raise NotImplementedError
+
+class SparkAPITransport(Transport):
+    """ Makes requests to Webex Teams with a CiscoSparkAPI
+
+    :param spark_api: CiscoSparkAPI instance
+    """
+
+    def __init__(self, spark_api):
+        self.spark_api = spark_api
+
+    def me(self):
+        return self.spark_api.people.me()
+
+    def get_person(self, person_id):
+        return self.spark_api.people.get(person_id)
+
+    def list_people(self, email):
+        return self.spark_api.people.list(email=email)
+
+    def get_room(self, room_id):
+        return self.spark_api.rooms.get(room_id)
+
+    def get_message(self, message_id):
+        return self.spark_api.messages.get(message_id)
+
+    def create_message(self, room_id, markdown):
+        return self.spark_api.messages.create(room_id, markdown=markdown)
+
+    def list_memberships(self, room_id, person_id=None):
+        if person_id:
+            return self.spark_api.memberships.list(roomId=room_id, personId=person_id)
+        return self.spark_api.memberships.list(roomId=room_id)
+
+    def list_team_memberships(self, team_id):
+        return self.spark_api.team_memberships.list(team_id)
+
+    def list_webhooks(self):
+        return self.spark_api.webhooks.list()
+
+    def create_webhook(self, name, target_url, resource, event, secret=None):
+        return self.spark_api.webhooks.create(name, target_url, resource, event, secret=secret)
+
+    def delete_webhook(self, webhook_id):
+        self.spark_api.webhooks.delete(webhook_id)
+
+    def async_api(self, pool=None):
+        return AsyncSparkAPI.from_spark_api(self.spark_api, pool=pool)
+
+def as_transport(api):
+    """ Returns ``api`` if it is a :class:`Transport`, or a :class:`SparkAPITransport` for it if it
+    is a CiscoSparkAPI
+
+    :raises TypeError: ``api`` is neither
+    """
+
+    if isinstance(api, Transport):
+        return api
+    if isinstance(api, CiscoSparkAPI):
+        return SparkAPITransport(api)
+    raise TypeError("api is not of type ciscosparkapi.CiscoSparkAPI or "
+                    "sparkbot.transport.Transport")
+
+class _AsyncInMemoryAPI:
+    """ The coroutine methods of AsyncSparkAPI, answered by an :class:`InMemoryTransport` """
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    async def get_message(self, message_id):
+        return self._transport.get_message(message_id)
+
+    async def get_person(self, person_id):
+        return self._transport.get_person(person_id)
+
+    async def get_room(self, room_id):
+        return self._transport.get_room(room_id)
+
+    async def create_message(self, room_id, markdown):
+        return self._transport.create_message(room_id, markdown)
+
+    async def close(self):
+        pass
+
+class InMemoryTransport(Transport):
+    """ Serves people, rooms and messages from dicts and records the messages the bot sends
+
+    Nothing leaves the process, so a bot made with one starts instantly and runs a command in
+    microseconds, which makes it useful for testing commands::
+
+        transport = InMemoryTransport()
+        bot = SparkBot(transport)
+
+        @bot.command("ping")
+        def ping():
+            return "pong"
+
+        transport.add_person("alice", "alice@example.com")
+        bot.commandworker(transport.new_message("ping", person_id="alice"))
+        assert transport.sent[-1].markdown == "pong"
+
+    Looking up something that hasn't been added raises :class:`sparkbot.exceptions.ApiError`
+    with a ``status`` of 404.
+
+    :param bot_id: ID of the bot account
+
+    :param bot_name: Display name of the bot account
+
+    :ivar sent: list of every ciscosparkapi.Message the bot has sent, oldest first
+    """
+
+    rate_limited = False
+
+    def __init__(self, bot_id="bot", bot_name="Bot"):
+        self._lock = Lock()
+        self._ids = count(1)
+        self.bot_id = bot_id
+        self.people = {}
+        self.rooms = {}
+        self.messages = {}
+        self.memberships = []
+        self.team_memberships = []
+        self.webhooks = {}
+        self.sent = []
+
+        self.add_person(bot_id, "bot@sparkbot.io", display_name=bot_name, type="bot")
+
+    def _new_id(self, kind):
+        return "{}-{}".format(kind, next(self._ids))
+
+    def _find(self, items, item_id, kind):
+        try:
+            return items[item_id]
+        except KeyError:
+            raise ApiError("No {} with ID {}".format(kind, item_id), status=404)
+
+    def add_person(self, person_id, email, display_name=None, **fields):
+        """ Adds a person and returns their ciscosparkapi.Person. Other ``fields``, such as
+        ``firstName`` or ``orgId``, are stored as given. """
+
+        data = dict(fields, id=person_id, emails=[email],
+                    displayName=display_name or email.split("@")[0])
+        data.setdefault("type", "person")
+        person = Person(data)
+        with self._lock:
+            self.people[person_id] = person
+        return person
+
+    def add_room(self, room_id, room_type="direct", **fields):
+        """ Adds a room and returns its ciscosparkapi.Room """
+
+        room = Room(dict(fields, id=room_id, type=room_type))
+        with self._lock:
+            self.rooms[room_id] = room
+        return room
+
+    def add_membership(self, room_id, person_id):
+        """ Adds ``person_id`` to the room ``room_id`` """
+
+        membership = Membership({"id": self._new_id("membership"), "roomId": room_id,
+                                 "personId": person_id})
+        with self._lock:
+            self.memberships.append(membership)
+        return membership
+
+    def add_team_membership(self, team_id, person_id):
+        """ Adds ``person_id`` to the team ``team_id`` """
+
+        membership = TeamMembership({"id": self._new_id("teammembership"), "teamId": team_id,
+                                     "personId": person_id})
+        with self._lock:
+            self.team_memberships.append(membership)
+        return membership
+
+    def new_message(self, text, person_id, room_id="room", room_type="direct", **fields):
+        """ Stores a message as if ``person_id`` had sent it, creating the room if needed. Other
+        ``fields``, such as ``html`` or ``mentionedPeople``, are stored on the message as given.
+
+        :returns: The webhook event for the message as a dict, ready to be passed to
+                  :func:`SparkBot.commandworker`
+        """
+
+        if room_id not in self.rooms:
+            self.add_room(room_id, room_type=room_type)
+
+        message = Message(dict(fields, id=self._new_id("message"), roomId=room_id,
+                               roomType=room_type, personId=person_id, text=text))
+        with self._lock:
+            self.messages[message.id] = message
+
+        return {"id": "webhook", "resource": "messages", "event": "created",
+                "actorId": person_id,
+                "data": {"id": message.id, "roomId": room_id, "roomType": room_type,
+                         "personId": person_id}}
+
+    def me(self):
+        return self.people[self.bot_id]
+
+    def get_person(self, person_id):
+        return self._find(self.people, person_id, "person")
+
+    def list_people(self, email):
+        with self._lock:
+            return [person for person in self.people.values() if email in person.emails]
+
+    def get_room(self, room_id):
+        return self._find(self.rooms, room_id, "room")
+
+    def get_message(self, message_id):
+        return self._find(self.messages, message_id, "message")
+
+    def create_message(self, room_id, markdown):
+        message = Message({"id": self._new_id("message"), "roomId": room_id,
+                           "personId": self.bot_id, "markdown": markdown, "text": markdown})
+        with self._lock:
+            self.messages[message.id] = message
+            self.sent.append(message)
+        return message
+
+    def list_memberships(self, room_id, person_id=None):
+        with self._lock:
+            return [membership for membership in self.memberships
+                    if membership.roomId == room_id
+                    and (person_id is None or membership.personId == person_id)]
+
+    def list_team_memberships(self, team_id):
+        with self._lock:
+            return [membership for membership in self.team_memberships
+                    if membership.teamId == team_id]
+
+    def list_webhooks(self):
+        with self._lock:
+            return list(self.webhooks.values())
+
+    def create_webhook(self, name, target_url, resource, event, secret=None):
+        webhook = Webhook({"id": self._new_id("webhook"), "name": name, "targetUrl": target_url,
+                           "resource": resource, "event": event, "secret": secret})
+        with self._lock:
+            self.webhooks[webhook.id] = webhook
+        return webhook
+
+    def delete_webhook(self, webhook_id):
+        with self._lock:
+            self._find(self.webhooks, webhook_id, "webhook")
+            del self.webhooks[webhook_id]
+
+    def async_api(self, pool=None):
+        return _AsyncInMemoryAPI(self)
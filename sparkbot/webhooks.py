@@ -0,0 +1,169 @@
+"""Lets several processes serve one bot by agreeing on its webhook secret and registration"""
+
+# Copyright 2018 Dalton Durst
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import hmac
+from os import path
+from tempfile import gettempdir
+from time import time
+from .executor import WorkerPool
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where every process registers the webhooks itself
+    fcntl = None
+
+def derive_secret(access_token, root_url):
+    """ Returns a webhook secret which every process with the same access token and URL agrees on
+
+    The secret is an HMAC of ``root_url`` keyed with the access token, so it can't be worked out
+    without the token.
+
+    :param access_token: The bot's Webex Teams access token
+    :type access_token: str
+
+    :param root_url: The base URL of the bot's receiver
+    :type root_url: str
+
+    :returns: bytes
+    """
+
+    digest = hmac.new(access_token.encode("utf-8"),
+                      msg="sparkbot webhook secret {}".format(root_url).encode("utf-8"),
+                      digestmod=hashlib.sha256)
+    return digest.hexdigest().encode("utf-8")
+
+def reconcile(transport, desired, secret, workers=8):
+    """ Makes the bot account's webhooks match ``desired`` without removing any it still needs
+
+    Webhooks which already match one in ``desired``, including its secret, are kept. Missing ones
+    are created before anything is deleted, so that the bot always has a webhook. Every other
+    webhook is then deleted, up to ``workers`` at a time.
+
+    :param transport: :class:`sparkbot.transport.Transport` to make requests with
+
+    :param desired: The webhooks to have, as a list of ``(name, target URL, resource, event)``
+    :type desired: list
+
+    :param secret: Secret of the desired webhooks
+    :type secret: bytes
+
+    :param workers: Maximum number of webhooks to delete at once
+    :type workers: int
+
+    :returns: A dict with the number of webhooks ``kept``, ``created`` and ``deleted``
+    """
+
+    secret = secret.decode()
+    missing = list(desired)
+    stale = []
+
+    for webhook in transport.list_webhooks():
+        found = (webhook.name, webhook.targetUrl, webhook.resource, webhook.event)
+        # Webex Teams disables webhooks whose target keeps failing, so those are replaced
+        if (found in missing and webhook.secret == secret and not webhook.filter
+                and webhook.status != "inactive"):
+            missing.remove(found)
+        else:
+            stale.append(webhook)
+
+    for name, target_url, resource, event in missing:
+        transport.create_webhook(name, target_url, resource, event, secret=secret)
+
+    if stale:
+        pool = WorkerPool(workers=min(workers, len(stale)), queue_size=len(stale))
+        try:
+            deletions = [pool.submit(transport.delete_webhook, webhook.id) for webhook in stale]
+            for deletion in deletions:
+                deletion.result()
+        finally:
+            pool.shutdown(wait=False)
+
+    return {"kept": len(desired) - len(missing), "created": len(missing), "deleted": len(stale)}
+
+class RegistrationLease:
+    """ Makes sure only one of the processes serving a bot registers its webhooks
+
+    Every gunicorn worker creates its own SparkBot. Without a lease, each of them would replace the
+    bot's webhooks as it started. With one, the first process to start registers them and records
+    when it did in ``path``. Processes starting at the same time wait for it, and any process
+    starting within ``duration`` seconds of it skips registration, as long as it would register
+    the same webhooks.
+
+    The processes must share ``path``, so it has to be on a local filesystem which all of them can
+    see. Locking uses ``fcntl``, so on platforms without it every process registers the webhooks.
+
+    :param path: Path of the lock file. It is created if it does not exist.
+    :type path: str
+
+    :param duration: Number of seconds after a registration during which other processes skip it
+    :type duration: float
+    """
+
+    def __init__(self, path, duration=60):
+        self.path = path
+        self.duration = duration
+
+    @classmethod
+    def for_url(cls, root_url, duration=60):
+        """ Returns a lease in the temporary directory for the bot served at ``root_url`` """
+
+        name = hashlib.sha256(root_url.encode("utf-8")).hexdigest()[:16]
+        return cls(path.join(gettempdir(), "sparkbot-webhooks-{}.lock".format(name)), duration)
+
+    def run_once(self, key, function):
+        """ Calls ``function`` unless a process sharing this lease already did for ``key`` within
+        ``duration`` seconds
+
+        :param key: Identifies what ``function`` registers. A different key is always registered.
+        :type key: str
+
+        :param function: Registers the webhooks. If it raises, the registration isn't recorded,
+                         so the next process to start tries again.
+
+        :returns: True if ``function`` was called, False if it was skipped
+        """
+
+        if not fcntl:
+            function()
+            return True
+
+        with open(self.path, "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                lock_file.seek(0)
+                if self._is_recent(lock_file.read(), key):
+                    return False
+
+                function()
+
+                lock_file.seek(0)
+                lock_file.truncate()
+                lock_file.write("{} {}".format(key, time()))
+                lock_file.flush()
+                return True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _is_recent(self, recorded, key):
+        """ Returns whether the lock file's contents record ``key`` within ``duration`` """
+
+        try:
+            recorded_key, recorded_at = recorded.split()
+            return recorded_key == key and time() - float(recorded_at) < self.duration
+        except ValueError:
+            return False
@@ -0,0 +1,32 @@
+"""Async generator commands for test_all.py, which must still parse on Python 3.5"""
+
+import asyncio
+
+def add_commands(bot, calls):
+    """ Adds ``count``, which yields three replies, and ``status``, which is cached and records
+    each call in ``calls`` """
+
+    @bot.command("count")
+    async def count():
+        for number in range(3):
+            await asyncio.sleep(0)
+            yield str(number)
+
+    @bot.command("status", cache_ttl=60)
+    async def status():
+        calls.append(1)
+        yield "up"
+
+def add_slow_generator(bot, cancelled):
+    """ Adds ``ticks``, which times out during its second reply and records its cancellation in
+    ``cancelled`` """
+
+    @bot.command("ticks", timeout=0.2, max_concurrency=1)
+    async def ticks():
+        yield "tick"
+        try:
+            await asyncio.sleep(3)
+        except asyncio.CancelledError:
+            cancelled.append("ticks")
+            raise
+        yield "too late"
@@ -1,5 +1,6 @@
 import pytest
 import subprocess
+import sys
 import server
 from random import SystemRandom
 import string
@@ -11,7 +12,40 @@ from sparkbot.exceptions import CommandSetupError
 from wsgiref import simple_server
 import requests
 from requests.exceptions import ConnectionError
-from ciscosparkapi import CiscoSparkAPI
+from ciscosparkapi import CiscoSparkAPI, Message, Person
+
+def mocked_spark_api(bot_name="Bot"):
+    """ Returns a mock CiscoSparkAPI that SparkBot can be created with, without any network """
+
+    spark_api = mock.MagicMock(spec=CiscoSparkAPI)
+    for endpoint in ["people", "rooms", "messages", "memberships", "team_memberships", "webhooks"]:
+        setattr(spark_api, endpoint, mock.MagicMock())
+    spark_api.people.me.return_value = Person({"id": "botid", "displayName": bot_name})
+
+    return spark_api
+
+def signed_webhook(bot, payload):
+    """ Returns the body and headers for a webhook POST that will pass ``bot``'s HMAC check """
+    import hmac
+    import hashlib
+    import json
+
+    body = json.dumps(payload).encode()
+    signature = hmac.new(bot.webhook_secret, msg=body, digestmod=hashlib.sha1).hexdigest()
+
+    return body, {"X-Spark-Signature": signature}
+
+def in_memory_bot(*people, transport=None, **kwargs):
+    """ Returns a SparkBot on an InMemoryTransport, along with the transport, which knows a person
+    for each of the given names. Other keyword arguments are passed to SparkBot. """
+    from sparkbot.transport import InMemoryTransport
+
+    if transport is None:
+        transport = InMemoryTransport()
+    for name in people:
+        transport.add_person(name, "{}@example.com".format(name), firstName=name.title())
+
+    return SparkBot(transport, **kwargs), transport
 
 class TestAPI:
 
@@ -674,3 +708,1964 @@ class TestAPI:
             @bot.command([bot, "stuff"])
             def ping():
                 return "pong"
+
+class TestWorkerPool:
+
+    def blocked_pool(self, **kwargs):
+        """ Returns a WorkerPool with one worker that is stuck until the returned Event is set """
+        from threading import Event
+        from sparkbot.executor import WorkerPool
+
+        release = Event()
+        started = Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        pool = WorkerPool(workers=1, queue_size=1, **kwargs)
+        pool.submit(block)
+        started.wait()
+
+        return pool, release
+
+    def test_runs_work(self):
+        """Tests that submitted work is run and its result returned"""
+        from sparkbot.executor import WorkerPool
+
+        pool = WorkerPool(workers=2)
+
+        assert pool.submit(lambda x: x * 2, 21).result(timeout=5) == 42
+
+        pool.shutdown()
+        assert pool.stats()["completed"] == 1
+
+    def test_reject_when_full(self):
+        """Tests that the default policy raises QueueFull once the queue is full"""
+        from sparkbot.exceptions import QueueFull
+
+        pool, release = self.blocked_pool()
+        pool.submit(lambda: None)
+
+        with pytest.raises(QueueFull):
+            pool.submit(lambda: None)
+
+        release.set()
+        pool.shutdown()
+
+        stats = pool.stats()
+        assert stats["rejected"] == 1
+        assert stats["saturated"] == 1
+        assert stats["completed"] == 2
+
+    def test_drop_oldest(self):
+        """Tests that the drop_oldest policy discards the longest waiting item"""
+
+        pool, release = self.blocked_pool(full_policy="drop_oldest")
+        oldest = pool.submit(lambda: "old")
+        newest = pool.submit(lambda: "new")
+
+        release.set()
+
+        assert newest.result(timeout=5) == "new"
+        assert oldest.cancelled()
+        pool.shutdown()
+        assert pool.stats()["dropped"] == 1
+
+class TestAsyncReceiver:
+
+    def test_async_command(self):
+        """Tests that the ASGI receiver runs a command and replies through the async API"""
+        import asyncio
+        pytest.importorskip("aiohttp")
+        pytest.importorskip("falcon.asgi")
+        from falcon.testing import ASGIConductor
+
+        bot = SparkBot(mocked_spark_api())
+        sent = []
+
+        class FakeAsyncAPI:
+            async def get_message(self, message_id):
+                return Message({"id": message_id, "text": "Bot ping", "personId": "personid"})
+
+            async def get_person(self, person_id):
+                return Person({"id": person_id, "emails": ["person@example.com"]})
+
+            async def create_message(self, room_id, markdown):
+                sent.append((room_id, markdown))
+
+            async def close(self):
+                pass
+
+        bot._async_api = FakeAsyncAPI()
+
+        @bot.command("ping")
+        def ping():
+            yield "pong"
+            yield "pong again"
+
+        body, headers = signed_webhook(bot, {"actorId": "personid",
+                                             "data": {"id": "messageid", "roomId": "roomid"}})
+
+        async def post_webhook():
+            async with ASGIConductor(receiver.create_asgi(bot)) as conductor:
+                result = await conductor.simulate_post("/sparkbot", body=body, headers=headers)
+                for _ in range(50):
+                    if len(sent) == 2:
+                        break
+                    await asyncio.sleep(0.05)
+                return result
+
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(post_webhook())
+        finally:
+            loop.close()
+
+        assert result.status_code == 204
+        assert sent == [("roomid", "pong"), ("roomid", "pong again")]
+
+    def test_commands_run_in_order_per_room(self):
+        """Tests that the ASGI receiver runs each room's commands in order and rooms at once"""
+        import asyncio
+        from sparkbot.transport import InMemoryTransport
+
+        bot = SparkBot(InMemoryTransport())
+        resource = receiver.AsyncReceiverResource(bot)
+        events = []
+
+        def worker(room_id, number, delay):
+            async def run():
+                events.append(("start", room_id, number))
+                await asyncio.sleep(delay)
+                events.append(("end", room_id, number))
+                if number == 1:
+                    raise ValueError("A failed command doesn't stop the next one")
+            return run
+
+        async def schedule():
+            tasks = [resource._schedule("a", worker("a", 1, 0.05)),
+                     resource._schedule("a", worker("a", 2, 0)),
+                     resource._schedule("b", worker("b", 1, 0))]
+            await asyncio.wait(tasks)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(schedule())
+        finally:
+            loop.close()
+
+        room_a = [event for event in events if event[1] == "a"]
+        assert room_a == [("start", "a", 1), ("end", "a", 1), ("start", "a", 2), ("end", "a", 2)]
+        # Room b didn't wait for room a
+        assert events.index(("end", "b", 1)) < events.index(("end", "a", 1))
+        assert resource._room_tails == {}
+        assert resource._tasks == set()
+
+class TestTTLCache:
+
+    def test_hit_and_miss(self):
+        """Tests that a cached value is only loaded once while it is fresh"""
+        from sparkbot.cache import TTLCache
+
+        cache = TTLCache(ttl=60)
+        loader = mock.MagicMock(return_value="person")
+
+        assert cache.get("id", loader) == "person"
+        assert cache.get("id", loader) == "person"
+
+        loader.assert_called_once_with("id")
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+
+    def test_lru_eviction(self):
+        """Tests that the least recently used entry is evicted when the cache is full"""
+        from sparkbot.cache import TTLCache
+
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a", lambda key: None)
+        cache.put("c", 3)
+
+        assert cache.peek("b") is None
+        assert cache.peek("a") == 1
+        assert cache.stats()["evictions"] == 1
+
+    def test_single_flight(self):
+        """Tests that concurrent misses for the same key share one load"""
+        from threading import Event, Thread
+        from sparkbot.cache import TTLCache
+
+        cache = TTLCache(ttl=60)
+        release = Event()
+        loader = mock.MagicMock(side_effect=lambda key: release.wait() and "person")
+        results = []
+
+        threads = [Thread(target=lambda: results.append(cache.get("id", loader)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+
+        while cache.stats()["coalesced"] < 4:
+            sleep(0.01)
+        release.set()
+
+        for thread in threads:
+            thread.join()
+
+        assert results == ["person"] * 5
+        loader.assert_called_once_with("id")
+
+    def test_stale_while_revalidate(self):
+        """Tests that a stale value is returned while a fresh one is loaded in the background"""
+        from sparkbot.cache import TTLCache
+
+        cache = TTLCache(ttl=0.05, stale_ttl=60)
+        cache.put("id", "old")
+        sleep(0.1)
+
+        assert cache.get("id", lambda key: "new") == "old"
+
+        for _ in range(100):
+            if cache.peek("id") == "new":
+                break
+            sleep(0.01)
+
+        assert cache.peek("id") == "new"
+        assert cache.stats()["stale_hits"] == 1
+
+    def test_stale_refreshes_are_bounded(self):
+        """Tests that refreshes run on the refresh pool and are skipped when it is full"""
+        from threading import Event
+        from sparkbot.cache import TTLCache
+        from sparkbot.executor import WorkerPool
+
+        release = Event()
+        pool = WorkerPool(workers=1, queue_size=1)
+        cache = TTLCache(ttl=0.05, stale_ttl=60, refresh_pool=pool)
+        for number in range(10):
+            cache.put(number, "old")
+        sleep(0.1)
+
+        def slow_load(key):
+            release.wait(5)
+            return "new"
+
+        assert cache.get(0, slow_load) == "old"
+        while pool.queue_depth:
+            sleep(0.01)
+        assert [cache.get(number, slow_load) for number in range(1, 10)] == ["old"] * 9
+        # One refresh is running and one is queued. The rest were skipped.
+        assert cache.stats()["skipped_refreshes"] == 8
+
+        release.set()
+        while pool.stats()["completed"] < 2:
+            sleep(0.01)
+        assert cache.get(0, slow_load) == "new"
+        assert cache.get(1, slow_load) == "new"
+        assert cache.get(2, slow_load) == "old"
+
+        with pytest.raises(TypeError):
+            TTLCache(refresh_pool="pool")
+
+class TestCommandHelpers:
+
+    def test_is_group_from_event(self):
+        """Tests that is_group uses the room type in the webhook event instead of asking Spark"""
+        from ciscosparkapi import Webhook
+        from sparkbot import commandhelpers
+
+        spark_api = mocked_spark_api()
+        event = Webhook({"data": {"roomId": "roomid", "roomType": "group"}})
+
+        assert commandhelpers.is_group(spark_api, "roomid", event=event)
+        assert not spark_api.rooms.get.called
+
+    def test_is_group_cached(self):
+        """Tests that is_group only looks a room up once when given a cache"""
+        from ciscosparkapi import Room
+        from sparkbot import commandhelpers
+        from sparkbot.cache import TTLCache
+
+        spark_api = mocked_spark_api()
+        spark_api.rooms.get.return_value = Room({"id": "roomid", "type": "direct"})
+        cache = TTLCache()
+        other_room_event = {"data": {"roomId": "otherroom", "roomType": "group"}}
+
+        assert not commandhelpers.is_group(spark_api, "roomid", cache=cache)
+        assert not commandhelpers.is_group(spark_api, "roomid", event=other_room_event,
+                                           cache=cache)
+        spark_api.rooms.get.assert_called_once_with("roomid")
+
+class TestMembershipIndex:
+
+    def memberships(self, *person_ids):
+        from ciscosparkapi import Membership
+        return [Membership({"personId": person_id}) for person_id in person_ids]
+
+    def test_check_if_in_team(self):
+        """Tests that a team's memberships are only listed once when using the index"""
+        from sparkbot import commandhelpers
+        from sparkbot.membership import MembershipIndex
+
+        spark_api = mocked_spark_api()
+        spark_api.team_memberships.list.return_value = self.memberships("alice", "bob")
+        index = MembershipIndex(spark_api)
+
+        assert commandhelpers.check_if_in_team(spark_api, "team", Person({"id": "bob"}),
+                                               index=index)
+        assert not commandhelpers.check_if_in_team(spark_api, "team", Person({"id": "carol"}),
+                                                   index=index)
+        spark_api.team_memberships.list.assert_called_once_with("team")
+
+    def test_room_membership_events(self):
+        """Tests that memberships webhook events update a loaded room"""
+        from sparkbot.membership import MembershipIndex
+
+        spark_api = mocked_spark_api()
+        spark_api.memberships.list.return_value = self.memberships("alice")
+        index = MembershipIndex(spark_api)
+
+        assert index.is_in_room("room", "alice")
+
+        index.handle_event({"resource": "memberships", "event": "created",
+                            "data": {"roomId": "room", "personId": "bob"}})
+        index.handle_event({"resource": "memberships", "event": "deleted",
+                            "data": {"roomId": "room", "personId": "alice"}})
+
+        assert index.is_in_room("room", "bob")
+        assert not index.is_in_room("room", "alice")
+        spark_api.memberships.list.assert_called_once_with(roomId="room")
+
+    def test_no_stale_answers_by_default(self):
+        """Tests that a team member who was removed fails checks once the team is due to reload,
+        unless stale answers are allowed"""
+        from sparkbot.membership import MembershipIndex
+
+        spark_api = mocked_spark_api()
+        spark_api.team_memberships.list.return_value = self.memberships("alice")
+        index = MembershipIndex(spark_api, refresh_interval=60)
+        stale_index = MembershipIndex(spark_api, refresh_interval=60, stale_ttl=60)
+
+        with mock.patch("sparkbot.cache.monotonic", return_value=100):
+            assert index.is_in_team("team", "alice")
+            assert stale_index.is_in_team("team", "alice")
+
+        spark_api.team_memberships.list.return_value = self.memberships()
+        with mock.patch("sparkbot.cache.monotonic", return_value=161):
+            assert not index.is_in_team("team", "alice")
+            # The old members answer while they reload
+            assert stale_index.is_in_team("team", "alice")
+
+    def test_event_during_load(self):
+        """Tests that an event which arrives while a room is loading isn't lost, and that events
+        don't count as hits or misses"""
+        from threading import Event, Thread
+        from sparkbot.membership import MembershipIndex
+
+        listing = Event()
+        release = Event()
+
+        def list_memberships(roomId):
+            listing.set()
+            release.wait(5)
+            # Listed before bob joined
+            return self.memberships("alice")
+
+        spark_api = mocked_spark_api()
+        spark_api.memberships.list.side_effect = list_memberships
+        index = MembershipIndex(spark_api)
+
+        index.handle_event({"resource": "memberships", "event": "created",
+                            "data": {"roomId": "unloaded", "personId": "bob"}})
+        assert index.stats()["misses"] == 0
+
+        checker = Thread(target=index.is_in_room, args=("room", "alice"))
+        checker.start()
+        assert listing.wait(5)
+        index.handle_event({"resource": "memberships", "event": "created",
+                            "data": {"roomId": "room", "personId": "bob"}})
+        release.set()
+        checker.join()
+
+        spark_api.memberships.list.side_effect = None
+        spark_api.memberships.list.return_value = self.memberships("alice", "bob")
+        assert index.is_in_room("room", "bob")
+        assert spark_api.memberships.list.call_count == 2
+
+class TestCommand:
+
+    def test_parameters_bound_once(self):
+        """Tests that a command's signature is inspected when it is created, not when executed"""
+        from sparkbot import Command
+        from sparkbot import core
+
+        def command(room_id, commandline):
+            return (room_id, commandline)
+
+        with mock.patch.object(core, "signature", wraps=core.signature) as wrapped_signature:
+            new_command = Command(command)
+            results = [new_command.execute(commandline=["one"], room_id="roomid",
+                                           caller="caller") for _ in range(3)]
+
+        assert wrapped_signature.call_count == 1
+        assert results == [("roomid", ["one"])] * 3
+
+class TestCommandWorker:
+
+    def slow_spark_api(self, delay):
+        """ Returns a mocked CiscoSparkAPI whose message and person lookups take ``delay`` seconds """
+
+        def get_message(message_id):
+            sleep(delay)
+            return Message({"id": message_id, "text": "ping", "personId": "personid"})
+
+        def get_person(person_id):
+            sleep(delay)
+            return Person({"id": person_id, "emails": ["person@example.com"]})
+
+        spark_api = mocked_spark_api()
+        spark_api.messages.get.side_effect = get_message
+        spark_api.people.get.side_effect = get_person
+
+        return spark_api
+
+    def test_concurrent_fetch(self):
+        """Tests that the message and its sender are fetched at the same time"""
+        from time import monotonic
+
+        spark_api = self.slow_spark_api(0.3)
+        bot = SparkBot(spark_api)
+
+        @bot.command("ping")
+        def ping(caller):
+            return "pong " + caller.id
+
+        start = monotonic()
+        bot.commandworker({"actorId": "personid",
+                           "data": {"id": "messageid", "roomId": "roomid",
+                                    "personId": "personid"}})
+
+        assert monotonic() - start < 0.55
+        spark_api.messages.create.assert_called_once_with("roomid", markdown="pong personid")
+
+    def test_cached_person_skips_fetch(self):
+        """Tests that a cached sender is not fetched again"""
+
+        spark_api = self.slow_spark_api(0)
+        bot = SparkBot(spark_api)
+        bot.person_cache.put("personid", Person({"id": "personid"}))
+
+        bot.commandworker({"actorId": "personid",
+                           "data": {"id": "messageid", "roomId": "roomid",
+                                    "personId": "personid"}})
+
+        assert not spark_api.people.get.called
+
+class TestOutput:
+
+    def test_split_markdown_lines(self):
+        """Tests that long messages are split between lines and fit in the limit"""
+        from sparkbot.output import split_markdown
+
+        markdown = "\n".join(["line {}".format(number) for number in range(100)])
+        chunks = split_markdown(markdown, limit=100)
+
+        assert all(len(chunk.encode()) <= 100 for chunk in chunks)
+        assert "\n".join(chunks) == markdown
+
+    def test_split_markdown_code_fence(self):
+        """Tests that a code block split across messages is closed and reopened"""
+        from sparkbot.output import split_markdown
+
+        markdown = "```python\n" + "\n".join(["x = {}".format(number) for number in range(100)]) + "\n```"
+        chunks = split_markdown(markdown, limit=200)
+
+        assert len(chunks) > 1
+        for chunk in chunks:
+            assert chunk.startswith("```python\n")
+            assert chunk.endswith("\n```")
+            assert len(chunk.encode()) <= 200
+
+    def test_split_markdown_small_limits(self):
+        """Tests that small limits are rejected and wide characters don't stop long lines
+        splitting"""
+        from sparkbot.output import split_markdown
+
+        with pytest.raises(ValueError):
+            split_markdown("a" * 200, limit=50)
+
+        # Each emoji is 4 bytes, more than the 2 bytes left after the code block allowance
+        markdown = "\U0001F600" * 30
+        chunks = split_markdown(markdown, limit=66)
+        # Pieces of a line which was split are put on lines of their own
+        assert "".join(chunks).replace("\n", "") == markdown
+        assert all(len(chunk.encode()) <= 66 for chunk in chunks)
+
+    def test_coalesce(self):
+        """Tests that replies yielded close together are merged and slow ones are not"""
+        from sparkbot.output import coalesce
+
+        def replies():
+            yield "one"
+            yield "two"
+            sleep(0.3)
+            yield "three"
+
+        sent = []
+        coalesce(replies(), sent.append, window=0.1)
+
+        assert sent == ["one\ntwo", "three"]
+
+    def test_coalesce_command(self):
+        """Tests that a command's coalesce_window is used when it yields"""
+
+        spark_api = mocked_spark_api()
+        spark_api.messages.get.return_value = Message({"id": "messageid", "text": "lines",
+                                                       "personId": "personid"})
+        bot = SparkBot(spark_api)
+
+        @bot.command("lines", coalesce_window=5)
+        def lines():
+            for number in range(200):
+                yield str(number)
+
+        bot.commandworker({"actorId": "personid",
+                           "data": {"id": "messageid", "roomId": "roomid"}})
+
+        spark_api.messages.create.assert_called_once_with(
+            "roomid", markdown="\n".join(str(number) for number in range(200)))
+
+class TestMessageSender:
+
+    def test_token_bucket(self):
+        """Tests that a token bucket allows a burst and then spaces out reservations"""
+        from sparkbot.sender import TokenBucket
+
+        bucket = TokenBucket(rate=10, burst=2)
+        waits = [bucket.reserve() for _ in range(4)]
+
+        assert waits[0] == waits[1] == 0
+        assert 0.05 < waits[2] <= 0.1
+        assert 0.15 < waits[3] <= 0.2
+
+    def test_retry_after(self):
+        """Tests that a rate limited message is retried after the Retry-After period"""
+        from ciscosparkapi import SparkApiError
+        from sparkbot import sender
+
+        rate_limited = SparkApiError.__new__(SparkApiError)
+        rate_limited.response = mock.Mock(status_code=429, headers={"Retry-After": "7"})
+
+        spark_api = mocked_spark_api()
+        spark_api.messages.create.side_effect = [rate_limited, "message"]
+        message_sender = sender.MessageSender(spark_api)
+
+        with mock.patch.object(sender, "sleep") as fake_sleep:
+            assert message_sender.send("roomid", "hello") == "message"
+
+        fake_sleep.assert_any_call(7)
+        assert spark_api.messages.create.call_count == 2
+        assert message_sender.stats()["rate_limited"] == 1
+
+    def test_room_order(self):
+        """Tests that messages to one room are sent in the order they were given"""
+        from threading import Thread
+        from sparkbot.sender import MessageSender
+
+        spark_api = mocked_spark_api()
+        sent = []
+        spark_api.messages.create.side_effect = lambda room_id, markdown: sent.append(markdown)
+        message_sender = MessageSender(spark_api, room_rate=100, room_burst=1)
+
+        threads = []
+        for number in range(20):
+            thread = Thread(target=message_sender.send, args=("roomid", str(number)))
+            thread.start()
+            threads.append(thread)
+            # Give each thread time to take its place in line
+            sleep(0.005)
+
+        for thread in threads:
+            thread.join()
+
+        assert sent == [str(number) for number in range(20)]
+        assert message_sender.stats()["sent"] == 20
+
+    def test_held_room_is_not_forgotten(self):
+        """Tests that a room which was looked up for a send survives idle rooms being forgotten"""
+        from sparkbot.sender import MessageSender
+        from sparkbot.transport import InMemoryTransport
+
+        message_sender = MessageSender(InMemoryTransport(), rate=None, room_rate=None)
+        held = message_sender._enter_room("held")
+
+        for number in range(1024):
+            message_sender.send("room-{}".format(number), "hello")
+
+        assert message_sender._enter_room("held") is held
+        message_sender._leave_room(held)
+        message_sender._leave_room(held)
+        assert message_sender.stats()["rooms"] < 1024
+        assert message_sender.stats()["waiting"] == 0
+
+class TestConnectionPool:
+
+    @pytest.fixture
+    def local_api(self):
+        """ Returns a CiscoSparkAPI pointed at a local server which answers every GET with a
+        person after a delay, given as the path's last segment in seconds. The API's
+        ``client_ports`` is the set of ports the server has been connected to from. """
+        import json
+        from threading import Thread
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+
+        client_ports = set()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                client_ports.add(self.client_address[1])
+                sleep(float(self.path.rsplit("/", 1)[-1]))
+                body = json.dumps({"id": "personid", "displayName": "Person"}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        server = Server(("127.0.0.1", 0), Handler)
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        api = CiscoSparkAPI("token", base_url="http://127.0.0.1:{}/".format(server.server_port))
+        api.client_ports = client_ports
+        yield api
+
+        server.shutdown()
+        server.server_close()
+
+    def test_reuses_connections(self, local_api):
+        """Tests that requests through a mounted pool share one kept-alive connection"""
+        from sparkbot.connectionpool import ConnectionPool
+
+        pool = ConnectionPool()
+        assert pool.mount(local_api)
+
+        for _ in range(5):
+            local_api.people.get("0")
+
+        stats = pool.stats()
+        assert stats["requests"] == 5
+        assert stats["opened"] == 1
+        assert len(local_api.client_ports) == 1
+        assert stats["idle"] == 1
+        assert stats["in_flight"] == 0
+
+    def test_no_keep_alive(self, local_api):
+        """Tests that keep_alive=False opens a connection for every request"""
+        from sparkbot.connectionpool import ConnectionPool
+
+        pool = ConnectionPool(keep_alive=False)
+        pool.mount(local_api)
+
+        for _ in range(3):
+            local_api.people.get("0")
+
+        assert len(local_api.client_ports) == 3
+
+    def test_read_timeout(self, local_api):
+        """Tests that the pool's read timeout applies to requests"""
+        from requests.exceptions import ReadTimeout
+        from sparkbot.connectionpool import ConnectionPool
+
+        ConnectionPool(read_timeout=0.1).mount(local_api)
+
+        with pytest.raises(ReadTimeout):
+            local_api.people.get("0.5")
+
+    def test_max_connections(self, local_api):
+        """Tests that max_connections limits the number of requests in progress at once"""
+        from threading import Thread
+        from sparkbot.connectionpool import ConnectionPool
+
+        pool = ConnectionPool(max_connections=2)
+        pool.mount(local_api)
+
+        threads = [Thread(target=local_api.people.get, args=("0.1",)) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = pool.stats()
+        assert stats["max_in_flight"] == 2
+        assert stats["waited"] >= 1
+
+    def test_traced_request(self, local_api):
+        """Tests that requests made during a trace are recorded as spans"""
+        from sparkbot.connectionpool import ConnectionPool
+        from sparkbot.tracing import Tracer
+
+        spans = []
+        tracer = Tracer(mock.Mock(export=spans.append))
+        ConnectionPool().mount(local_api)
+
+        local_api.people.get("0")
+        with tracer.trace("webhook"):
+            local_api.people.get("0")
+
+        assert [span.name for span in spans] == ["webex_api", "webhook"]
+        assert spans[0].trace_id == spans[1].trace_id
+        assert spans[0].parent_id == spans[1].span_id
+        assert spans[0].attributes == {"method": "GET", "path": "/people/0", "status": 200}
+
+    def test_bot_mounts_pool(self):
+        """Tests that SparkBot applies its connection pool to the API it is given"""
+        from sparkbot.connectionpool import ConnectionPool
+
+        pool = ConnectionPool()
+        with mock.patch.object(pool, "mount") as mount:
+            bot = SparkBot(mocked_spark_api(), connection_pool=pool)
+
+        mount.assert_called_once_with(bot.spark_api)
+        assert not ConnectionPool().mount(mocked_spark_api())
+
+        with pytest.raises(TypeError):
+            SparkBot(mocked_spark_api(), connection_pool="pool")
+
+class TestMetrics:
+
+    def test_histogram_render(self):
+        """Tests that a histogram renders cumulative buckets, a sum and a count"""
+        from sparkbot.metrics import Histogram
+
+        histogram = Histogram("test_seconds", "Test.", ["stage"], buckets=(0.1, 1))
+        histogram.observe(0.05, "fetch")
+        histogram.observe(0.1, "fetch")
+        histogram.observe(5, "fetch")
+
+        assert histogram.render() == [
+            "# HELP test_seconds Test.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{stage="fetch",le="0.1"} 2',
+            'test_seconds_bucket{stage="fetch",le="1.0"} 2',
+            'test_seconds_bucket{stage="fetch",le="+Inf"} 3',
+            'test_seconds_sum{stage="fetch"} 5.15',
+            'test_seconds_count{stage="fetch"} 3',
+        ]
+
+    def test_command_counters(self):
+        """Tests that command exceptions are counted by command and unknown commands separately"""
+
+        spark_api = mocked_spark_api()
+        spark_api.people.get.return_value = Person({"id": "personid",
+                                                    "emails": ["person@example.com"]})
+        bot = SparkBot(spark_api)
+
+        @bot.command(["broken", "alsobroken"])
+        def broken():
+            raise ValueError("Oops")
+
+        for text in ["broken", "alsobroken", "nonexistent"]:
+            spark_api.messages.get.return_value = Message({"id": "messageid", "text": text,
+                                                           "personId": "personid"})
+            bot.commandworker({"actorId": "personid",
+                               "data": {"id": "messageid", "roomId": "roomid"}})
+
+        assert bot.metrics.command_errors.value("broken") == 1
+        assert bot.metrics.command_errors.value("alsobroken") == 1
+        assert bot.metrics.not_found.value() == 1
+        assert bot.metrics.worker_seconds.count("respond") == 3
+
+    def test_metrics_route(self):
+        """Tests that the receiver serves metrics at metrics_path and counts rejected webhooks"""
+        from falcon.testing import TestClient
+
+        bot = SparkBot(mocked_spark_api(), metrics_path="/metrics")
+        client = TestClient(receiver.create(bot))
+
+        body, headers = signed_webhook(bot, {"actorId": "botid", "data": {}})
+        assert client.simulate_post("/sparkbot", body=body, headers=headers).status_code == 204
+        headers["X-Spark-Signature"] = "0" * 40
+        assert client.simulate_post("/sparkbot", body=body, headers=headers).status_code == 403
+
+        result = client.simulate_get("/metrics")
+        assert result.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert "sparkbot_webhooks_rejected_total 1\n" in result.text
+        assert "sparkbot_self_messages_total 1\n" in result.text
+        assert 'sparkbot_receiver_seconds_count{stage="validate"} 2\n' in result.text
+        assert "sparkbot_executor_queue_depth 0\n" in result.text
+
+        assert SparkBot(mocked_spark_api()).metrics_path is None
+        with pytest.raises(TypeError):
+            SparkBot(mocked_spark_api(), metrics_path="metrics")
+
+class TestTracing:
+
+    def test_webhook_trace(self):
+        """Tests that a webhook's trace follows it to the worker, the command and the reply"""
+        from sparkbot.tracing import Tracer
+
+        spans = []
+        spark_api = mocked_spark_api()
+        spark_api.messages.get.return_value = Message({"id": "messageid", "text": "ping",
+                                                       "personId": "personid"})
+        spark_api.people.get.return_value = Person({"id": "personid",
+                                                    "emails": ["person@example.com"]})
+        bot = SparkBot(spark_api, tracer=Tracer(mock.Mock(export=spans.append)))
+
+        @bot.command("ping")
+        def ping():
+            return "pong"
+
+        from falcon.testing import TestClient
+        body, headers = signed_webhook(bot, {"actorId": "personid",
+                                             "data": {"id": "messageid", "roomId": "roomid"}})
+        TestClient(receiver.create(bot)).simulate_post("/sparkbot", body=body, headers=headers)
+
+        for _ in range(50):
+            if any(span.name == "commandworker" for span in spans):
+                break
+            sleep(0.02)
+
+        by_name = {span.name: span for span in spans}
+        assert set(by_name) == {"webhook", "commandworker", "command", "reply"}
+        assert len(set(span.trace_id for span in spans)) == 1
+        assert by_name["webhook"].parent_id is None
+        assert by_name["commandworker"].parent_id == by_name["webhook"].span_id
+        assert by_name["command"].parent_id == by_name["commandworker"].span_id
+        assert by_name["reply"].parent_id == by_name["commandworker"].span_id
+        assert by_name["command"].attributes == {"command": "ping"}
+        assert by_name["webhook"].attributes == {"status": "204 No Content"}
+
+    def test_json_lines_and_logging(self, tmpdir):
+        """Tests that spans are written as JSON lines and log records carry the trace ID"""
+        import json
+        import logging
+        from sparkbot.tracing import Tracer
+
+        records = []
+        logger = logging.getLogger("sparkbot-test-tracing")
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+
+        path = str(tmpdir.join("traces.jsonl"))
+        bot = SparkBot(mocked_spark_api(), logger=logger, tracer=Tracer(path))
+        del records[:]
+
+        with bot.tracer.trace("webhook") as span:
+            logger.warning("inside")
+        logger.warning("outside")
+        bot.tracer.exporter.close()
+
+        with open(path) as trace_file:
+            exported = [json.loads(line) for line in trace_file]
+
+        assert [line["trace_id"] for line in exported] == [span.trace_id]
+        assert [record.trace_id for record in records] == [span.trace_id, "-"]
+
+class TestInMemoryTransport:
+
+    def test_round_trips(self):
+        """Tests that thousands of commands run in-process without a network"""
+        from time import monotonic
+
+        bot, transport = in_memory_bot("alice")
+
+        @bot.command("ping")
+        def ping(caller):
+            return "pong " + caller.firstName
+
+        start = monotonic()
+        for number in range(2000):
+            bot.commandworker(transport.new_message("ping", "alice",
+                                                    room_id="room-{}".format(number % 10)))
+
+        assert monotonic() - start < 2
+        assert len(transport.sent) == 2000
+        assert transport.sent[-1].markdown == "pong Alice"
+        assert transport.sent[-1].roomId == "room-9"
+
+    def test_webhooks_and_helpers(self):
+        """Tests that webhook setup and commandhelpers use the transport"""
+        from sparkbot import commandhelpers
+
+        bot, transport = in_memory_bot("alice", root_url="https://example.com",
+                                       track_memberships=True)
+        transport.add_room("group", room_type="group")
+        transport.add_membership("group", "alice")
+
+        assert sorted(webhook.resource for webhook in transport.list_webhooks()) == \
+            ["memberships", "messages"]
+        assert bot.spark_api is None
+
+        alice = commandhelpers.get_person_by_email(transport, "alice@example.com")
+        assert alice.id == "alice"
+        assert commandhelpers.is_group(transport, "group")
+        assert commandhelpers.check_if_in_room(transport, "group", alice)
+        assert bot.membership_index.is_in_room("group", "alice")
+        with pytest.raises(ValueError):
+            commandhelpers.get_person_by_spark_id(transport, "nobody")
+
+    def test_async_round_trip(self):
+        """Tests that the async command worker uses the transport too"""
+        import asyncio
+
+        bot, transport = in_memory_bot("alice")
+
+        @bot.command("ping")
+        def ping(caller):
+            return "pong " + caller.firstName
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(bot.async_commandworker(transport.new_message("ping",
+                                                                                  "alice")))
+        finally:
+            loop.close()
+
+        assert [message.markdown for message in transport.sent] == ["pong Alice"]
+
+class TestJournal:
+
+    def test_replays_unfinished(self, tmpdir):
+        """Tests that only entries which were never completed are replayed after reopening"""
+        from sparkbot.journal import Journal
+
+        path = str(tmpdir.join("journal.db"))
+        journal = Journal(path)
+        first = journal.append({"data": {"id": "one"}})
+        second = journal.append({"data": {"id": "two"}})
+        journal.complete(first)
+        # A new journal doesn't replay its own entries
+        assert journal.unfinished() == []
+        journal.close()
+
+        reopened = Journal(path)
+        assert reopened.unfinished() == [(second, {"data": {"id": "two"}})]
+        reopened.close()
+
+    def test_shared_file(self, tmpdir):
+        """Tests that journals sharing a file only replay entries whose process has stopped, and
+        that each entry is claimed by one of them"""
+        from sparkbot.journal import Journal
+
+        path = str(tmpdir.join("journal.db"))
+        running = Journal(path)
+        in_flight = running.append({"data": {"id": "running"}})
+
+        # Append an entry from a process which stops without completing it
+        subprocess.run([sys.executable, "-c",
+                        "from sparkbot.journal import Journal; "
+                        "Journal({!r}).append({{'data': {{'id': 'stopped'}}}})".format(path)],
+                       check=True)
+
+        first, second = Journal(path), Journal(path)
+        claimed = first.unfinished()
+        assert [json_data for _, json_data in claimed] == [{"data": {"id": "stopped"}}]
+        assert second.unfinished() == []
+
+        # Once its journal is closed, the entry it never completed can be replayed
+        running.close()
+        assert second.unfinished() == [(in_flight, {"data": {"id": "running"}})]
+        assert first.unfinished() == []
+        first.close()
+        second.close()
+
+    def test_batches_commits(self, tmpdir):
+        """Tests that concurrent appends share commits"""
+        from concurrent.futures import ThreadPoolExecutor
+        from time import time
+        from sparkbot import journal as journal_module
+
+        def slow_time():
+            # Called once per commit, so every commit takes a while, like a slow fsync
+            sleep(0.05)
+            return time()
+
+        journal = journal_module.Journal(str(tmpdir.join("journal.db")), fsync=False)
+        with mock.patch.object(journal_module, "time", slow_time):
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                entry_ids = list(pool.map(lambda number: journal.append({"number": number}),
+                                          range(100)))
+
+        assert len(set(entry_ids)) == 100
+        stats = journal.stats()
+        assert stats["appended"] == 100
+        # Unbatched, this would be 100 commits
+        assert stats["commits"] <= 25
+        journal.close()
+
+    def test_receiver_journals_and_replays(self, tmpdir):
+        """Tests that webhooks acknowledged by a bot which stopped are run by the next one"""
+        from falcon.testing import TestClient
+        from sparkbot.executor import WorkerPool
+        from sparkbot.journal import Journal
+
+        path = str(tmpdir.join("journal.db"))
+
+        # This bot's executor never runs anything, as if the process stopped before it could
+        stalled = WorkerPool(workers=1, queue_size=10)
+        stalled.submit_ordered = mock.Mock()
+        bot, transport = in_memory_bot("alice", executor=stalled, journal=Journal(path))
+        client = TestClient(bot.receiver)
+        for text in ("ping", "ping"):
+            body, headers = signed_webhook(bot, transport.new_message(text, "alice"))
+            assert client.simulate_post("/sparkbot", body=body, headers=headers).status_code == 204
+        assert stalled.submit_ordered.call_count == 2
+        bot.journal.close()
+
+        restarted = SparkBot(transport, journal=Journal(path))
+
+        @restarted.command("ping")
+        def ping():
+            return "pong"
+
+        assert restarted.replay_journal() == 2
+        assert restarted.replay_journal() == 0
+        for _ in range(100):
+            if len(transport.sent) == 2:
+                break
+            sleep(0.05)
+        assert [message.markdown for message in transport.sent] == ["pong", "pong"]
+
+        # Both entries are marked as done, so a third start has nothing to replay
+        restarted.executor.shutdown()
+        restarted.journal.close()
+        assert Journal(path).unfinished() == []
+
+    def test_dropped_webhooks_are_completed(self, tmpdir):
+        """Tests that a webhook which the executor drops to make room isn't replayed"""
+        from threading import Event
+        from sparkbot.executor import DROP_OLDEST, WorkerPool
+        from sparkbot.journal import Journal
+
+        path = str(tmpdir.join("journal.db"))
+        release = Event()
+        bot, transport = in_memory_bot("alice", journal=Journal(path),
+                                       executor=WorkerPool(workers=1, queue_size=1,
+                                                           full_policy=DROP_OLDEST))
+
+        @bot.command("wait")
+        def wait():
+            release.wait(5)
+            return "done"
+
+        webhooks = [transport.new_message("wait", "alice") for _ in range(3)]
+        entry_ids = [bot.journal.append(json_data) for json_data in webhooks]
+        running = bot.submit_journaled(entry_ids[0], webhooks[0])
+        while not running.running():
+            sleep(0.01)
+        dropped = bot.submit_journaled(entry_ids[1], webhooks[1])
+        bot.submit_journaled(entry_ids[2], webhooks[2])
+        assert dropped.cancelled()
+
+        release.set()
+        bot.executor.shutdown()
+        bot.journal.close()
+        assert Journal(path).unfinished() == []
+
+    def test_wrong_type(self):
+        """Tests that journal must be a Journal"""
+        with pytest.raises(TypeError):
+            in_memory_bot(journal="journal.db")
+
+class TestWebhookRegistration:
+
+    def test_secret(self, monkeypatch):
+        """Tests where the webhook secret comes from"""
+        from sparkbot.transport import InMemoryTransport
+        from sparkbot.webhooks import derive_secret
+
+        transport = InMemoryTransport()
+        assert SparkBot(transport, webhook_secret="shared").webhook_secret == b"shared"
+
+        monkeypatch.setenv("WEBHOOK_SECRET", "from-environment")
+        assert SparkBot(transport).webhook_secret == b"from-environment"
+        monkeypatch.delenv("WEBHOOK_SECRET")
+
+        # Without one, every process with the same token and URL derives the same secret
+        assert derive_secret("token", "https://a") == derive_secret("token", "https://a")
+        assert derive_secret("token", "https://a") != derive_secret("token", "https://b")
+        assert derive_secret("token", "https://a") != derive_secret("other", "https://a")
+        assert SparkBot(transport).webhook_secret != SparkBot(transport).webhook_secret
+
+        with pytest.raises(TypeError):
+            SparkBot(transport, webhook_secret=1234)
+
+    def test_registers_once(self, tmpdir):
+        """Tests that only the first of several bots with the same webhooks registers them"""
+        from concurrent.futures import ThreadPoolExecutor
+        import functools
+        from sparkbot.transport import InMemoryTransport
+        from sparkbot.webhooks import RegistrationLease
+
+        transport = InMemoryTransport()
+        transport.create_webhook("stale", "https://old.example.com/sparkbot", "messages",
+                                 "created")
+        transport.create_webhook = mock.Mock(wraps=transport.create_webhook)
+        start_bot = functools.partial(in_memory_bot, transport=transport,
+                                      root_url="https://example.com",
+                                      registration_lease=RegistrationLease(
+                                          str(tmpdir.join("webhooks.lock"))))
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            bots = [bot for bot, _ in pool.map(lambda _: start_bot(webhook_secret="shared"),
+                                               range(4))]
+
+        assert transport.create_webhook.call_count == 1
+        assert [webhook.targetUrl for webhook in transport.list_webhooks()] == \
+            ["https://example.com/sparkbot"]
+        assert len(set(bot.webhook_secret for bot in bots)) == 1
+
+        # Different webhooks are registered even within the lease
+        start_bot(webhook_secret="changed")
+        assert transport.create_webhook.call_count == 2
+
+    def test_failed_registration_is_retried(self, tmpdir):
+        """Tests that a failed registration isn't recorded in the lease"""
+        import functools
+        from sparkbot.transport import InMemoryTransport
+        from sparkbot.webhooks import RegistrationLease
+
+        transport = InMemoryTransport()
+        start_bot = functools.partial(in_memory_bot, transport=transport,
+                                      root_url="https://example.com",
+                                      registration_lease=RegistrationLease(
+                                          str(tmpdir.join("webhooks.lock"))))
+        with mock.patch.object(transport, "create_webhook", side_effect=RuntimeError):
+            with pytest.raises(RuntimeError):
+                start_bot(webhook_secret="shared")
+
+        start_bot(webhook_secret="shared")
+        assert len(transport.list_webhooks()) == 1
+
+    def test_reconcile(self):
+        """Tests that matching webhooks are kept, new ones created first and others deleted"""
+        from sparkbot.transport import InMemoryTransport
+        from sparkbot.webhooks import reconcile
+
+        transport = InMemoryTransport()
+        kept = transport.create_webhook("myBot", "https://example.com/sparkbot", "messages",
+                                        "created", secret="shared")
+        for number in range(20):
+            transport.create_webhook("old", "https://old.example.com/{}".format(number),
+                                     "messages", "created")
+        # Same webhook with a different secret
+        transport.create_webhook("myBot memberships", "https://example.com/sparkbot",
+                                 "memberships", "all", secret="other")
+
+        calls = []
+        create_webhook, delete_webhook = transport.create_webhook, transport.delete_webhook
+
+        def record_create(*args, **kwargs):
+            calls.append("create")
+            return create_webhook(*args, **kwargs)
+
+        def record_delete(webhook_id):
+            calls.append("delete")
+            delete_webhook(webhook_id)
+
+        transport.create_webhook, transport.delete_webhook = record_create, record_delete
+
+        changes = reconcile(transport, [
+            ("myBot", "https://example.com/sparkbot", "messages", "created"),
+            ("myBot memberships", "https://example.com/sparkbot", "memberships", "all"),
+        ], b"shared")
+
+        assert changes == {"kept": 1, "created": 1, "deleted": 21}
+        assert calls == ["create"] + ["delete"] * 21
+        assert sorted(webhook.resource for webhook in transport.list_webhooks()) == \
+            ["memberships", "messages"]
+        assert kept.id in transport.webhooks
+
+    def test_fast_startup(self, tmpdir):
+        """Tests that the bot account is fetched once and startup phases are timed"""
+        import functools
+        from sparkbot.transport import InMemoryTransport
+        from sparkbot.webhooks import RegistrationLease
+
+        transport = InMemoryTransport()
+        transport.me = mock.Mock(wraps=transport.me)
+        start_bot = functools.partial(in_memory_bot, transport=transport,
+                                      root_url="https://example.com",
+                                      registration_lease=RegistrationLease(
+                                          str(tmpdir.join("webhooks.lock"))))
+        bot, _ = start_bot()
+
+        assert transport.me.call_count == 1
+        assert list(bot.startup_seconds) == ["setup", "identity", "receiver", "webhooks"]
+
+        # Restarting with the same secret keeps the webhook
+        transport.create_webhook = mock.Mock(wraps=transport.create_webhook)
+        transport.delete_webhook = mock.Mock(wraps=transport.delete_webhook)
+        bot.registration_lease.duration = 0
+        start_bot(webhook_secret=bot.webhook_secret)
+        assert transport.create_webhook.call_count == 0
+        assert transport.delete_webhook.call_count == 0
+
+class TestSeenSet:
+
+    def test_window_and_maxsize(self):
+        """Tests that keys are remembered for the window and at most maxsize are kept"""
+        from sparkbot.cache import SeenSet
+
+        seen = SeenSet(window=10, maxsize=3)
+        with mock.patch("sparkbot.cache.monotonic", return_value=100):
+            assert seen.add("a")
+            assert not seen.add("a")
+            assert seen.add("b")
+            assert seen.add("c")
+            assert seen.add("d")
+            # "a" was evicted to make room for "d"
+            assert "a" not in seen
+            assert seen.add("a")
+
+        with mock.patch("sparkbot.cache.monotonic", return_value=110):
+            assert seen.add("b")
+            assert len(seen) == 1
+
+        assert seen.stats()["duplicates"] == 1
+        assert seen.stats()["evictions"] == 2
+
+    def test_colliding_hashes(self):
+        """Tests that keys whose hashes share table slots are found, discarded and evicted"""
+        from sparkbot.cache import SeenSet
+
+        seen = SeenSet(maxsize=4)
+        # Every key starts probing at the last slot of the table, so runs wrap around its end
+        mask = len(seen._table) - 1
+        seen._hash = lambda key: (ord(key) << 8) | mask
+
+        for key in "abcd":
+            assert seen.add(key)
+        seen.discard("b")
+        assert "b" not in seen
+        assert all(key in seen for key in "acd")
+
+        # Adding "e" and "b" evicts "a", and the slot "b" was discarded from
+        assert seen.add("e")
+        assert seen.add("b")
+        assert [key in seen for key in "abcde"] == [False, True, True, True, True]
+        assert len(seen) == 4
+        assert seen.stats()["evictions"] == 1
+
+    def test_receiver_drops_redelivery(self):
+        """Tests that a redelivered webhook is acknowledged without running the command again,
+        unless the first delivery was turned away"""
+        from falcon.testing import TestClient
+        from sparkbot.executor import WorkerPool
+        from sparkbot.exceptions import QueueFull
+
+        executor = WorkerPool(workers=1, queue_size=10)
+        executor.submit_ordered = mock.Mock(side_effect=[QueueFull(), None, None])
+        bot, transport = in_memory_bot("alice", executor=executor)
+        client = TestClient(bot.receiver)
+
+        body, headers = signed_webhook(bot, transport.new_message("ping", "alice"))
+        statuses = [client.simulate_post("/sparkbot", body=body, headers=headers).status_code
+                    for _ in range(3)]
+
+        assert statuses == [503, 204, 204]
+        assert executor.submit_ordered.call_count == 2
+        assert bot.metrics.duplicates.value() == 1
+
+    def test_receiver_forgets_failed_delivery(self, tmpdir):
+        """Tests that a webhook which fails after it was marked as seen is run when redelivered"""
+        from falcon.testing import TestClient
+        from sparkbot.executor import WorkerPool
+        from sparkbot.journal import Journal
+
+        executor = WorkerPool(workers=1, queue_size=10)
+        executor.submit_ordered = mock.Mock(side_effect=[RuntimeError("submit failed"), None])
+        bot, transport = in_memory_bot("alice", executor=executor)
+        client = TestClient(bot.receiver)
+
+        body, headers = signed_webhook(bot, transport.new_message("ping", "alice"))
+        statuses = [client.simulate_post("/sparkbot", body=body, headers=headers).status_code
+                    for _ in range(2)]
+
+        assert statuses == [500, 204]
+        assert executor.submit_ordered.call_count == 2
+
+        # The same goes for a journal which can't be written to
+        journal = Journal(str(tmpdir.join("journal.db")))
+        bot, _ = in_memory_bot(transport=transport, journal=journal,
+                               executor=WorkerPool(workers=1, queue_size=10))
+        bot.executor.submit_ordered = mock.Mock()
+        client = TestClient(bot.receiver)
+        body, headers = signed_webhook(bot, transport.new_message("ping", "alice"))
+        with mock.patch.object(journal, "append", side_effect=RuntimeError("database is locked")):
+            assert client.simulate_post("/sparkbot", body=body,
+                                        headers=headers).status_code == 500
+        assert client.simulate_post("/sparkbot", body=body, headers=headers).status_code == 204
+        assert bot.executor.submit_ordered.call_count == 1
+        journal.close()
+
+class TestReceiverBody:
+
+    def test_signature_checked_before_parsing(self):
+        """Tests that forged webhooks are rejected without being parsed"""
+        import json
+        from falcon.testing import TestClient
+
+        decoder = mock.Mock(side_effect=json.loads)
+        bot, transport = in_memory_bot("alice", json_decoder=decoder)
+        bot.executor.submit_ordered = mock.Mock()
+        client = TestClient(bot.receiver)
+        body, headers = signed_webhook(bot, transport.new_message("ping", "alice"))
+
+        # A missing signature used to raise a TypeError, answered with 500
+        assert client.simulate_post("/sparkbot", body=body).status_code == 403
+        assert client.simulate_post("/sparkbot", body=body,
+                                    headers={"X-Spark-Signature": "forged"}).status_code == 403
+        assert client.simulate_post("/sparkbot", body=body,
+                                    headers={"X-Spark-Signature": "förged"}).status_code == 403
+        assert decoder.call_count == 0
+        assert bot.metrics.rejected.value() == 3
+
+        assert client.simulate_post("/sparkbot", body=body, headers=headers).status_code == 204
+        decoder.assert_called_once_with(body)
+        assert bot.executor.submit_ordered.call_count == 1
+
+    def test_large_body(self):
+        """Tests that a body is read in chunks up to max_body_size"""
+        from falcon.testing import TestClient
+        from sparkbot.receiver import CHUNK_SIZE
+
+        bot, transport = in_memory_bot("alice", max_body_size=4 * CHUNK_SIZE)
+        bot.executor.submit_ordered = mock.Mock()
+        client = TestClient(bot.receiver)
+        event = transport.new_message("ping", "alice")
+        event["padding"] = "x" * (3 * CHUNK_SIZE)
+        body, headers = signed_webhook(bot, event)
+        assert client.simulate_post("/sparkbot", body=body, headers=headers).status_code == 204
+
+        event["padding"] = "x" * (4 * CHUNK_SIZE)
+        body, headers = signed_webhook(bot, event)
+        assert client.simulate_post("/sparkbot", body=body, headers=headers).status_code == 413
+        assert bot.metrics.malformed.value() == 1
+
+    def test_invalid_json(self):
+        """Tests that a signed body which isn't a JSON object is rejected with 400"""
+        import hashlib
+        import hmac
+        from falcon.testing import TestClient
+
+        bot, transport = in_memory_bot("alice")
+        client = TestClient(bot.receiver)
+        for body in (b"{not json", b"[1, 2]"):
+            signature = hmac.new(bot.webhook_secret, msg=body, digestmod=hashlib.sha1).hexdigest()
+            assert client.simulate_post("/sparkbot", body=body,
+                                        headers={"X-Spark-Signature": signature}).status_code == 400
+
+        with pytest.raises(TypeError):
+            in_memory_bot(json_decoder="orjson")
+
+    def test_default_decoder(self):
+        """Tests that the default decoder hands json.loads a str, as Python 3.5 requires, and
+        rejects bodies which aren't UTF-8 with 400"""
+        import hashlib
+        import hmac
+        import json
+        from falcon.testing import TestClient
+
+        loads = json.loads
+
+        def loads_str_only(raw):
+            # json.loads on Python 3.5 raises TypeError for bytes
+            if not isinstance(raw, str):
+                raise TypeError("the JSON object must be str, not 'bytes'")
+            return loads(raw)
+
+        bot, transport = in_memory_bot("alice")
+        bot.executor.submit_ordered = mock.Mock()
+        client = TestClient(bot.receiver)
+        with mock.patch("sparkbot.receiver.json.loads", side_effect=loads_str_only):
+            body, headers = signed_webhook(bot, transport.new_message("ping", "alice"))
+            assert client.simulate_post("/sparkbot", body=body, headers=headers).status_code == 204
+            assert bot.executor.submit_ordered.call_count == 1
+
+            body = b'{"text": "\xff"}'
+            signature = hmac.new(bot.webhook_secret, msg=body, digestmod=hashlib.sha1).hexdigest()
+            assert client.simulate_post("/sparkbot", body=body,
+                                        headers={"X-Spark-Signature": signature}).status_code == 400
+        assert bot.metrics.malformed.value() == 1
+
+class TestCommandLine:
+
+    def test_tokenize_matches_shlex(self):
+        """Tests that the fast path gives the same tokens as shlex.split"""
+        import shlex
+        from sparkbot.commandline import tokenize
+
+        texts = ["ping", "  ping   one\ttwo\nthree ", "", "say 'hello world'",
+                 'say "a \\"quoted\\" word"', "back\\ slash", "tabs\x0band\xa0nbsp", "#hash"]
+        cryptogen = SystemRandom()
+        for _ in range(500):
+            texts.append("".join(cryptogen.choice("ab \t\n'\"\\#\xa0") for _ in range(12)))
+
+        for text in texts:
+            try:
+                expected = shlex.split(text)
+            except ValueError:
+                with pytest.raises(ValueError):
+                    tokenize(text)
+            else:
+                assert tokenize(text) == expected, text
+
+    def test_strip_mention(self):
+        """Tests that the bot's mention is removed however it was written"""
+        from sparkbot.commandline import strip_mention
+
+        me = Person({"id": "botid", "displayName": "Helpful Bot"})
+        html = ('<p><spark-mention data-object-type="person" data-object-id="botid">Helpful'
+                '</spark-mention> ping</p>')
+
+        assert strip_mention("Helpful ping", me, html=html, mentioned_people=["botid"]) == " ping"
+        assert strip_mention("Helpful Bot ping", me) == " ping"
+        assert strip_mention("Helpful Bot", me) == ""
+        assert strip_mention("Helpful Botanist", me) == "Helpful Botanist"
+        # Someone else was mentioned
+        assert strip_mention("Helpful ping", me, html=html.replace("botid", "otherid"),
+                             mentioned_people=["otherid"]) == "Helpful ping"
+
+    def test_commandworker_strips_mention(self):
+        """Tests that a command is found after a multi-word mention of the bot"""
+        from sparkbot.transport import InMemoryTransport
+
+        transport = InMemoryTransport(bot_name="Helpful Bot")
+        transport.add_person("alice", "alice@example.com")
+        bot = SparkBot(transport)
+
+        @bot.command("ping")
+        def ping(commandline):
+            return " ".join(commandline)
+
+        html = ('<spark-mention data-object-type="person" data-object-id="bot">Helpful'
+                '</spark-mention> ping "one two"')
+        bot.commandworker(transport.new_message('Helpful ping "one two"', "alice",
+                                                room_type="group", html=html,
+                                                mentionedPeople=["bot"]))
+        bot.commandworker(transport.new_message("Helpful Bot", "alice", room_type="group"))
+
+        assert [message.markdown for message in transport.sent] == \
+            ["ping one two", bot.command_not_found_message]
+
+class TestCommandCache:
+
+    def test_cached_by_key(self):
+        """Tests that replies are cached by the chosen inputs"""
+        bot, transport = in_memory_bot("alice", "bob")
+        calls = []
+
+        @bot.command("status", cache_ttl=60)
+        def status(commandline):
+            calls.append(commandline)
+            return "up " + commandline[-1]
+
+        @bot.command("whoami", cache_ttl=60, cache_key=("caller",))
+        def whoami(caller):
+            calls.append(caller.id)
+            return caller.id
+
+        for person_id in ("alice", "bob"):
+            for text in ("status a", "status a", "status b", "whoami", "whoami"):
+                bot.commandworker(transport.new_message(text, person_id))
+
+        assert calls == [["status", "a"], ["status", "b"], "alice", "bob"]
+        assert [message.markdown for message in transport.sent] == \
+            ["up a", "up a", "up b", "alice", "alice"] + ["up a", "up a", "up b", "bob", "bob"]
+        assert bot.commands["status"].cache.stats()["hits"] == 4
+
+    def test_single_flight_and_generators(self):
+        """Tests that concurrent calls run a generator command once and share its replies"""
+        from concurrent.futures import ThreadPoolExecutor
+        from threading import Event
+
+        bot, transport = in_memory_bot("alice", "bob")
+        started = Event()
+        calls = []
+
+        @bot.command("report", cache_ttl=60)
+        def report():
+            calls.append(1)
+            started.wait(1)
+            yield "part one"
+            yield "part two"
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [pool.submit(bot.commandworker, transport.new_message("report", "alice"))
+                       for _ in range(4)]
+            sleep(0.1)
+            started.set()
+            for future in futures:
+                future.result()
+
+        assert len(calls) == 1
+        assert sorted(message.markdown for message in transport.sent) == \
+            ["part one"] * 4 + ["part two"] * 4
+
+    def test_setup_errors(self):
+        """Tests that callback commands and unknown cache keys are refused"""
+        bot, _ = in_memory_bot("alice", "bob")
+
+        with pytest.raises(CommandSetupError):
+            @bot.command("progress", cache_ttl=60)
+            def progress(callback):
+                pass
+
+        with pytest.raises(CommandSetupError):
+            @bot.command("status", cache_ttl=60, cache_key=("event",))
+            def status():
+                pass
+
+        with pytest.raises(TypeError):
+            @bot.command("status", cache_ttl="1 minute")
+            def other_status():
+                pass
+
+class TestOrderedWorkerPool:
+
+    def test_orders_each_room(self):
+        """Tests that work for one key runs in order, one at a time, while keys run in parallel"""
+        from threading import Lock
+        from sparkbot.executor import OrderedWorkerPool
+
+        pool = OrderedWorkerPool(workers=4, queue_size=1000)
+        lock = Lock()
+        order = {}
+        running = {}
+        overlaps = []
+        peak = [0]
+
+        def work(room, number):
+            with lock:
+                running[room] = running.get(room, 0) + 1
+                overlaps.append(running[room])
+                peak[0] = max(peak[0], sum(running.values()))
+            sleep(0.002 * (number % 3))
+            with lock:
+                running[room] -= 1
+                order.setdefault(room, []).append(number)
+
+        futures = [pool.submit_ordered("room-{}".format(number % 5), work,
+                                       "room-{}".format(number % 5), number)
+                   for number in range(100)]
+        for future in futures:
+            future.result(timeout=10)
+
+        for room, numbers in order.items():
+            assert numbers == sorted(numbers)
+        assert max(overlaps) == 1
+        assert peak[0] > 1
+        # Idle mailboxes are removed
+        assert pool.stats()["mailboxes"] == 0
+        pool.shutdown()
+
+    def test_waiting_counts_towards_queue_size(self):
+        """Tests that work waiting in a mailbox fills the queue, and can't be dropped"""
+        from threading import Event
+        from sparkbot.executor import OrderedWorkerPool
+        from sparkbot.exceptions import QueueFull
+
+        release = Event()
+        pool = OrderedWorkerPool(workers=1, queue_size=2, full_policy="drop_oldest")
+        running = pool.submit_ordered("room", release.wait)
+        while not running.running():
+            sleep(0.01)
+        pool.submit_ordered("room", lambda: None)
+        pool.submit_ordered("room", lambda: None)
+
+        assert pool.queue_depth == 2
+        with pytest.raises(QueueFull):
+            pool.submit_ordered("room", lambda: None)
+
+        release.set()
+        pool.shutdown()
+        assert pool.stats()["completed"] == 3
+        assert pool.stats()["mailboxes"] == 0
+
+class TestCommandLimits:
+
+    def test_timeout_replies_with_error(self):
+        """Tests that a command which runs too long gets an error reply and keeps its slot"""
+        from threading import Event
+
+        bot, transport = in_memory_bot("alice")
+        release = Event()
+
+        @bot.command("slow", timeout=0.1, max_concurrency=1)
+        def slow():
+            release.wait(5)
+            return "finally"
+
+        bot.commandworker(transport.new_message("slow", "alice"))
+        assert transport.sent[-1].markdown == "⚠️ Error: This command took too long to finish."
+
+        # The call is still running, so the next one is busy
+        bot.commandworker(transport.new_message("slow", "alice"))
+        assert transport.sent[-1].markdown == \
+            "⚠️ Error: This command is busy right now. Try again later."
+        assert bot.command_stats()["slow"]["in_flight"] == 1
+
+        release.set()
+        sleep(0.1)
+        stats = bot.commands["slow"].stats()
+        assert stats["in_flight"] == 0
+        assert stats["calls"] == 2
+        assert stats["timeouts"] == 1
+        assert stats["busy"] == 1
+        assert len(transport.sent) == 2
+
+    def test_concurrency_limit_queues(self):
+        """Tests that calls beyond max_concurrency wait up to queue_timeout for a slot"""
+        from concurrent.futures import ThreadPoolExecutor
+        from threading import Lock
+
+        bot, transport = in_memory_bot("alice")
+        lock = Lock()
+        running = [0]
+        peak = [0]
+
+        @bot.command("work", max_concurrency=2, queue_timeout=5)
+        def work():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return "done"
+
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            futures = [pool.submit(bot.commandworker, transport.new_message("work", "alice"))
+                       for _ in range(6)]
+            for future in futures:
+                future.result()
+
+        assert peak[0] == 2
+        assert [message.markdown for message in transport.sent] == ["done"] * 6
+        assert bot.commands["work"].stats()["busy"] == 0
+        assert "help" not in bot.command_stats()
+
+    def test_busy_without_concurrency_limit(self):
+        """Tests that calls beyond the threads for timed calls are busy and release their slot"""
+        from threading import Event
+        from sparkbot.executor import Bulkhead
+        from sparkbot.exceptions import CommandBusy, CommandTimeout
+
+        release = Event()
+        bulkhead = Bulkhead(timeout=0.05, timeout_workers=1)
+
+        # One call runs on the only thread and one waits for it. Both time out and keep their slot.
+        for _ in range(2):
+            with pytest.raises(CommandTimeout):
+                bulkhead.run(release.wait)
+        for _ in range(2):
+            with pytest.raises(CommandBusy):
+                bulkhead.run(release.wait)
+
+        stats = bulkhead.stats()
+        assert stats["in_flight"] == 2
+        assert stats["busy"] == 2
+        assert stats["timeouts"] == 2
+
+        release.set()
+        for _ in range(50):
+            if bulkhead.stats()["in_flight"] == 0:
+                break
+            sleep(0.01)
+        assert bulkhead.stats()["in_flight"] == 0
+        assert bulkhead.run(lambda: "done") == "done"
+        assert bulkhead.stats()["in_flight"] == 0
+
+    def test_generator_timeout(self):
+        """Tests that a command which yields is timed across all of its replies"""
+        bot, transport = in_memory_bot("alice")
+
+        @bot.command("count", timeout=0.2)
+        def count():
+            for number in range(10):
+                yield str(number)
+                sleep(0.05)
+
+        bot.commandworker(transport.new_message("count", "alice"))
+
+        replies = [message.markdown for message in transport.sent]
+        assert 1 < len(replies) < 10
+        assert replies[:2] == ["0", "1"]
+        assert replies[-1] == "⚠️ Error: This command took too long to finish."
+        assert bot.metrics.command_errors.value("count") == 1
+
+    def test_bad_limits(self):
+        """Tests that timeout and max_concurrency are checked when the command is added"""
+        bot, _ = in_memory_bot("alice")
+
+        with pytest.raises(TypeError):
+            bot.command("slow", timeout="5")(lambda: "")
+        with pytest.raises(ValueError):
+            bot.command("slow", max_concurrency=0)(lambda: "")
+
+class TestAsyncCommands:
+
+    def test_coroutine(self):
+        """Tests that async def commands reply through commandworker"""
+        import asyncio
+        from sparkbot.exceptions import SparkBotError
+
+        bot, transport = in_memory_bot("alice")
+
+        @bot.command("ping")
+        async def ping(commandline):
+            await asyncio.sleep(0)
+            return "pong " + commandline[-1]
+
+        @bot.command("fail")
+        async def fail():
+            raise SparkBotError("Failed", "it broke")
+
+        bot.commandworker(transport.new_message("ping a", "alice"))
+        bot.commandworker(transport.new_message("fail", "alice"))
+
+        assert [message.markdown for message in transport.sent] == \
+            ["pong a", "⚠️ Error: it broke"]
+
+    def test_callback_refused(self):
+        """Tests that async commands can't take the blocking callback"""
+        bot, transport = in_memory_bot("alice")
+
+        with pytest.raises(CommandSetupError):
+            @bot.command("ping")
+            async def ping(callback):
+                callback("pong")
+
+        assert "ping" not in bot.commands
+
+    @pytest.mark.skipif(sys.version_info < (3, 6), reason="async generators need Python 3.6")
+    def test_async_generator(self):
+        """Tests that each value an async generator yields is a reply, and that they cache"""
+        from asyncgen_commands import add_commands
+
+        bot, transport = in_memory_bot("alice")
+        calls = []
+        add_commands(bot, calls)
+
+        for text in ("count", "status", "status"):
+            bot.commandworker(transport.new_message(text, "alice"))
+
+        assert [message.markdown for message in transport.sent] == ["0", "1", "2", "up", "up"]
+        assert len(calls) == 1
+
+    def test_commands_share_the_loop(self):
+        """Tests that async commands from several workers wait on one loop concurrently"""
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from threading import current_thread
+        from time import monotonic
+
+        bot, transport = in_memory_bot("alice")
+        threads = set()
+
+        @bot.command("wait")
+        async def wait():
+            threads.add(current_thread().name)
+            await asyncio.sleep(0.2)
+            return "done"
+
+        started = monotonic()
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            futures = [pool.submit(bot.commandworker, transport.new_message("wait", "alice"))
+                       for _ in range(10)]
+            for future in futures:
+                future.result()
+
+        assert monotonic() - started < 1
+        assert threads == {"sparkbot-loop"}
+        assert [message.markdown for message in transport.sent] == ["done"] * 10
+
+    def test_limits_and_cache(self):
+        """Tests that timeouts and caching apply to async commands"""
+        import asyncio
+
+        bot, transport = in_memory_bot("alice")
+        calls = []
+
+        @bot.command("slow", timeout=0.1)
+        async def slow():
+            await asyncio.sleep(1)
+            return "too late"
+
+        @bot.command("status", cache_ttl=60)
+        async def status():
+            calls.append(1)
+            return "up"
+
+        bot.commandworker(transport.new_message("slow", "alice"))
+        bot.commandworker(transport.new_message("status", "alice"))
+        bot.commandworker(transport.new_message("status", "alice"))
+
+        assert [message.markdown for message in transport.sent] == \
+            ["⚠️ Error: This command took too long to finish.", "up", "up"]
+        assert len(calls) == 1
+        assert not bot.commands["slow"].awaitable
+
+    def test_timeout_cancels(self):
+        """Tests that an async command which runs out of time is cancelled and frees its slot"""
+        import asyncio
+        from time import monotonic
+
+        bot, transport = in_memory_bot("alice")
+        cancelled = []
+
+        @bot.command("slow", timeout=0.1, max_concurrency=1)
+        async def slow():
+            try:
+                await asyncio.sleep(3)
+            except asyncio.CancelledError:
+                cancelled.append("slow")
+                raise
+            return "too late"
+
+        started = monotonic()
+        for call in range(2):
+            bot.commandworker(transport.new_message("slow", "alice"))
+            # The slot is given back once the coroutine has finished unwinding
+            for _ in range(100):
+                if bot.commands["slow"].stats()["in_flight"] == 0:
+                    break
+                sleep(0.01)
+            assert len(cancelled) == call + 1
+
+        assert monotonic() - started < 2
+        assert [message.markdown for message in transport.sent] == \
+            ["⚠️ Error: This command took too long to finish."] * 2
+        assert bot.commands["slow"].stats()["busy"] == 0
+
+    @pytest.mark.skipif(sys.version_info < (3, 6), reason="async generators need Python 3.6")
+    def test_generator_timeout_cancels(self):
+        """Tests that the step of an async generator running when it times out is cancelled"""
+        from asyncgen_commands import add_slow_generator
+
+        bot, transport = in_memory_bot("alice")
+        cancelled = []
+        add_slow_generator(bot, cancelled)
+
+        bot.commandworker(transport.new_message("ticks", "alice"))
+        for _ in range(50):
+            if bot.commands["ticks"].stats()["in_flight"] == 0:
+                break
+            sleep(0.01)
+
+        assert cancelled == ["ticks"]
+        assert bot.commands["ticks"].stats()["in_flight"] == 0
+        assert [message.markdown for message in transport.sent] == \
+            ["tick", "⚠️ Error: This command took too long to finish."]
+
+    def test_execute_async_awaits_on_bot_loop(self):
+        """Tests that execute_async awaits async def commands on the bot loop, not a worker"""
+        import asyncio
+        from threading import current_thread
+
+        bot, transport = in_memory_bot("alice")
+        threads = []
+
+        @bot.command("ping")
+        async def ping():
+            threads.append(current_thread().name)
+            return "pong"
+
+        assert bot.commands["ping"].awaitable
+        command = bot.commands["ping"]
+
+        async def run():
+            return await command.execute_async(commandline=["ping"])
+
+        loop = asyncio.new_event_loop()
+        try:
+            assert loop.run_until_complete(run()) == "pong"
+        finally:
+            loop.close()
+        assert threads == ["sparkbot-loop"]
+        bot.event_loop.stop()
+
+class TestCommandRegistry:
+
+    def test_help_follows_changes(self):
+        """Tests that help-all includes commands added after it was first used, and removals"""
+        bot, _ = in_memory_bot()
+        assert bot.my_help_all().endswith("\n - help")
+
+        @bot.command(["name2", "name1"])
+        def multiple_names():
+            """
+            Has two names.
+            """
+
+        @bot.command("z")
+        def z_command():
+            pass
+
+        assert bot.my_help_all() == (
+"""Type `help [command]` for more specific help about any of these commands:
+ - help
+ - name1, name2
+ - z""")
+        assert bot.my_help(["help", "name1"]) == "\nHas two names.\n"
+        assert bot.my_help(["help", "z"]) == "There is no help available for `z`."
+        assert bot.commands.names_of(bot.commands["name1"]) == ["name2", "name1"]
+
+        bot.remove_help()
+        del bot.commands["name2"]
+        assert "help" not in bot.commands
+        assert bot.my_help_all() == (
+"""Type `help [command]` for more specific help about any of these commands:
+ - name1
+ - z""")
+
+    def test_replacing_a_name(self):
+        """Tests that registering a name again moves it to the new command"""
+        bot, _ = in_memory_bot()
+
+        @bot.command(["status", "st"])
+        def status():
+            return "old"
+
+        @bot.command("st")
+        def short_status():
+            """Short status"""
+            return "new"
+
+        assert bot.commands["st"].execute() == "new"
+        assert bot.my_help(["help", "st"]) == "Short status"
+        assert bot.my_help_all().splitlines()[1:] == [" - help", " - st", " - status"]
+        assert len(bot.commands) == 3
+        with pytest.raises(KeyError):
+            del bot.commands["missing"]
+
+    def test_snapshot_is_unchanged(self):
+        """Tests that a snapshot keeps the commands it was taken with"""
+        bot, _ = in_memory_bot()
+        snapshot = bot.commands.snapshot
+
+        @bot.command("ping")
+        def ping():
+            return "pong"
+
+        assert list(snapshot) == ["help"]
+        assert sorted(bot.commands.snapshot) == ["help", "ping"]
+        with pytest.raises(TypeError):
+            snapshot["ping"] = None